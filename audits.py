@@ -0,0 +1,351 @@
+"""
+Map-reduce versions of the notebook's data-quality audits.
+
+Each auditor keeps its result in an explicit state value and has three
+operations:
+
+    init()                  -> empty state
+    update(state, element)  -> fold one top-level element (node/way/relation/...) in
+    merge(a, b)             -> combine the states of two disjoint parts of the file
+
+so the file can be cut into byte ranges, each range audited in its own process,
+and the partial states merged. Ranges are cut just before a top-level
+<node/<way/<relation, and each range is parsed on its own by wrapping it in an
+<osm> root, so every element is seen by exactly one shard and the merged result
+is the same as a serial run.
+
+Usage:
+    results = audit_file("WPM.osm")           # one shard per core
+    results['key_types']
+    # {'lower': ..., 'lower_colon': ..., 'problemchars': ..., 'other': ...}
+"""
+
+import os
+import re
+import xml.etree.cElementTree as ET
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from data import OSM_PATH
+
+# count_tags / process_keys_map
+lower = re.compile(r'^([a-z]|_)*$')
+lower_colon = re.compile(r'^([a-z]|_)*:([a-z]|_)*$')
+problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
+
+# audit (street types)
+street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
+expected = ["Street", "Avenue", "Boulevard", "Drive", "Court", "Place", "Square", "Lane", "Road",
+            "Trail", "Parkway", "Plaza", "Park"]
+mapping = {"St": "Street",
+           "ST": "Street",
+           "St.": "Street",
+           "St,": "Street",
+           "Street.": "Street",
+           "street": "Street",
+           "Sq": "Square",
+           "Rd.": "Road",
+           "Rd": "Road",
+           "Ave": "Avenue",
+           "DR.": "Drive"
+           }
+
+# audit_amenity
+# https://wiki.openstreetmap.org/wiki/Key:amenity
+amenity_re = re.compile(r'\S+(\s\S+)*')
+expected_amenities = ["bar", "biergarten", "cafe", "fast_food", "pub", "restaurant", "school", "university",
+                      "boat_rental", "boat_sharing", "parking", "taxi", "atm", "bank", "hospital", "pharmacy",
+                      "fire_station", "police", "post_office", "townhall", "water_point", "gym", "martketplace",
+                      "internet_cafe", "place_of_worship", "user defined"]
+amenity_mapping = {"fastfood": "fast_food",
+                   "New American": "restaurant",
+                   "police; council": "police"
+                   }
+
+# Start of a top-level element; <tag>, <nd> and <member> never match
+ELEMENT_START_RE = re.compile(rb'<(?:node|way|relation)[\s/>]')
+
+READ_SIZE = 1 << 20
+
+
+# ================================================== #
+#               Auditors                             #
+# ================================================== #
+def key_type(k):
+    """Which of the process_keys_map buckets a tag k falls in"""
+    if lower.search(k):
+        return 'lower'
+    elif lower_colon.search(k):
+        return 'lower_colon'
+    elif problemchars.search(k):
+        return 'problemchars'
+    return 'other'
+
+
+def update_name(name, mapping=mapping):
+    """Replace the street type at the end of name if it is a known abbreviation
+
+    The notebook's version substituted whenever any mapping key appeared anywhere
+    in the name (so "State Road" became "State Street"); this one only looks at
+    the street type itself.
+    """
+    m = street_type_re.search(name)
+    if m and m.group() in mapping:
+        return name[:m.start()] + mapping[m.group()]
+    return name
+
+
+def update_amenity(name, amenity_mapping=amenity_mapping):
+    for amenity in amenity_mapping:
+        if amenity in name:
+            name = re.sub(r'\b' + re.escape(amenity), amenity_mapping[amenity], name)
+    return name
+
+
+class Auditor(object):
+    """Base auditor; subclasses override init, update and merge"""
+
+    name = None
+
+    def init(self):
+        raise NotImplementedError
+
+    def update(self, state, element):
+        raise NotImplementedError
+
+    def merge(self, a, b):
+        raise NotImplementedError
+
+    def root(self, state, root):
+        """Called once with the <osm> root element of the real document"""
+
+    def result(self, state):
+        return state
+
+
+class TagCounts(Auditor):
+    """count_tags: how many of each XML tag there are"""
+
+    name = 'tags'
+
+    def init(self):
+        return Counter()
+
+    def update(self, state, element):
+        for e in element.iter():
+            state[e.tag] += 1
+
+    def root(self, state, root):
+        state[root.tag] += 1
+
+    def merge(self, a, b):
+        a.update(b)
+        return a
+
+    def result(self, state):
+        return dict(state)
+
+
+class KeyTypes(Auditor):
+    """process_keys_map: classify every tag k as lower, lower_colon, problemchars or other"""
+
+    name = 'key_types'
+
+    def init(self):
+        return {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
+
+    def update(self, state, element):
+        for tag in element.iter('tag'):
+            state[key_type(tag.attrib['k'])] += 1
+
+    def merge(self, a, b):
+        for key, count in b.items():
+            a[key] += count
+        return a
+
+
+class TagValueAudit(Auditor):
+    """Group the values of one tag key that do not have an expected type"""
+
+    key = None
+    pattern = None
+    expected = ()
+
+    def init(self):
+        return defaultdict(set)
+
+    def update(self, state, element):
+        if element.tag == 'node' or element.tag == 'way':
+            for tag in element.iter('tag'):
+                if tag.attrib['k'] == self.key:
+                    value = tag.attrib['v']
+                    m = self.pattern.search(value)
+                    if m and m.group() not in self.expected:
+                        state[m.group()].add(value)
+
+    def merge(self, a, b):
+        for found, values in b.items():
+            a[found] |= values
+        return a
+
+    def result(self, state):
+        return dict(state)
+
+
+class StreetTypes(TagValueAudit):
+    """audit: street names whose type is not in expected"""
+
+    name = 'street_types'
+    key = 'addr:street'
+    pattern = street_type_re
+    expected = expected
+
+
+class Amenities(TagValueAudit):
+    """audit_amenity: amenity values not in expected_amenities"""
+
+    name = 'amenities'
+    key = 'amenity'
+    pattern = amenity_re
+    expected = expected_amenities
+
+
+class Users(Auditor):
+    """process_users_map: the set of users that edited an element"""
+
+    name = 'users'
+
+    def init(self):
+        return set()
+
+    def update(self, state, element):
+        if element.get('user'):
+            state.add(element.get('user'))
+
+    def merge(self, a, b):
+        a |= b
+        return a
+
+
+AUDITORS = (TagCounts(), KeyTypes(), StreetTypes(), Amenities(), Users())
+
+
+# ================================================== #
+#               Sharding                             #
+# ================================================== #
+def shard_offsets(filename, shards):
+    """Byte offsets that cut filename into about shards ranges at top-level element starts"""
+    size = os.path.getsize(filename)
+    offsets = [0]
+    with open(filename, 'rb') as f:
+        for i in range(1, shards):
+            pos = max(size * i // shards, offsets[-1] + 1)
+            f.seek(pos)
+            # Keep the last bytes of the previous block in case a start tag straddles them
+            carry = b''
+            while True:
+                block = f.read(READ_SIZE)
+                if not block:
+                    return offsets + [size]
+                m = ELEMENT_START_RE.search(carry + block)
+                if m:
+                    offsets.append(pos - len(carry) + m.start())
+                    break
+                pos += len(block)
+                carry = block[-16:]
+    return offsets + [size]
+
+
+def read_range(filename, start, end):
+    """Yield the bytes of filename[start:end] in READ_SIZE blocks"""
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = f.read(min(READ_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+
+def iter_range(filename, start, end, first, last):
+    """Yield the top-level elements that start in filename[start:end]
+
+    The first range holds the real <osm> root, which is yielded first as
+    (True, root); every other item is (False, element).
+    """
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    depth = 0
+    root = None
+
+    def events():
+        nonlocal depth, root
+        for event, elem in parser.read_events():
+            if event == 'start':
+                depth += 1
+                if depth == 1:
+                    root = elem
+                    if first:
+                        yield True, elem
+            else:
+                depth -= 1
+                if depth == 1:
+                    yield False, elem
+                    root.clear()
+
+    if not first:
+        parser.feed(b'<osm>')
+    for block in read_range(filename, start, end):
+        parser.feed(block)
+        yield from events()
+    if not last:
+        parser.feed(b'</osm>')
+    parser.close()
+    yield from events()
+
+
+def audit_range(filename, start, end, first, last, auditors=AUDITORS):
+    """Run every auditor over one byte range and return their partial states"""
+    states = [a.init() for a in auditors]
+    for is_root, element in iter_range(filename, start, end, first, last):
+        for auditor, state in zip(auditors, states):
+            if is_root:
+                auditor.root(state, element)
+            else:
+                auditor.update(state, element)
+    return states
+
+
+def audit_file(filename=OSM_PATH, auditors=AUDITORS, processes=None, shards=None):
+    """Audit filename across a process pool and return {auditor name: result}"""
+    processes = processes or os.cpu_count() or 1
+    offsets = shard_offsets(filename, shards or processes)
+    ranges = list(zip(offsets[:-1], offsets[1:]))
+
+    args = [(filename, start, end, i == 0, i == len(ranges) - 1, auditors)
+            for i, (start, end) in enumerate(ranges)]
+    if processes == 1 or len(ranges) == 1:
+        partials = [audit_range(*a) for a in args]
+    else:
+        with ProcessPoolExecutor(processes) as pool:
+            partials = list(pool.map(audit_range, *zip(*args)))
+
+    results = {}
+    for i, auditor in enumerate(auditors):
+        state = partials[0][i]
+        for partial in partials[1:]:
+            state = auditor.merge(state, partial[i])
+        results[auditor.name] = auditor.result(state)
+    return results
+
+
+if __name__ == '__main__':
+    import pprint
+
+    results = audit_file(OSM_PATH)
+    pprint.pprint(results['tags'])
+    pprint.pprint(results['key_types'])
+    print(len(results['users']))
+    pprint.pprint(results['street_types'])
+    pprint.pprint(results['amenities'])
@@ -0,0 +1,180 @@
+"""
+Per-changeset summary built while the data is loaded.
+
+changeset, uid and timestamp ride along on every node and way but the report
+only uses uid, for the top-10 users. ChangesetWriter folds each element into
+a running summary per changeset as load_map streams the file:
+
+    changesets(id, uid, user, first_timestamp, last_timestamp, nodes, ways,
+               tags, min_lat, min_lon, max_lat, max_lon)
+
+Timestamps are epoch seconds. The bbox covers the nodes in the changeset (a
+changeset that only touched ways has none). Flushes are UPSERTs that add the
+counts and widen the bbox and time span, so loading another file into the same
+database updates the rows in place. Indexes on the time columns and uid keep
+the contributor-activity and triage queries in CHANGESET_QUERIES off the nodes
+and ways tables.
+
+Usage:
+    load_map("WPM.osm", "WPM.db", writers=[TableWriter(), ChangesetWriter()])
+    build_changesets(conn)          # rebuild from the loaded tables
+    conn.execute(CHANGESET_QUERIES['largest_area']).fetchall()
+"""
+
+from compact import parse_timestamp
+from database import DB_PATH, create_connection, create_table
+
+SQL_CREATE_CHANGESETS_TABLE = """CREATE TABLE IF NOT EXISTS changesets (
+    id INTEGER PRIMARY KEY NOT NULL,
+    uid INTEGER,
+    user TEXT,
+    first_timestamp INTEGER,
+    last_timestamp INTEGER,
+    nodes INTEGER NOT NULL DEFAULT 0,
+    ways INTEGER NOT NULL DEFAULT 0,
+    tags INTEGER NOT NULL DEFAULT 0,
+    min_lat FLOAT,
+    min_lon FLOAT,
+    max_lat FLOAT,
+    max_lon FLOAT
+);"""
+
+SQL_CREATE_CHANGESETS_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS changesets_first_timestamp ON changesets (first_timestamp);",
+    "CREATE INDEX IF NOT EXISTS changesets_last_timestamp ON changesets (last_timestamp);",
+    "CREATE INDEX IF NOT EXISTS changesets_uid ON changesets (uid, first_timestamp);",
+]
+
+
+def widen(column, fn):
+    """SET clause combining the stored and the new value of a nullable min/max column"""
+    return "{0} = {1}(COALESCE({0}, excluded.{0}), COALESCE(excluded.{0}, {0}))".format(column, fn)
+
+
+SQL_UPSERT_CHANGESET = """INSERT INTO changesets VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (id) DO UPDATE SET
+        uid = COALESCE(uid, excluded.uid),
+        user = COALESCE(user, excluded.user),
+        nodes = nodes + excluded.nodes,
+        ways = ways + excluded.ways,
+        tags = tags + excluded.tags,
+        {}""".format(',\n        '.join([
+    widen('first_timestamp', 'MIN'), widen('last_timestamp', 'MAX'),
+    widen('min_lat', 'MIN'), widen('min_lon', 'MIN'),
+    widen('max_lat', 'MAX'), widen('max_lon', 'MAX')]))
+
+# The same summary from the loaded tables, in the column order of changesets
+SQL_CHANGESET_SUMMARY = """SELECT changeset, MIN(uid), MIN(user),
+        MIN(CAST(strftime('%s', timestamp) AS INTEGER)),
+        MAX(CAST(strftime('%s', timestamp) AS INTEGER)),
+        SUM(is_node), SUM(1 - is_node), SUM(tags),
+        MIN(lat), MIN(lon), MAX(lat), MAX(lon)
+    FROM (SELECT n.changeset, n.uid, n.user, n.timestamp, 1 AS is_node, n.lat, n.lon,
+                 (SELECT COUNT(*) FROM nodes_tags t WHERE t.id = n.id) AS tags
+          FROM nodes n
+          UNION ALL
+          SELECT w.changeset, w.uid, w.user, w.timestamp, 0, NULL, NULL,
+                 (SELECT COUNT(*) FROM ways_tags t WHERE t.id = w.id)
+          FROM ways w)
+    GROUP BY changeset"""
+
+CHANGESET_QUERIES = {
+    # Contributors by number of changesets, with their first and last edit
+    'user_activity': """SELECT uid, user, COUNT(*) AS changesets, SUM(nodes + ways) AS edits,
+            datetime(MIN(first_timestamp), 'unixepoch') AS first,
+            datetime(MAX(last_timestamp), 'unixepoch') AS last
+        FROM changesets
+        GROUP BY uid
+        ORDER BY changesets DESC LIMIT 10;""",
+    # Changesets spread over an unusually large area, a common sign of trouble
+    'largest_area': """SELECT id, user, nodes, ways,
+            (max_lat - min_lat) * (max_lon - min_lon) AS area
+        FROM changesets
+        WHERE min_lat IS NOT NULL
+        ORDER BY area DESC LIMIT 10;""",
+    # Largest changesets of the last year of the data
+    'recent_largest': """SELECT id, user, nodes + ways AS edits,
+            datetime(first_timestamp, 'unixepoch') AS started
+        FROM changesets
+        WHERE first_timestamp >= (SELECT MAX(last_timestamp) - 365 * 86400 FROM changesets)
+        ORDER BY edits DESC LIMIT 10;""",
+}
+
+
+def create_changesets(conn):
+    create_table(conn, SQL_CREATE_CHANGESETS_TABLE)
+    for sql in SQL_CREATE_CHANGESETS_INDEXES:
+        create_table(conn, sql)
+
+
+class ChangesetWriter(object):
+    """load_map writer that maintains changesets while the elements stream past"""
+
+    def __init__(self):
+        self.summaries = {}
+        self.added = 0
+
+    @property
+    def pending(self):
+        return self.added
+
+    def create(self, conn):
+        create_changesets(conn)
+
+    def add(self, el):
+        if 'node' in el:
+            attribs, tags = el['node'], el['node_tags']
+        else:
+            attribs, tags = el['way'], el['way_tags']
+        changeset = int(attribs['changeset'])
+        ts = parse_timestamp(attribs['timestamp'])
+
+        s = self.summaries.get(changeset)
+        if s is None:
+            # [uid, user, first, last, nodes, ways, tags, min_lat, min_lon, max_lat, max_lon]
+            s = self.summaries[changeset] = [int(attribs['uid']), attribs['user'], ts, ts,
+                                             0, 0, 0, None, None, None, None]
+        else:
+            s[2] = min(s[2], ts)
+            s[3] = max(s[3], ts)
+        s[6] += len(tags)
+
+        if 'node' in el:
+            s[4] += 1
+            lat, lon = float(attribs['lat']), float(attribs['lon'])
+            if s[7] is None:
+                s[7:11] = [lat, lon, lat, lon]
+            else:
+                s[7], s[8] = min(s[7], lat), min(s[8], lon)
+                s[9], s[10] = max(s[9], lat), max(s[10], lon)
+        else:
+            s[5] += 1
+        self.added += 1
+
+    def flush(self, conn):
+        conn.executemany(SQL_UPSERT_CHANGESET,
+                         ([changeset] + s for changeset, s in self.summaries.items()))
+        self.summaries.clear()
+        self.added = 0
+
+    def finish(self, conn):
+        pass
+
+
+def build_changesets(conn):
+    """(Re)build changesets from the loaded nodes and ways; return the number of rows"""
+    conn.execute("DROP TABLE IF EXISTS changesets")
+    create_changesets(conn)
+    conn.executemany(SQL_UPSERT_CHANGESET, conn.execute(SQL_CHANGESET_SUMMARY).fetchall())
+    conn.commit()
+    return conn.execute("SELECT COUNT(*) FROM changesets").fetchone()[0]
+
+
+if __name__ == '__main__':
+    import pprint
+
+    conn = create_connection(DB_PATH)
+    print("{} changesets".format(build_changesets(conn)))
+    for name, sql in CHANGESET_QUERIES.items():
+        print(name)
+        pprint.pprint(conn.execute(sql).fetchall())
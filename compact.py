@@ -0,0 +1,166 @@
+"""
+Compact typed storage for nodes, ways and ways_nodes.
+
+The plain tables keep version and the ISO timestamp as TEXT, lat/lon as floats
+and repeat the user name on every row. CompactTableWriter stores instead:
+
+    users(uid, user)
+    nodes_compact(id, lat, lon, uid, version, changeset, timestamp)
+    ways_compact(id, uid, version, changeset, timestamp)
+    ways_nodes(id, node_id, position)  -- WITHOUT ROWID, keyed on (id, position)
+
+with integer versions, epoch-second timestamps and lat/lon as fixed-point
+integers (degrees * 10**7, the precision OSM itself stores). Tables are STRICT
+when the SQLite library supports it. nodes and ways become views that decode
+back to the old columns, so the report SQL still works.
+
+Timestamps are indexed, so edit-history questions are range scans:
+
+    SELECT COUNT(*) FROM nodes_compact
+    WHERE timestamp >= CAST(strftime('%s', 'now', '-1 year') AS INTEGER);
+
+A uid keeps the first user name seen for it.
+
+Usage:
+    conn = load_map("WPM.osm", "WPM.db", writers=[CompactTableWriter()])
+"""
+
+import calendar
+import sqlite3
+
+from data import OSM_PATH
+from database import (SQL_CREATE_NODES_TAGS_TABLE, SQL_CREATE_WAYS_TAGS_TABLE, SQL_INSERT,
+                      TableWriter, load_map)
+
+# STRICT tables need SQLite 3.37
+STRICT = " STRICT" if sqlite3.sqlite_version_info >= (3, 37, 0) else ""
+
+# Fixed-point scale for lat/lon
+COORD_SCALE = 10 ** 7
+
+SQL_CREATE_USERS_TABLE = """CREATE TABLE IF NOT EXISTS users (
+    uid INTEGER PRIMARY KEY NOT NULL,
+    user TEXT NOT NULL
+){};""".format(STRICT)
+
+SQL_CREATE_NODES_COMPACT_TABLE = """CREATE TABLE IF NOT EXISTS nodes_compact (
+    id INTEGER PRIMARY KEY NOT NULL,
+    lat INTEGER NOT NULL,
+    lon INTEGER NOT NULL,
+    uid INTEGER,
+    version INTEGER,
+    changeset INTEGER,
+    timestamp INTEGER,
+    FOREIGN KEY (uid) REFERENCES users(uid)
+){};""".format(STRICT)
+
+SQL_CREATE_WAYS_COMPACT_TABLE = """CREATE TABLE IF NOT EXISTS ways_compact (
+    id INTEGER PRIMARY KEY NOT NULL,
+    uid INTEGER,
+    version INTEGER,
+    changeset INTEGER,
+    timestamp INTEGER,
+    FOREIGN KEY (uid) REFERENCES users(uid)
+){};""".format(STRICT)
+
+SQL_CREATE_WAYS_NODES_COMPACT_TABLE = """CREATE TABLE IF NOT EXISTS ways_nodes (
+    id INTEGER NOT NULL,
+    node_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (id, position)
+) WITHOUT ROWID{};""".format("," + STRICT if STRICT else "")
+
+SQL_CREATE_NODES_TIMESTAMP_INDEX = """CREATE INDEX IF NOT EXISTS nodes_compact_timestamp_idx
+    ON nodes_compact (timestamp);"""
+
+SQL_CREATE_WAYS_TIMESTAMP_INDEX = """CREATE INDEX IF NOT EXISTS ways_compact_timestamp_idx
+    ON ways_compact (timestamp);"""
+
+# Compatibility views with the column names and order of the plain tables. lat/lon
+# are divided by the scale (not multiplied by its inverse) so they round-trip exactly.
+SQL_CREATE_NODES_VIEW = """CREATE VIEW IF NOT EXISTS nodes AS
+    SELECT n.id AS id, n.lat / {0:.1f} AS lat, n.lon / {0:.1f} AS lon,
+           u.user AS user, n.uid AS uid,
+           CAST(n.version AS TEXT) AS version, n.changeset AS changeset,
+           strftime('%Y-%m-%dT%H:%M:%SZ', n.timestamp, 'unixepoch') AS timestamp
+    FROM nodes_compact n
+    LEFT JOIN users u ON u.uid = n.uid;""".format(COORD_SCALE)
+
+SQL_CREATE_WAYS_VIEW = """CREATE VIEW IF NOT EXISTS ways AS
+    SELECT w.id AS id, u.user AS user, w.uid AS uid,
+           CAST(w.version AS TEXT) AS version, w.changeset AS changeset,
+           strftime('%Y-%m-%dT%H:%M:%SZ', w.timestamp, 'unixepoch') AS timestamp
+    FROM ways_compact w
+    LEFT JOIN users u ON u.uid = w.uid;"""
+
+
+def parse_timestamp(ts):
+    """Epoch seconds for an OSM timestamp like '2010-07-22T16:16:51Z'"""
+    return calendar.timegm((int(ts[0:4]), int(ts[5:7]), int(ts[8:10]),
+                            int(ts[11:13]), int(ts[14:16]), int(ts[17:19])))
+
+
+def to_fixed(degrees):
+    """Fixed-point integer for a lat/lon in degrees"""
+    return int(round(float(degrees) * COORD_SCALE))
+
+
+class CompactTableWriter(TableWriter):
+    """TableWriter for the compact typed layout"""
+
+    create_sql = [SQL_CREATE_USERS_TABLE, SQL_CREATE_NODES_COMPACT_TABLE, SQL_CREATE_WAYS_COMPACT_TABLE,
+                  SQL_CREATE_WAYS_NODES_COMPACT_TABLE, SQL_CREATE_NODES_TAGS_TABLE,
+                  SQL_CREATE_WAYS_TAGS_TABLE, SQL_CREATE_NODES_VIEW, SQL_CREATE_WAYS_VIEW]
+    insert_sql = dict(SQL_INSERT, **{
+        'users': "INSERT OR IGNORE INTO users VALUES (?, ?)",
+        'nodes': "INSERT INTO nodes_compact VALUES (?, ?, ?, ?, ?, ?, ?)",
+        'ways': "INSERT INTO ways_compact VALUES (?, ?, ?, ?, ?)",
+    })
+
+    def __init__(self):
+        super(CompactTableWriter, self).__init__()
+        self.uids = set()
+
+    def add_user(self, attribs):
+        uid = int(attribs['uid'])
+        if uid not in self.uids:
+            self.uids.add(uid)
+            self.rows['users'].append((uid, attribs['user']))
+        return uid
+
+    def add(self, el):
+        if 'node' in el:
+            n = el['node']
+            uid = self.add_user(n)
+            self.rows['nodes'].append((int(n['id']), to_fixed(n['lat']), to_fixed(n['lon']), uid,
+                                       int(n['version']), int(n['changeset']),
+                                       parse_timestamp(n['timestamp'])))
+            self.add_tags('nodes_tags', el['node_tags'])
+        else:
+            w = el['way']
+            uid = self.add_user(w)
+            self.rows['ways'].append((int(w['id']), uid, int(w['version']), int(w['changeset']),
+                                      parse_timestamp(w['timestamp'])))
+            self.add_tags('ways_tags', el['way_tags'])
+            self.rows['ways_nodes'].extend((int(nd['id']), int(nd['node_id']), nd['position'])
+                                           for nd in el['way_nodes'])
+
+    def flush(self, conn):
+        # users first, so the uids in this batch resolve
+        users = self.rows.pop('users', None)
+        if users:
+            conn.executemany(self.insert_sql['users'], users)
+        super(CompactTableWriter, self).flush(conn)
+
+    def finish(self, conn):
+        # Built after the load rather than maintained row by row
+        conn.execute(SQL_CREATE_NODES_TIMESTAMP_INDEX)
+        conn.execute(SQL_CREATE_WAYS_TIMESTAMP_INDEX)
+
+
+if __name__ == '__main__':
+    import os
+
+    conn = load_map(OSM_PATH, "WPM.db", writers=[CompactTableWriter()])
+    conn.execute("VACUUM")
+    print("WPM.db: {} bytes".format(os.path.getsize("WPM.db")))
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Shaping code from the notebook, broken out so the loaders can share it.
+
+Parse the elements in the OSM XML file, transform them from document format to
+tabular format and write them to .csv files (or hand them to a database loader).
+See shape_element for the layout of each shaped element.
+"""
+
+import csv
+import codecs
+import pprint
+import re
+import xml.etree.cElementTree as ET
+
+from my_schema import SCHEMA
+
+OSM_PATH = "WPM.osm"
+SAMPLE_PATH = "sample_WPM.osm"
+
+# Parameter: take every k-th top level element
+SAMPLE_K = 42
+
+NODES_PATH = "nodes.csv"
+NODE_TAGS_PATH = "nodes_tags.csv"
+WAYS_PATH = "ways.csv"
+WAY_NODES_PATH = "ways_nodes.csv"
+WAY_TAGS_PATH = "ways_tags.csv"
+
+LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
+PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
+
+# Make sure the fields order in the csvs matches the column order in the sql table schema
+NODE_FIELDS = ['id', 'lat', 'lon', 'user', 'uid', 'version', 'changeset', 'timestamp']
+NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
+WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
+WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
+WAY_NODES_FIELDS = ['id', 'node_id', 'position']
+
+
+def shape_tag(element_id, tag, problem_chars=PROBLEMCHARS, default_tag_type='regular'):
+    """Shape one <tag> child into a tags row, or None if its k has problem characters"""
+    k = tag.attrib['k']
+
+    # ignores tags containing problem characters in the k tag attribute:
+    if problem_chars.search(k):
+        return None
+
+    colon_find = k.split(':')
+    if len(colon_find) == 1:
+        key, tag_type = k, default_tag_type
+    else:
+        key, tag_type = ':'.join(colon_find[1:]), colon_find[0]
+
+    return {'id': element_id, 'key': key, 'value': tag.attrib['v'], 'type': tag_type}
+
+
+def full_key(tag_dict, default_tag_type='regular'):
+    """Undo the type/key split of shape_tag and return the original k attribute"""
+    if tag_dict['type'] == default_tag_type:
+        return tag_dict['key']
+    return tag_dict['type'] + ':' + tag_dict['key']
+
+
+def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
+                  problem_chars=PROBLEMCHARS, default_tag_type='regular'):
+    """Clean and shape node or way XML element to Python dict"""
+
+    tags = []  # Handle secondary tags the same way for both node and way elements
+
+    if element.tag == 'node':
+        node_attribs = {field: element.attrib[field] for field in node_attr_fields}
+
+        for tag in element.iter('tag'):
+            tag_dict = shape_tag(node_attribs['id'], tag, problem_chars, default_tag_type)
+            if tag_dict is not None:
+                tags.append(tag_dict)
+
+        return {'node': node_attribs, 'node_tags': tags}
+
+    elif element.tag == 'way':
+        way_attribs = {field: element.attrib[field] for field in way_attr_fields}
+
+        for tag in element.iter('tag'):
+            tag_dict = shape_tag(way_attribs['id'], tag, problem_chars, default_tag_type)
+            if tag_dict is not None:
+                tags.append(tag_dict)
+
+        way_nodes = []
+        for n, nd in enumerate(element.iter('nd')):
+            way_nodes.append({'id': way_attribs['id'], 'node_id': nd.attrib['ref'], 'position': n})
+
+        return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
+
+
+# ================================================== #
+#               Helper Functions                     #
+# ================================================== #
+def get_element(osm_file, tags=('node', 'way', 'relation')):
+    """Yield element if it is the right type of tag"""
+
+    context = ET.iterparse(osm_file, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event == 'end' and elem.tag in tags:
+            yield elem
+            root.clear()
+
+
+def make_sample(osm_file=OSM_PATH, sample_file=SAMPLE_PATH, k=SAMPLE_K):
+    """Write every k-th top level element of osm_file to sample_file"""
+    with open(sample_file, 'wb') as output:
+        output.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+        output.write(b'<osm>\n  ')
+
+        # Write every kth top level element
+        for i, element in enumerate(get_element(osm_file)):
+            if i % k == 0:
+                output.write(ET.tostring(element, encoding='utf-8'))
+
+        output.write(b'</osm>')
+
+
+def validate_element(element, validator, schema=SCHEMA):
+    """Raise ValidationError if element does not match schema"""
+    if validator.validate(element, schema) is not True:
+        field, errors = next(iter(validator.errors.items()))
+        message_string = "\nElement of type '{0}' has the following errors:\n{1}"
+        error_string = pprint.pformat(errors)
+
+        raise Exception(message_string.format(field, error_string))
+
+
+def make_validator(validate=True):
+    """cerberus.Validator(), or None when not validating
+
+    cerberus is imported here rather than at the top of the module: it is by far
+    the slowest import, and most runs (loads, audits, reports) never validate.
+    """
+    if not validate:
+        return None
+    import cerberus
+    return cerberus.Validator()
+
+
+def iter_shaped(file_in, validate=False):
+    """Yield shape_element output for every node and way in file_in"""
+    validator = make_validator(validate)
+
+    for element in get_element(file_in, tags=('node', 'way')):
+        el = shape_element(element)
+        if el:
+            if validator is not None:
+                validate_element(el, validator)
+            yield el
+
+
+class UnicodeDictWriter(csv.DictWriter, object):
+    """Extend csv.DictWriter to handle Unicode input"""
+
+    def writerow(self, row):
+        super(UnicodeDictWriter, self).writerow({
+            k: v for k, v in row.items()
+        })
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+
+# ================================================== #
+#               Main Function                        #
+# ================================================== #
+def process_map(file_in, validate):
+    """Iteratively process each XML element and write to csv(s)"""
+
+    with codecs.open(NODES_PATH, 'w', "utf-8") as nodes_file, \
+         codecs.open(NODE_TAGS_PATH, 'w', "utf-8") as nodes_tags_file, \
+         codecs.open(WAYS_PATH, 'w', "utf-8") as ways_file, \
+         codecs.open(WAY_NODES_PATH, 'w', "utf-8") as way_nodes_file, \
+         codecs.open(WAY_TAGS_PATH, 'w', "utf-8") as way_tags_file:
+
+        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
+        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
+        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
+        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
+        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
+
+        nodes_writer.writeheader()
+        node_tags_writer.writeheader()
+        ways_writer.writeheader()
+        way_nodes_writer.writeheader()
+        way_tags_writer.writeheader()
+
+        for el in iter_shaped(file_in, validate):
+            if 'node' in el:
+                nodes_writer.writerow(el['node'])
+                node_tags_writer.writerows(el['node_tags'])
+            else:
+                ways_writer.writerow(el['way'])
+                way_nodes_writer.writerows(el['way_nodes'])
+                way_tags_writer.writerows(el['way_tags'])
+
+
+if __name__ == '__main__':
+    process_map(OSM_PATH, validate=True)
+    print("Reshaped and exported.")
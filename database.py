@@ -0,0 +1,209 @@
+"""
+Create WPM.db and load the shaped OSM elements into it.
+
+The table definitions are the ones from the notebook's main(). load_map streams
+the OSM file through data.shape_element and hands each element to one or more
+writers, which batch their rows into the database; that replaces the manual
+sqlite3 `.import` of the csvs.
+
+https://www.sqlitetutorial.net/sqlite-python/create-tables/
+"""
+
+import sqlite3
+from collections import defaultdict
+from sqlite3 import Error
+
+from data import OSM_PATH, iter_shaped
+
+DB_PATH = "WPM.db"
+
+# Rows held by a writer before they are flushed with executemany
+BATCH_SIZE = 10000
+
+SQL_CREATE_NODES_TABLE = """CREATE TABLE IF NOT EXISTS nodes (
+    id INTEGER PRIMARY KEY NOT NULL,
+    lat FLOAT,
+    lon FLOAT,
+    user TEXT,
+    uid INTEGER,
+    version TEXT,
+    changeset INTEGER,
+    timestamp TEXT
+);"""
+
+SQL_CREATE_NODES_TAGS_TABLE = """CREATE TABLE IF NOT EXISTS nodes_tags (
+    id INTEGER,
+    key TEXT,
+    value TEXT,
+    type TEXT,
+    FOREIGN KEY (id) REFERENCES nodes(id)
+);"""
+
+SQL_CREATE_WAYS_TABLE = """CREATE TABLE IF NOT EXISTS ways (
+    id INTEGER PRIMARY KEY NOT NULL,
+    user TEXT,
+    uid INTEGER,
+    version TEXT,
+    changeset INTEGER,
+    timestamp TEXT
+);"""
+
+SQL_CREATE_WAYS_TAGS_TABLE = """CREATE TABLE IF NOT EXISTS ways_tags (
+    id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    type TEXT,
+    FOREIGN KEY (id) REFERENCES ways(id)
+);"""
+
+SQL_CREATE_WAYS_NODES_TABLE = """CREATE TABLE IF NOT EXISTS ways_nodes (
+    id INTEGER NOT NULL,
+    node_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    FOREIGN KEY (id) REFERENCES ways(id),
+    FOREIGN KEY (node_id) REFERENCES nodes(id)
+);"""
+
+# Insert statements in the same column order as data.*_FIELDS
+SQL_INSERT = {
+    'nodes': "INSERT INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+    'nodes_tags': "INSERT INTO nodes_tags VALUES (?, ?, ?, ?)",
+    'ways': "INSERT INTO ways VALUES (?, ?, ?, ?, ?, ?)",
+    'ways_tags': "INSERT INTO ways_tags VALUES (?, ?, ?, ?)",
+    'ways_nodes': "INSERT INTO ways_nodes VALUES (?, ?, ?)",
+}
+
+
+def create_connection(db_file):
+    """ create a database connection to the SQLite database
+        specified by db_file
+    :param db_file: database file
+    :return: Connection object or None
+    """
+    conn = None
+    try:
+        conn = sqlite3.connect(db_file)
+        return conn
+    except Error as e:
+        print(e)
+
+    return conn
+
+
+def create_table(conn, create_table_sql):
+    """ create a table from the create_table_sql statement
+    :param conn: Connection object
+    :param create_table_sql: a CREATE TABLE statement
+    :return:
+    """
+    try:
+        c = conn.cursor()
+        c.execute(create_table_sql)
+    except Error as e:
+        print(e)
+
+
+class TableWriter(object):
+    """Write shaped elements to the five tables from main()
+
+    Writers are what load_map drives: create() makes the tables, add() takes one
+    shape_element dict, flush() writes the pending rows and finish() runs once
+    after the last flush.
+    """
+
+    create_sql = [SQL_CREATE_NODES_TABLE, SQL_CREATE_NODES_TAGS_TABLE, SQL_CREATE_WAYS_TABLE,
+                  SQL_CREATE_WAYS_TAGS_TABLE, SQL_CREATE_WAYS_NODES_TABLE]
+    insert_sql = SQL_INSERT
+
+    def __init__(self):
+        self.rows = defaultdict(list)
+
+    @property
+    def pending(self):
+        return sum(len(rows) for rows in self.rows.values())
+
+    def create(self, conn):
+        for sql in self.create_sql:
+            create_table(conn, sql)
+
+    def add(self, el):
+        if 'node' in el:
+            n = el['node']
+            self.rows['nodes'].append((n['id'], n['lat'], n['lon'], n['user'], n['uid'],
+                                       n['version'], n['changeset'], n['timestamp']))
+            self.add_tags('nodes_tags', el['node_tags'])
+        else:
+            w = el['way']
+            self.rows['ways'].append((w['id'], w['user'], w['uid'], w['version'],
+                                      w['changeset'], w['timestamp']))
+            self.add_tags('ways_tags', el['way_tags'])
+            self.rows['ways_nodes'].extend((nd['id'], nd['node_id'], nd['position'])
+                                           for nd in el['way_nodes'])
+
+    def add_tags(self, table, tags):
+        self.rows[table].extend((t['id'], t['key'], t['value'], t['type']) for t in tags)
+
+    def flush(self, conn):
+        for table, rows in self.rows.items():
+            if rows:
+                conn.executemany(self.insert_sql[table], rows)
+        self.rows.clear()
+
+    def finish(self, conn):
+        pass
+
+
+def way_centroids(conn, way_ids):
+    """Return {way id: (lat, lon)} with the mean coordinate of each way's nodes"""
+    centroids = {}
+    for way_id in way_ids:
+        row = conn.execute("""SELECT AVG(n.lat), AVG(n.lon) FROM ways_nodes wn
+                              JOIN nodes n ON n.id = wn.node_id
+                              WHERE wn.id = ?""", (way_id,)).fetchone()
+        if row[0] is not None:
+            centroids[way_id] = row
+    return centroids
+
+
+def load_map(file_in=OSM_PATH, db_file=DB_PATH, writers=None, validate=False,
+             batch_size=BATCH_SIZE):
+    """Stream file_in into db_file through the given writers (default: TableWriter)"""
+    if writers is None:
+        writers = [TableWriter()]
+
+    conn = create_connection(db_file)
+    if conn is None:
+        print("Error! cannot create the database connection.")
+        return None
+
+    for writer in writers:
+        writer.create(conn)
+
+    for el in iter_shaped(file_in, validate):
+        for writer in writers:
+            writer.add(el)
+            if writer.pending >= batch_size:
+                writer.flush(conn)
+
+    for writer in writers:
+        writer.flush(conn)
+        writer.finish(conn)
+    conn.commit()
+    return conn
+
+
+def main():
+    database = DB_PATH
+
+    # create a database connection
+    conn = create_connection(database)
+
+    # create tables
+    if conn is not None:
+        TableWriter().create(conn)
+    else:
+        print("Error! cannot create the database connection.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""
+Diff two OSM extracts into an osmChange file.
+
+When a new WPM.osm arrives, diff_extracts compares it with the previous one
+without loading either into a database:
+
+    1. each file is read as a stream of (type, id)-ordered records. OSM files
+       are normally written in that order, which a quick regex pass over the
+       start tags checks (is_sorted); a file that is not gets sorted through
+       sorted_output.ExternalSorter runs instead
+    2. the two streams are merge-compared: an id only in the new file is a
+       create, only in the old file a delete, and in both a modify if the
+       version, coordinates, tags, node refs or members differ
+    3. the changes are written as they are found, as osmChange
+       <create>/<modify>/<delete> blocks
+
+Memory is one record per input (plus the sorter's bounded runs), whatever the
+size of the files.
+
+Usage:
+    counts = diff_extracts("WPM_old.osm", "WPM.osm", "WPM.osc")
+    # {'create': ..., 'modify': ..., 'delete': ...}
+"""
+
+import mmap
+import xml.etree.cElementTree as ET
+
+from data import get_element
+from element_index import ID_RE, START_TAG_RE
+from sorted_output import RUN_SIZE, ExternalSorter
+
+# Order of the element types in an OSM file
+TYPE_RANK = {'node': 0, 'way': 1, 'relation': 2}
+
+CHANGE_KINDS = ('create', 'modify', 'delete')
+
+
+def is_sorted(osm_file):
+    """True if the elements of osm_file are in (type, id) order"""
+    last = (-1, 0)
+    with open(osm_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for m in START_TAG_RE.finditer(mm):
+            key = (TYPE_RANK[m.group(1).decode()], int(ID_RE.search(m.group(2)).group(1)))
+            if key <= last:
+                return False
+            last = key
+    return True
+
+
+def signature(element):
+    """What has to match for two versions of an element to count as unchanged"""
+    attrib = element.attrib
+    return (attrib.get('lat'), attrib.get('lon'),
+            tuple(sorted((t.attrib['k'], t.attrib['v']) for t in element.iter('tag'))),
+            tuple(nd.attrib['ref'] for nd in element.iter('nd')),
+            tuple((m.attrib['type'], m.attrib['ref'], m.attrib.get('role', ''))
+                  for m in element.iter('member')))
+
+
+def record(element):
+    """(type rank, id, version, signature, xml) of a parsed element"""
+    element.tail = None
+    return (TYPE_RANK[element.tag], int(element.attrib['id']), element.attrib.get('version'),
+            signature(element), ET.tostring(element, encoding='unicode'))
+
+
+def record_key(r):
+    return r[0], r[1]
+
+
+def sorted_records(osm_file, run_size=RUN_SIZE):
+    """Records of osm_file in (type, id) order"""
+    elements = get_element(osm_file, tags=tuple(TYPE_RANK))
+    if is_sorted(osm_file):
+        for element in elements:
+            yield record(element)
+        return
+    sorter = ExternalSorter(record_key, run_size)
+    try:
+        for element in elements:
+            sorter.add(record(element))
+        yield from sorter
+    finally:
+        sorter.close()
+
+
+def compare(old, new):
+    """Yield (kind, record) for every difference between two sorted record streams"""
+    a, b = next(old, None), next(new, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and record_key(a) < record_key(b)):
+            yield 'delete', a
+            a = next(old, None)
+        elif a is None or record_key(b) < record_key(a):
+            yield 'create', b
+            b = next(new, None)
+        else:
+            if a[2] != b[2] or a[3] != b[3]:
+                yield 'modify', b
+            a, b = next(old, None), next(new, None)
+
+
+class OsmChangeWriter(object):
+    """Write changes as osmChange, one block per run of changes of the same kind"""
+
+    def __init__(self, f):
+        self.f = f
+        self.kind = None
+        self.counts = {kind: 0 for kind in CHANGE_KINDS}
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<osmChange version="0.6" generator="diff_extracts.py">\n')
+
+    def write(self, kind, xml):
+        if kind != self.kind:
+            if self.kind is not None:
+                self.f.write('</{}>\n'.format(self.kind))
+            self.f.write('<{}>\n'.format(kind))
+            self.kind = kind
+        self.f.write('  ' + xml.strip() + '\n')
+        self.counts[kind] += 1
+
+    def close(self):
+        if self.kind is not None:
+            self.f.write('</{}>\n'.format(self.kind))
+        self.f.write('</osmChange>\n')
+
+
+def diff_extracts(old_file, new_file, change_file, run_size=RUN_SIZE):
+    """Write the osmChange from old_file to new_file; return the counts per kind"""
+    with open(change_file, 'w', encoding='utf-8') as f:
+        writer = OsmChangeWriter(f)
+        for kind, r in compare(sorted_records(old_file, run_size),
+                               sorted_records(new_file, run_size)):
+            writer.write(kind, r[4])
+        writer.close()
+    return writer.counts
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) != 4:
+        print("usage: diff_extracts.py OLD.osm NEW.osm OUT.osc")
+        sys.exit(1)
+    print(diff_extracts(*sys.argv[1:]))
@@ -0,0 +1,245 @@
+"""
+Find POIs that were mapped more than once.
+
+The cuisine pie chart has two coffee-shop slices and the amenity counts do not
+match the cuisine counts; a common cause is the same business mapped twice,
+often once as a node and once as a building way. find_duplicates:
+
+    1. loads every node and way centroid with a name, amenity or cuisine
+    2. hashes them into a grid of cells max_distance wide, so two POIs closer
+       than max_distance are always in the same or neighbouring cells
+    3. pairs each POI with the ones in its own cell and four of its eight
+       neighbours (the other four pairs are found from the other side), drops
+       the pairs farther apart than max_distance, all with NumPy arrays
+    4. scores the surviving pairs on normalized name, amenity and cuisine, and
+       joins pairs above min_score into clusters
+
+Only nearby pairs are ever compared, never all pairs. build_duplicates stores
+the clusters in WPM.db:
+
+    poi_duplicates(cluster, element_type, id, name, confidence)
+
+Usage:
+    for cluster in find_duplicates(conn):
+        print(cluster['confidence'], cluster['members'])
+    build_duplicates(conn)
+"""
+
+import re
+from difflib import SequenceMatcher
+
+import numpy as np
+
+from database import DB_PATH, create_connection, create_table
+from nearby import METERS_PER_DEGREE, haversine
+
+MAX_DISTANCE = 75.0   # meters
+MIN_SCORE = 0.6
+
+# Cell offsets (row, col) that cover each neighbouring pair exactly once
+HALF_NEIGHBOURHOOD = ((0, 0), (0, 1), (1, -1), (1, 0), (1, 1))
+
+# Different spellings of the same cuisine/amenity value
+SYNONYMS = {
+    'coffee': 'coffee_shop',
+    'cafe': 'coffee_shop',
+    'pizzeria': 'pizza',
+    'fastfood': 'fast_food',
+}
+
+SQL_CREATE_POI_DUPLICATES_TABLE = """CREATE TABLE IF NOT EXISTS poi_duplicates (
+    cluster INTEGER NOT NULL,
+    element_type TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    name TEXT,
+    confidence FLOAT NOT NULL,
+    PRIMARY KEY (cluster, element_type, id)
+);"""
+
+SQL_POI_ATTRIBUTES = """SELECT id,
+        MAX(CASE WHEN key = 'name' AND type = 'regular' THEN value END) AS name,
+        MAX(CASE WHEN key = 'amenity' AND type = 'regular' THEN value END) AS amenity,
+        MAX(CASE WHEN key = 'cuisine' AND type = 'regular' THEN value END) AS cuisine
+    FROM {table}
+    WHERE key IN ('name', 'amenity', 'cuisine') AND type = 'regular'
+    GROUP BY id"""
+
+SQL_NODE_POIS = """SELECT t.id, n.lat, n.lon, t.name, t.amenity, t.cuisine
+    FROM ({}) t
+    JOIN nodes n ON n.id = t.id"""
+
+SQL_WAY_POIS = """SELECT t.id, AVG(n.lat), AVG(n.lon), t.name, t.amenity, t.cuisine
+    FROM ({}) t
+    JOIN ways_nodes wn ON wn.id = t.id
+    JOIN nodes n ON n.id = wn.node_id
+    GROUP BY t.id"""
+
+NON_ALNUM = re.compile(r'[^a-z0-9 ]+')
+SPACES = re.compile(r'\s+')
+
+
+def normalize_name(name):
+    """Lower case, '&' as 'and', punctuation dropped, whitespace collapsed"""
+    if not name:
+        return ''
+    name = NON_ALNUM.sub(' ', name.lower().replace('&', ' and ').replace("'", ''))
+    return SPACES.sub(' ', name).strip()
+
+
+def normalize_values(value):
+    """Set of the ;-separated values of a tag, lower case, with SYNONYMS applied"""
+    if not value:
+        return frozenset()
+    parts = (v.strip().lower().replace(' ', '_') for v in value.split(';'))
+    return frozenset(SYNONYMS.get(v, v) for v in parts if v)
+
+
+def load_pois(conn):
+    """Column arrays of every node/way with a name, amenity or cuisine"""
+    rows = []
+    for element_type, table, sql in (('node', 'nodes_tags', SQL_NODE_POIS),
+                                     ('way', 'ways_tags', SQL_WAY_POIS)):
+        for element_id, lat, lon, name, amenity, cuisine in conn.execute(
+                sql.format(SQL_POI_ATTRIBUTES.format(table=table))):
+            rows.append((element_type, element_id, lat, lon, name, amenity, cuisine))
+    return {
+        'element_type': [r[0] for r in rows],
+        'id': np.array([r[1] for r in rows], dtype=np.int64),
+        'lat': np.array([r[2] for r in rows], dtype=np.float64),
+        'lon': np.array([r[3] for r in rows], dtype=np.float64),
+        'name': [r[4] for r in rows],
+        'names': [normalize_name(r[4]) for r in rows],
+        'amenities': [normalize_values(r[5]) for r in rows],
+        'cuisines': [normalize_values(r[6]) for r in rows],
+    }
+
+
+def candidate_pairs(lats, lons, max_distance=MAX_DISTANCE):
+    """(i, j, meters) of every pair of points closer than max_distance"""
+    if len(lats) < 2:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, np.empty(0)
+    # Square cells max_distance wide: longitude degrees shrink with latitude
+    cell_lat = max_distance / METERS_PER_DEGREE
+    cell_lon = cell_lat / max(np.cos(np.radians(np.abs(lats).max())), 1e-6)
+    rows = np.floor(lats / cell_lat).astype(np.int64)
+    cols = np.floor(lons / cell_lon).astype(np.int64)
+    width = cols.max() - cols.min() + 3
+    keys = (rows - rows.min() + 1) * width + (cols - cols.min() + 1)
+
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+
+    pairs_i, pairs_j = [], []
+    for d_row, d_col in HALF_NEIGHBOURHOOD:
+        target = sorted_keys + d_row * width + d_col
+        lo = np.searchsorted(sorted_keys, target, 'left')
+        hi = np.searchsorted(sorted_keys, target, 'right')
+        if (d_row, d_col) == (0, 0):
+            # Same cell: only the points after this one
+            lo = np.maximum(lo, np.arange(len(sorted_keys)) + 1)
+        counts = np.maximum(hi - lo, 0)
+        i = np.repeat(np.arange(len(sorted_keys)), counts)
+        j = lo[i] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        pairs_i.append(order[i])
+        pairs_j.append(order[j])
+
+    i, j = np.concatenate(pairs_i), np.concatenate(pairs_j)
+    meters = haversine(lats[i], lons[i], lats[j], lons[j])
+    close = meters <= max_distance
+    return i[close], j[close], meters[close]
+
+
+def pair_score(pois, i, j, meters, max_distance=MAX_DISTANCE):
+    """Confidence in [0, 1] that POIs i and j are the same thing"""
+    name_i, name_j = pois['names'][i], pois['names'][j]
+    amenity_i, amenity_j = pois['amenities'][i], pois['amenities'][j]
+    cuisine_i, cuisine_j = pois['cuisines'][i], pois['cuisines'][j]
+
+    if name_i and name_j:
+        name = SequenceMatcher(None, name_i, name_j).ratio()
+        if name < 0.75:
+            return 0.0
+    elif (name_i or name_j) and amenity_i & amenity_j:
+        # One side unnamed: only a shared amenity can link them
+        name = 0.5
+    else:
+        return 0.0
+
+    if amenity_i and amenity_j:
+        amenity = 1.0 if amenity_i & amenity_j else 0.0
+    else:
+        amenity = 0.5
+    if cuisine_i and cuisine_j:
+        cuisine = len(cuisine_i & cuisine_j) / len(cuisine_i | cuisine_j)
+    else:
+        cuisine = 0.5
+    closeness = 1.0 - meters / max_distance
+    return 0.55 * name + 0.2 * amenity + 0.1 * cuisine + 0.15 * closeness
+
+
+def clusters_of(n, pairs):
+    """Union-find over (i, j, score) pairs; return {root: (sorted members, pair scores)}"""
+    parent = list(range(n))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for i, j, _ in pairs:
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+
+    clusters = {}
+    for i, j, score in pairs:
+        members, scores = clusters.setdefault(find(i), (set(), []))
+        members.update((i, j))
+        scores.append(score)
+    return {root: (sorted(members), scores) for root, (members, scores) in clusters.items()}
+
+
+def find_duplicates(conn, max_distance=MAX_DISTANCE, min_score=MIN_SCORE):
+    """Clusters of probable duplicate POIs, most confident first
+
+    :return: list of {'confidence': float, 'members': [(element_type, id, name), ...]}
+    """
+    pois = load_pois(conn)
+    i, j, meters = candidate_pairs(pois['lat'], pois['lon'], max_distance)
+    pairs = []
+    for a, b, d in zip(i.tolist(), j.tolist(), meters.tolist()):
+        score = pair_score(pois, a, b, d, max_distance)
+        if score >= min_score:
+            pairs.append((a, b, score))
+
+    result = []
+    for members, scores in clusters_of(len(pois['id']), pairs).values():
+        result.append({
+            # A cluster is only as believable as its weakest link
+            'confidence': round(min(scores), 3),
+            'members': [(pois['element_type'][m], int(pois['id'][m]), pois['name'][m])
+                        for m in members],
+        })
+    result.sort(key=lambda c: -c['confidence'])
+    return result
+
+
+def build_duplicates(conn, max_distance=MAX_DISTANCE, min_score=MIN_SCORE):
+    """(Re)build poi_duplicates; return the number of clusters"""
+    conn.execute("DROP TABLE IF EXISTS poi_duplicates")
+    create_table(conn, SQL_CREATE_POI_DUPLICATES_TABLE)
+    clusters = find_duplicates(conn, max_distance, min_score)
+    conn.executemany("INSERT INTO poi_duplicates VALUES (?, ?, ?, ?, ?)",
+                     ((n, element_type, element_id, name, cluster['confidence'])
+                      for n, cluster in enumerate(clusters)
+                      for element_type, element_id, name in cluster['members']))
+    conn.commit()
+    return len(clusters)
+
+
+if __name__ == '__main__':
+    conn = create_connection(DB_PATH)
+    for cluster in find_duplicates(conn)[:20]:
+        print(cluster['confidence'], cluster['members'])
@@ -0,0 +1,160 @@
+"""
+Byte-offset index for random access into the raw OSM XML file.
+
+The only ways to look at one element were streaming the whole file through
+get_element or ET.parse(...).getroot() in find_element. build_element_index
+scans the file once and records, for every node, way and relation, the byte
+offset and length of its XML. The index is kept as sorted NumPy arrays in a
+side file (WPM.osm.idx.npz) and lookups mmap the OSM file and parse only that
+one fragment.
+
+Usage:
+    index = ElementIndex.open("WPM.osm")      # builds the side file if missing/stale
+    node = index.find('node', 65602865)       # xml.etree Element, or None
+    index.raw('way', 209809850)               # the element's XML bytes
+"""
+
+import mmap
+import os
+import re
+import xml.etree.cElementTree as ET
+
+import numpy as np
+
+from data import OSM_PATH
+
+ELEMENT_TYPES = ('node', 'way', 'relation')
+
+# Whole start tag of a top-level element; group 3 is '/' when it is self-closing
+# (attribute values may contain a raw '>', so quoted strings are skipped whole)
+START_TAG_RE = re.compile(rb'<(node|way|relation)\b((?:[^>"\']|"[^"]*"|\'[^\']*\')*?)(/?)>')
+ID_RE = re.compile(rb'\sid="(-?\d+)"')
+
+
+def index_path(osm_file):
+    return osm_file + ".idx.npz"
+
+
+def scan_offsets(osm_file):
+    """One pass over osm_file; return {type: (ids, offsets, lengths)} sorted by id"""
+    found = {t: ([], [], []) for t in ELEMENT_TYPES}
+    with open(osm_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos = 0
+        while True:
+            m = START_TAG_RE.search(mm, pos)
+            if m is None:
+                break
+            element_type = m.group(1).decode()
+            start = m.start()
+            if m.group(3):
+                end = m.end()
+            else:
+                close = b'</' + m.group(1) + b'>'
+                end = mm.find(close, m.end())
+                if end < 0:
+                    raise ValueError("Unclosed <{}> at byte {}".format(element_type, start))
+                end += len(close)
+
+            ids, offsets, lengths = found[element_type]
+            ids.append(int(ID_RE.search(m.group(2)).group(1)))
+            offsets.append(start)
+            lengths.append(end - start)
+            pos = end
+
+    arrays = {}
+    for element_type, (ids, offsets, lengths) in found.items():
+        ids = np.array(ids, dtype=np.int64)
+        order = np.argsort(ids, kind='stable')
+        arrays[element_type] = (ids[order],
+                                np.array(offsets, dtype=np.int64)[order],
+                                np.array(lengths, dtype=np.int64)[order])
+    return arrays
+
+
+def build_element_index(osm_file=OSM_PATH):
+    """Scan osm_file and write its side index; return the arrays"""
+    arrays = scan_offsets(osm_file)
+    stat = os.stat(osm_file)
+    columns = {'source': np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)}
+    for element_type, (ids, offsets, lengths) in arrays.items():
+        columns[element_type + '_ids'] = ids
+        columns[element_type + '_offsets'] = offsets
+        columns[element_type + '_lengths'] = lengths
+    with open(index_path(osm_file), 'wb') as f:
+        np.savez(f, **columns)
+    return arrays
+
+
+def load_element_index(osm_file=OSM_PATH):
+    """Arrays from the side index, or None if it is missing or older than osm_file"""
+    path = index_path(osm_file)
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(osm_file)
+    with np.load(path) as columns:
+        if list(columns['source']) != [stat.st_size, stat.st_mtime_ns]:
+            return None
+        return {t: (columns[t + '_ids'], columns[t + '_offsets'], columns[t + '_lengths'])
+                for t in ELEMENT_TYPES}
+
+
+class ElementIndex(object):
+    """mmap-backed lookups of single elements by type and id"""
+
+    def __init__(self, osm_file, arrays):
+        self.osm_file = osm_file
+        self.arrays = arrays
+        self.file = open(osm_file, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @classmethod
+    def open(cls, osm_file=OSM_PATH):
+        arrays = load_element_index(osm_file)
+        if arrays is None:
+            arrays = build_element_index(osm_file)
+        return cls(osm_file, arrays)
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return sum(len(ids) for ids, _, _ in self.arrays.values())
+
+    def locate(self, element_type, element_id):
+        """(offset, length) of the element, or None"""
+        ids, offsets, lengths = self.arrays[element_type]
+        i = np.searchsorted(ids, element_id)
+        if i < len(ids) and ids[i] == element_id:
+            return int(offsets[i]), int(lengths[i])
+        return None
+
+    def raw(self, element_type, element_id):
+        """The element's XML bytes, or None"""
+        found = self.locate(element_type, element_id)
+        if found is None:
+            return None
+        offset, length = found
+        return self.mm[offset:offset + length]
+
+    def find(self, element_type, element_id):
+        """The element parsed into an xml.etree Element, or None"""
+        fragment = self.raw(element_type, element_id)
+        return None if fragment is None else ET.fromstring(fragment)
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+
+    start = time.perf_counter()
+    with ElementIndex.open(OSM_PATH) as index:
+        print("Indexed {} elements in {:.2f} s".format(len(index), time.perf_counter() - start))
+        if len(sys.argv) > 2:
+            ET.dump(index.find(sys.argv[1], int(sys.argv[2])))
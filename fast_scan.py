@@ -0,0 +1,91 @@
+"""
+Fast-scan tag statistics straight from the bytes of the OSM file.
+
+count_tags, process_keys_map and process_users_map build a full Element for
+everything in the file just to count tag names, classify k attributes and
+collect user names. fast_stats memory-maps the file and runs compiled byte
+regexes over it instead, with the file cut (at top-level element starts, as in
+audits.py) into ranges that are scanned in a process pool. The Python re
+module holds the GIL, so processes rather than threads.
+
+The results have the same shape as the 'tags', 'key_types' and 'users' results
+of audits.audit_file, and for well-formed OSM files the same values.
+
+Usage:
+    stats = fast_stats("WPM.osm")
+    stats['tags']        # {'osm': 1, 'node': ..., 'tag': ..., ...}
+    stats['key_types']   # {'lower': ..., 'lower_colon': ..., ...}
+    stats['users']       # set of user names
+"""
+
+import mmap
+import os
+import re
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from xml.sax.saxutils import unescape
+
+from audits import KeyTypes, key_type, shard_offsets
+from data import OSM_PATH
+
+# Any start tag (not </..., <?... or <!...)
+START_TAG_RE = re.compile(rb'<([A-Za-z_][\w:.-]*)')
+# k attribute of a <tag>, wherever it is in the attribute list
+TAG_K_RE = re.compile(rb'<tag\b[^>]*?\sk="([^"]*)"')
+USER_RE = re.compile(rb'\suser="([^"]*)"')
+
+XML_ENTITIES = {'&quot;': '"', '&apos;': "'"}
+
+
+def decode(value):
+    """Attribute bytes to the string an XML parser would return"""
+    return unescape(value.decode('utf-8'), XML_ENTITIES)
+
+
+def scan_range(filename, start, end):
+    """Raw counts for filename[start:end]: (tag names, tag k values, user names)"""
+    with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        tags = Counter(START_TAG_RE.findall(mm, start, end))
+        keys = Counter(TAG_K_RE.findall(mm, start, end))
+        users = set(USER_RE.findall(mm, start, end))
+    return tags, keys, users
+
+
+def fast_stats(filename=OSM_PATH, processes=None, shards=None):
+    """Tag name counts, k classification and user names of filename"""
+    processes = processes or os.cpu_count() or 1
+    offsets = shard_offsets(filename, shards or processes * 4)
+    starts, ends = offsets[:-1], offsets[1:]
+
+    if processes == 1 or len(starts) == 1:
+        partials = [scan_range(filename, s, e) for s, e in zip(starts, ends)]
+    else:
+        with ProcessPoolExecutor(processes) as pool:
+            partials = list(pool.map(scan_range, [filename] * len(starts), starts, ends))
+
+    tags, keys, users = Counter(), Counter(), set()
+    for t, k, u in partials:
+        tags.update(t)
+        keys.update(k)
+        users |= u
+
+    # Classify each distinct key once and weight it by how often it occurs
+    key_types = KeyTypes().init()
+    for k, count in keys.items():
+        key_types[key_type(decode(k))] += count
+
+    return {'tags': {t.decode(): n for t, n in tags.items()},
+            'key_types': key_types,
+            'users': {decode(u) for u in users}}
+
+
+if __name__ == '__main__':
+    import pprint
+    import time
+
+    start = time.perf_counter()
+    stats = fast_stats(OSM_PATH)
+    print("Scanned in {:.2f} s".format(time.perf_counter() - start))
+    pprint.pprint(stats['tags'])
+    pprint.pprint(stats['key_types'])
+    print(len(stats['users']))
@@ -0,0 +1,249 @@
+"""
+Wide `features` table: one row per node and way, one column per common tag.
+
+Every report query digs through the long nodes_tags / ways_tags tables, often
+with a self-join (religions joins nodes_tags to a DISTINCT(id) subquery on
+value='place_of_worship'). build_features pivots the most used keys into
+
+    features(element_type, id, lat, lon, name, amenity, cuisine, religion,
+             addr_street, highway, building, ...)
+
+with an index on every tag column, so those queries become single-table
+indexed scans (see FEATURE_QUERIES). The columns are FEATURE_KEYS plus the most
+frequent other keys in the data (choose_keys); features_columns maps each
+column back to its OSM key. lat/lon are the node's coordinate (NULL for ways).
+
+Triggers on the plain nodes, ways and tag tables keep the table in sync when
+rows are inserted, updated or deleted later. The triggers need the tables; for
+the dictionary and compact layouts, where some of them are views, rerun
+build_features after changing the data.
+
+Usage:
+    load_map("WPM.osm", "WPM.db", writers=[TableWriter(), FeaturesWriter()])
+    build_features(conn)            # or on an existing database
+    conn.execute(FEATURE_QUERIES['religions']).fetchall()
+"""
+
+import re
+
+from database import DB_PATH, create_connection, create_table
+from nearby import IGNORED_KEYS
+
+# Always pivoted, in this column order
+FEATURE_KEYS = ['name', 'amenity', 'cuisine', 'religion', 'addr:street', 'highway', 'building']
+
+# Extra columns picked by frequency
+EXTRA_KEYS = 5
+
+RESERVED_COLUMNS = ('element_type', 'id', 'lat', 'lon')
+
+SQL_CREATE_FEATURES_COLUMNS_TABLE = """CREATE TABLE IF NOT EXISTS features_columns (
+    name TEXT PRIMARY KEY NOT NULL,
+    key TEXT NOT NULL,
+    position INTEGER NOT NULL
+);"""
+
+SQL_KEY_FREQUENCY = """SELECT CASE WHEN type = 'regular' THEN key ELSE type || ':' || key END AS k,
+        COUNT(*) AS n
+    FROM (SELECT key, type FROM nodes_tags UNION ALL SELECT key, type FROM ways_tags)
+    GROUP BY k
+    ORDER BY n DESC"""
+
+FEATURE_QUERIES = {
+    'amenities': """SELECT amenity, COUNT(*) AS count FROM features
+        WHERE amenity IS NOT NULL
+        GROUP BY amenity ORDER BY count DESC LIMIT 20;""",
+    'religions': """SELECT religion, COUNT(*) AS num FROM features
+        WHERE element_type = 'node' AND amenity = 'place_of_worship' AND religion IS NOT NULL
+        GROUP BY religion ORDER BY num DESC;""",
+    'cuisines': """SELECT cuisine, COUNT(*) AS count FROM features
+        WHERE cuisine IS NOT NULL
+        GROUP BY cuisine ORDER BY count DESC LIMIT 10;""",
+    'cuisine_total': "SELECT COUNT(cuisine) FROM features;",
+}
+
+
+def column_name(key):
+    """SQL column for an OSM key: 'addr:street' -> 'addr_street'"""
+    return re.sub(r'\W', '_', key.lower())
+
+
+def split_key(key):
+    """(key, type) as stored in the tag tables"""
+    if ':' in key:
+        tag_type, rest = key.split(':', 1)
+        return rest, tag_type
+    return key, 'regular'
+
+
+def quote(s):
+    return "'" + s.replace("'", "''") + "'"
+
+
+def choose_keys(conn, extra=EXTRA_KEYS, always=FEATURE_KEYS):
+    """always plus the extra most frequent keys whose column names are free"""
+    keys = list(always)
+    columns = set(RESERVED_COLUMNS) | {column_name(k) for k in keys}
+    for key, _ in conn.execute(SQL_KEY_FREQUENCY):
+        if len(keys) >= len(always) + extra:
+            break
+        name = column_name(key)
+        if key in keys or key in IGNORED_KEYS or name in columns or not name.isidentifier():
+            continue
+        keys.append(key)
+        columns.add(name)
+    return keys
+
+
+def value_expr(table, key, id_expr):
+    """Scalar subquery: the value of key on element id_expr in table"""
+    k, tag_type = split_key(key)
+    return "(SELECT MAX(value) FROM {} WHERE id = {} AND key = {} AND type = {})".format(
+        table, id_expr, quote(k), quote(tag_type))
+
+
+def pivot_sql(element_type, keys):
+    """INSERT ... SELECT that fills features for one element type in one pass"""
+    table, tags = ('nodes', 'nodes_tags') if element_type == 'node' else ('ways', 'ways_tags')
+    coords = 'e.lat, e.lon' if element_type == 'node' else 'NULL, NULL'
+    pivots = []
+    for key in keys:
+        k, tag_type = split_key(key)
+        pivots.append("MAX(CASE WHEN t.key = {} AND t.type = {} THEN t.value END)".format(
+            quote(k), quote(tag_type)))
+    return """INSERT INTO features
+        SELECT '{element_type}', e.id, {coords}, {pivots}
+        FROM {table} e
+        LEFT JOIN {tags} t ON t.id = e.id
+        GROUP BY e.id""".format(element_type=element_type, coords=coords,
+                                pivots=', '.join(pivots), table=table, tags=tags)
+
+
+def trigger_sql(element_type, keys):
+    """Triggers that keep the features rows of element_type in sync"""
+    table, tags = ('nodes', 'nodes_tags') if element_type == 'node' else ('ways', 'ways_tags')
+    columns = [column_name(k) for k in keys]
+    key_names = ', '.join(quote(k) for k in sorted({split_key(k)[0] for k in keys}))
+
+    def refresh(id_expr):
+        sets = ', '.join('{} = {}'.format(c, value_expr(tags, k, id_expr))
+                         for c, k in zip(columns, keys))
+        return "UPDATE features SET {} WHERE element_type = '{}' AND id = {};".format(
+            sets, element_type, id_expr)
+
+    coords = 'NEW.lat, NEW.lon' if element_type == 'node' else 'NULL, NULL'
+    prefix = 'features_' + table
+    return [
+        """CREATE TRIGGER {p}_insert AFTER INSERT ON {table} BEGIN
+            INSERT OR REPLACE INTO features (element_type, id, lat, lon)
+            VALUES ('{et}', NEW.id, {coords});
+            {refresh}
+        END;""".format(p=prefix, table=table, et=element_type, coords=coords,
+                       refresh=refresh('NEW.id')),
+        """CREATE TRIGGER {p}_delete AFTER DELETE ON {table} BEGIN
+            DELETE FROM features WHERE element_type = '{et}' AND id = OLD.id;
+        END;""".format(p=prefix, table=table, et=element_type),
+        """CREATE TRIGGER {p}_update AFTER UPDATE ON {table} BEGIN
+            UPDATE features SET id = NEW.id{coord_sets}
+            WHERE element_type = '{et}' AND id = OLD.id;
+        END;""".format(p=prefix, table=table, et=element_type,
+                       coord_sets=', lat = NEW.lat, lon = NEW.lon' if element_type == 'node' else ''),
+        """CREATE TRIGGER {p}_tags_insert AFTER INSERT ON {tags}
+            WHEN NEW.key IN ({keys}) BEGIN
+            {refresh}
+        END;""".format(p=prefix, tags=tags, keys=key_names, refresh=refresh('NEW.id')),
+        """CREATE TRIGGER {p}_tags_delete AFTER DELETE ON {tags}
+            WHEN OLD.key IN ({keys}) BEGIN
+            {refresh}
+        END;""".format(p=prefix, tags=tags, keys=key_names, refresh=refresh('OLD.id')),
+        """CREATE TRIGGER {p}_tags_update AFTER UPDATE ON {tags}
+            WHEN OLD.key IN ({keys}) OR NEW.key IN ({keys}) BEGIN
+            {refresh_old}
+            {refresh_new}
+        END;""".format(p=prefix, tags=tags, keys=key_names, refresh_old=refresh('OLD.id'),
+                       refresh_new=refresh('NEW.id')),
+    ]
+
+
+def is_table(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                        (name,)).fetchone() is not None
+
+
+def drop_features(conn):
+    for (trigger,) in conn.execute("""SELECT name FROM sqlite_master
+                                      WHERE type = 'trigger' AND name LIKE 'features\\_%' ESCAPE '\\'
+                                      """).fetchall():
+        conn.execute("DROP TRIGGER {}".format(trigger))
+    conn.execute("DROP TABLE IF EXISTS features")
+    conn.execute("DROP TABLE IF EXISTS features_columns")
+
+
+def build_features(conn, keys=None):
+    """(Re)build features and its triggers; return the pivoted keys"""
+    if keys is None:
+        keys = choose_keys(conn)
+    drop_features(conn)
+
+    columns = [column_name(k) for k in keys]
+    create_table(conn, """CREATE TABLE IF NOT EXISTS features (
+    element_type TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    lat FLOAT,
+    lon FLOAT,
+    {},
+    PRIMARY KEY (element_type, id)
+) WITHOUT ROWID;""".format(',\n    '.join('{} TEXT'.format(c) for c in columns)))
+    create_table(conn, SQL_CREATE_FEATURES_COLUMNS_TABLE)
+    conn.executemany("INSERT INTO features_columns VALUES (?, ?, ?)",
+                     ((c, k, i) for i, (c, k) in enumerate(zip(columns, keys))))
+
+    conn.execute(pivot_sql('node', keys))
+    conn.execute(pivot_sql('way', keys))
+    for c in columns:
+        create_table(conn, "CREATE INDEX IF NOT EXISTS features_{0} ON features ({0});".format(c))
+
+    for element_type, names in (('node', ('nodes', 'nodes_tags')), ('way', ('ways', 'ways_tags'))):
+        if all(is_table(conn, name) for name in names):
+            for sql in trigger_sql(element_type, keys):
+                conn.execute(sql)
+    conn.commit()
+    return keys
+
+
+class FeaturesWriter(object):
+    """load_map writer that builds features once the other writers are done
+
+    The pivot is one set-based INSERT ... SELECT per element type, which is much
+    faster than maintaining the rows element by element during the stream.
+    List it after the writer that creates the tables.
+    """
+
+    def __init__(self, keys=None):
+        self.keys = keys
+
+    @property
+    def pending(self):
+        return 0
+
+    def create(self, conn):
+        pass
+
+    def add(self, el):
+        pass
+
+    def flush(self, conn):
+        pass
+
+    def finish(self, conn):
+        self.keys = build_features(conn, self.keys)
+
+
+if __name__ == '__main__':
+    import pprint
+
+    conn = create_connection(DB_PATH)
+    print("features columns: {}".format(build_features(conn)))
+    for name, sql in FEATURE_QUERIES.items():
+        print(name)
+        pprint.pprint(conn.execute(sql).fetchall())
@@ -0,0 +1,167 @@
+"""
+Workload-driven index builder for WPM.db.
+
+main() creates the five tables without secondary indexes, so every report
+query is a full table scan. build_indexes runs EXPLAIN QUERY PLAN over the
+report queries, creates the candidate indexes for each table that one of the
+plans scans, runs ANALYZE and prints the before/after plans and timings.
+
+Run it once after the bulk load; building the indexes on a loaded table is much
+faster than maintaining them row by row during the load.
+"""
+
+import re
+import time
+
+from database import DB_PATH, create_connection
+from queries import REPORT_QUERIES
+
+# Candidate indexes per table. The tag indexes cover the key/value filters and
+# the id join of the report queries without touching the table itself.
+CANDIDATE_INDEXES = {
+    'nodes': [
+        "CREATE INDEX IF NOT EXISTS nodes_uid_idx ON nodes (uid, user)",
+    ],
+    'ways': [
+        "CREATE INDEX IF NOT EXISTS ways_uid_idx ON ways (uid, user)",
+    ],
+    'nodes_tags': [
+        "CREATE INDEX IF NOT EXISTS nodes_tags_key_idx ON nodes_tags (key, value, id)",
+        "CREATE INDEX IF NOT EXISTS nodes_tags_value_idx ON nodes_tags (value, id)",
+        "CREATE INDEX IF NOT EXISTS nodes_tags_id_idx ON nodes_tags (id, key, value)",
+    ],
+    'ways_tags': [
+        "CREATE INDEX IF NOT EXISTS ways_tags_key_idx ON ways_tags (key, value, id)",
+        "CREATE INDEX IF NOT EXISTS ways_tags_id_idx ON ways_tags (id, key, value)",
+    ],
+    'ways_nodes': [
+        "CREATE INDEX IF NOT EXISTS ways_nodes_id_idx ON ways_nodes (id, position)",
+        "CREATE INDEX IF NOT EXISTS ways_nodes_node_idx ON ways_nodes (node_id)",
+    ],
+    # tag_dictionary layout
+    'nodes_tags_enc': [
+        "CREATE INDEX IF NOT EXISTS nodes_tags_enc_key_idx ON nodes_tags_enc (key_id, value_id, id)",
+        "CREATE INDEX IF NOT EXISTS nodes_tags_enc_id_idx ON nodes_tags_enc (id, key_id)",
+    ],
+    'ways_tags_enc': [
+        "CREATE INDEX IF NOT EXISTS ways_tags_enc_key_idx ON ways_tags_enc (key_id, value_id, id)",
+        "CREATE INDEX IF NOT EXISTS ways_tags_enc_id_idx ON ways_tags_enc (id, key_id)",
+    ],
+}
+
+# Tables that are always indexed, whatever the report plans say (ways_nodes is
+# not in the report but every geometry lookup reads it by way id)
+ALWAYS_INDEXED = ('ways_nodes',)
+
+SCAN_RE = re.compile(r'^SCAN (\w+)')
+
+# "FROM table alias" / "JOIN table AS alias" in a query or view definition
+ALIAS_RE = re.compile(r'\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', re.IGNORECASE)
+NOT_ALIASES = {'as', 'on', 'using', 'where', 'join', 'left', 'inner', 'cross', 'natural',
+               'outer', 'group', 'order', 'having', 'limit', 'union', 'except', 'intersect',
+               'window'}
+
+
+def explain(conn, sql):
+    """Return the EXPLAIN QUERY PLAN detail lines for sql"""
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+
+
+def plan_aliases(conn, sql):
+    """Alias -> set of tables it may stand for, from sql and every view definition
+
+    Plans name a scanned table by its alias, and a view flattened into the query
+    shows up under the alias used inside the view (SCAN t for nodes_tags_enc in
+    the tag_dictionary layout).
+    """
+    sources = [sql] + [row[0] for row in
+                       conn.execute("SELECT sql FROM sqlite_master WHERE type='view'")]
+    aliases = {}
+    for text in sources:
+        for table, alias in ALIAS_RE.findall(text):
+            if alias and alias.lower() not in NOT_ALIASES:
+                aliases.setdefault(alias, set()).add(table)
+    return aliases
+
+
+def scanned_tables(plan, aliases=None):
+    """Tables the plan reads with a full scan rather than an index"""
+    aliases = aliases or {}
+    tables = set()
+    for detail in plan:
+        m = SCAN_RE.match(detail)
+        if m and 'USING' not in detail:
+            tables |= aliases.get(m.group(1), {m.group(1)})
+    return tables
+
+
+def time_query(conn, sql, repeat=3):
+    """Best wall-clock time of repeat runs of sql, in seconds"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        conn.execute(sql).fetchall()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def existing_tables(conn):
+    """Names of the real tables (not views) in the database"""
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+
+
+def profile(conn, queries, repeat=3):
+    """Plan and best time for every query, keyed by query name"""
+    return {name: (explain(conn, sql), time_query(conn, sql, repeat))
+            for name, sql in queries.items()}
+
+
+def build_indexes(conn, queries=REPORT_QUERIES, repeat=3):
+    """Create the indexes the query workload needs, ANALYZE, and return the profiles
+
+    :return: (created index statements, profile before, profile after)
+    """
+    before = profile(conn, queries, repeat)
+
+    wanted = set(ALWAYS_INDEXED)
+    for name, (plan, _) in before.items():
+        wanted |= scanned_tables(plan, plan_aliases(conn, queries[name]))
+    wanted &= existing_tables(conn)
+
+    created = []
+    for table in sorted(wanted):
+        for sql in CANDIDATE_INDEXES.get(table, []):
+            conn.execute(sql)
+            created.append(sql)
+    conn.execute("ANALYZE")
+    conn.commit()
+
+    after = profile(conn, queries, repeat)
+    return created, before, after
+
+
+def print_report(created, before, after):
+    print("Created {} indexes:".format(len(created)))
+    for sql in created:
+        print("  " + sql)
+    print()
+    for name in before:
+        plan_before, t_before = before[name]
+        plan_after, t_after = after[name]
+        print("{}: {:.2f} ms -> {:.2f} ms".format(name, t_before * 1000, t_after * 1000))
+        for detail in plan_after:
+            print("    " + detail)
+
+
+def main():
+    conn = create_connection(DB_PATH)
+    if conn is None:
+        print("Error! cannot create the database connection.")
+        return
+    print_report(*build_indexes(conn))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+"""
+Referential-integrity checker for the loaded tables or the csvs.
+
+ways_nodes.node_id REFERENCES nodes(id) is declared but never enforced (SQLite
+foreign keys are off by default and .import skips them), and sampling every
+42nd element leaves dangling references as a matter of course. The checker
+makes one linear pass:
+
+    1. nodes and ways ids go into IdBitmaps (duplicates are reported here)
+    2. ways_nodes, nodes_tags and ways_tags are streamed in batches and every
+       id / node_id is tested against the bitmaps
+
+Memory is the bitmaps (one bit per possible id in each 65536-id block that has
+any ids) plus one batch, whatever the size of the tables. With prune=True the
+offending rows are deleted from the database, or the csvs are rewritten
+without them. Checking works on every table layout; pruning deletes by rowid,
+so it needs real rowid tables (the plain layout), not the views and WITHOUT
+ROWID tables of the dictionary and compact layouts.
+
+Usage:
+    report = check_database(conn)
+    report = check_csvs(".", prune=True)
+"""
+
+import csv
+import os
+
+import numpy as np
+
+from data import (NODES_PATH, NODE_TAGS_PATH, WAYS_PATH, WAY_NODES_PATH, WAY_TAGS_PATH)
+from database import DB_PATH, create_connection
+
+BATCH_SIZE = 100000
+
+# Number of offending ids kept in the report for each problem
+SAMPLE_SIZE = 10
+
+
+class IdBitmap(object):
+    """Set of integer ids as one bitmap per block of 2**16 ids"""
+
+    BLOCK_BITS = 16
+    BLOCK_BYTES = (1 << BLOCK_BITS) // 8
+
+    def __init__(self):
+        self.blocks = {}
+
+    def _split(self, ids):
+        """Block number, offset in the block, byte and bit mask of each id"""
+        ids = np.asarray(ids, dtype=np.int64)
+        low = ids & ((1 << self.BLOCK_BITS) - 1)
+        return ids >> self.BLOCK_BITS, low, low >> 3, (1 << (low & 7)).astype(np.uint8)
+
+    def add(self, ids):
+        """Add ids; return a mask of the ones that were already present (or repeated in ids)"""
+        high, low, byte, bit = self._split(ids)
+        duplicate = np.zeros(len(high), dtype=bool)
+        for h in np.unique(high):
+            sel = np.nonzero(high == h)[0]
+            block = self.blocks.get(int(h))
+            if block is None:
+                block = self.blocks[int(h)] = np.zeros(self.BLOCK_BYTES, dtype=np.uint8)
+            b, m = byte[sel], bit[sel]
+            dup = (block[b] & m) != 0
+            # Repeats inside this batch: every occurrence after the first
+            _, first = np.unique(low[sel], return_index=True)
+            repeated = np.ones(len(sel), dtype=bool)
+            repeated[first] = False
+            duplicate[sel] = dup | repeated
+            np.bitwise_or.at(block, b, m)
+        return duplicate
+
+    def contains(self, ids):
+        """Mask of the ids that are in the bitmap"""
+        high, _, byte, bit = self._split(ids)
+        found = np.zeros(len(high), dtype=bool)
+        for h in np.unique(high):
+            block = self.blocks.get(int(h))
+            if block is not None:
+                sel = np.nonzero(high == h)[0]
+                found[sel] = (block[byte[sel]] & bit[sel]) != 0
+        return found
+
+    def nbytes(self):
+        return len(self.blocks) * self.BLOCK_BYTES
+
+
+# ================================================== #
+#               Sources                              #
+# ================================================== #
+def has_rowid(conn, table):
+    """True if table is a real table with rowids (not a view or WITHOUT ROWID)"""
+    row = conn.execute("SELECT type, sql FROM sqlite_master WHERE name = ?", (table,)).fetchone()
+    return row is not None and row[0] == 'table' and 'WITHOUT ROWID' not in row[1].upper()
+
+
+def table_batches(conn, table, columns, batch_size=BATCH_SIZE, rowids=False):
+    """Yield (row keys, {column: array}) batches of a table
+
+    The keys are rowids with rowids=True, otherwise row numbers in scan order.
+    """
+    selected = (['rowid'] if rowids else []) + list(columns)
+    cursor = conn.execute("SELECT {} FROM {}".format(', '.join(selected), table))
+    start = 0
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        data = np.array(rows, dtype=np.int64).reshape(len(rows), len(selected))
+        if rowids:
+            keys, data = data[:, 0], data[:, 1:]
+        else:
+            keys = np.arange(start, start + len(rows))
+        start += len(rows)
+        yield keys, {c: data[:, i] for i, c in enumerate(columns)}
+
+
+def csv_batches(path, columns, batch_size=BATCH_SIZE):
+    """Yield (row numbers, {column: array}) batches of a csv"""
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.DictReader(f)
+        start = 0
+        while True:
+            rows = [r for _, r in zip(range(batch_size), reader)]
+            if not rows:
+                break
+            numbers = np.arange(start, start + len(rows))
+            start += len(rows)
+            yield numbers, {c: np.array([int(r[c]) for r in rows], dtype=np.int64) for c in columns}
+
+
+# ================================================== #
+#               Checker                              #
+# ================================================== #
+class Report(object):
+    """Counts and sample ids for each problem, plus the rows to prune per table"""
+
+    def __init__(self):
+        self.counts = {}
+        self.samples = {}
+        self.bad_rows = {}
+        self.memory = 0
+
+    def record(self, problem, table, rows, ids):
+        if not len(ids):
+            self.counts.setdefault(problem, 0)
+            return
+        self.counts[problem] = self.counts.get(problem, 0) + len(ids)
+        sample = self.samples.setdefault(problem, [])
+        sample.extend(int(i) for i in ids[:SAMPLE_SIZE - len(sample)])
+        self.bad_rows.setdefault(table, []).append(rows)
+
+    def rows_to_prune(self, table):
+        parts = self.bad_rows.get(table)
+        return np.unique(np.concatenate(parts)) if parts else np.empty(0, dtype=np.int64)
+
+    def as_dict(self):
+        return {problem: {'count': count, 'sample': self.samples.get(problem, [])}
+                for problem, count in self.counts.items()}
+
+
+def check(batches):
+    """Run the checks; batches(table, columns) yields the row batches of a table"""
+    report = Report()
+    nodes, ways = IdBitmap(), IdBitmap()
+
+    for table, bitmap in (('nodes', nodes), ('ways', ways)):
+        for rows, data in batches(table, ['id']):
+            dup = bitmap.add(data['id'])
+            report.record('duplicate_' + table, table, rows[dup], data['id'][dup])
+
+    for rows, data in batches('ways_nodes', ['id', 'node_id']):
+        missing = ~nodes.contains(data['node_id'])
+        report.record('missing_node_refs', 'ways_nodes', rows[missing], data['node_id'][missing])
+        orphan = ~ways.contains(data['id'])
+        report.record('orphan_ways_nodes', 'ways_nodes', rows[orphan], data['id'][orphan])
+
+    for table, bitmap in (('nodes_tags', nodes), ('ways_tags', ways)):
+        for rows, data in batches(table, ['id']):
+            orphan = ~bitmap.contains(data['id'])
+            report.record('orphan_' + table, table, rows[orphan], data['id'][orphan])
+
+    report.memory = nodes.nbytes() + ways.nbytes()
+    return report
+
+
+PRUNED_TABLES = ('nodes', 'ways', 'ways_nodes', 'nodes_tags', 'ways_tags')
+
+
+def check_database(conn, prune=False, batch_size=BATCH_SIZE):
+    """Check the tables of conn; with prune=True delete the offending rows"""
+    if prune:
+        missing = [table for table in PRUNED_TABLES if not has_rowid(conn, table)]
+        if missing:
+            raise ValueError("pruning needs rowid tables; not rowid tables: {}".format(
+                ', '.join(missing)))
+    report = check(lambda table, columns: table_batches(conn, table, columns, batch_size,
+                                                        rowids=prune))
+    if prune:
+        for table in PRUNED_TABLES:
+            rowids = report.rows_to_prune(table)
+            for start in range(0, len(rowids), batch_size):
+                conn.executemany("DELETE FROM {} WHERE rowid = ?".format(table),
+                                 ((int(r),) for r in rowids[start:start + batch_size]))
+        conn.commit()
+    return report
+
+
+CSV_PATHS = {
+    'nodes': NODES_PATH,
+    'ways': WAYS_PATH,
+    'ways_nodes': WAY_NODES_PATH,
+    'nodes_tags': NODE_TAGS_PATH,
+    'ways_tags': WAY_TAGS_PATH,
+}
+
+
+def check_csvs(directory='.', prune=False, batch_size=BATCH_SIZE):
+    """Check the csvs in directory; with prune=True rewrite them without the offending rows"""
+    paths = {table: os.path.join(directory, name) for table, name in CSV_PATHS.items()}
+    report = check(lambda table, columns: csv_batches(paths[table], columns, batch_size))
+    if prune:
+        for table in PRUNED_TABLES:
+            bad = report.rows_to_prune(table)
+            if len(bad):
+                prune_csv(paths[table], bad)
+    return report
+
+
+def prune_csv(path, bad_rows):
+    """Rewrite the csv at path without the given (0-based, after the header) rows"""
+    tmp = path + '.tmp'
+    bad = iter(bad_rows.tolist())
+    next_bad = next(bad, None)
+    with open(path, newline='', encoding='utf-8') as src, \
+            open(tmp, 'w', newline='', encoding='utf-8') as dst:
+        dst.write(src.readline())
+        reader, writer = csv.reader(src), csv.writer(dst)
+        for n, row in enumerate(reader):
+            if n == next_bad:
+                next_bad = next(bad, None)
+                continue
+            writer.writerow(row)
+    os.replace(tmp, path)
+
+
+if __name__ == '__main__':
+    import pprint
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'csv':
+        result = check_csvs('.', prune='--prune' in sys.argv)
+    else:
+        result = check_database(create_connection(DB_PATH), prune='--prune' in sys.argv)
+    pprint.pprint(result.as_dict())
+    print("bitmap memory: {} bytes".format(result.memory))
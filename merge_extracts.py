@@ -0,0 +1,127 @@
+"""
+Merge several OSM extracts into one database.
+
+Neighbouring extracts overlap at their borders, so loading them one after the
+other with load_map violates the nodes/ways primary keys. merge_extracts:
+
+    1. shapes every extract in its own process and writes one run file per
+       element type, sorted by (id, version) through a sorted_output
+       ExternalSorter, so a worker holds at most run_size elements whatever
+       the size of its extract
+    2. k-way merges the runs of all extracts with heapq.merge, keeps the newest
+       version of each id, and streams the survivors into the database in id
+       order through a normal load_map writer
+
+No per-row UPSERTs; every row is inserted once, already in primary key order.
+
+Usage:
+    merge_extracts(["westport.osm", "dartmouth.osm", "fall_river.osm"], "region.db")
+"""
+
+import heapq
+import itertools
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from data import iter_shaped
+from database import BATCH_SIZE, TableWriter, create_connection
+from sorted_output import RUN_SIZE, ExternalSorter, read_run, write_run
+
+ELEMENT_KEYS = ('node', 'way')
+
+
+def element_key(el):
+    """(id, version) sort key of a shape_element dict"""
+    attribs = el['node'] if 'node' in el else el['way']
+    return int(attribs['id']), int(attribs['version'])
+
+
+def record_key(record):
+    return record[0]
+
+
+def sort_extract(osm_file, directory, validate=False, run_size=RUN_SIZE):
+    """Shape osm_file and write one (id, version)-sorted run per element type
+
+    :return: {'node': run path, 'way': run path}
+    """
+    sorters = {key: ExternalSorter(record_key, run_size, directory) for key in ELEMENT_KEYS}
+    try:
+        for el in iter_shaped(osm_file, validate):
+            sorters['node' if 'node' in el else 'way'].add((element_key(el), el))
+
+        base = os.path.join(directory, os.path.basename(osm_file))
+        runs = {}
+        for key, sorter in sorters.items():
+            runs[key] = '{}.{}.run'.format(base, key)
+            write_run(runs[key], sorter)
+        return runs
+    finally:
+        for sorter in sorters.values():
+            sorter.close()
+
+
+def newest(records):
+    """From (id, version)-sorted records, yield only the last version of each id"""
+    for _, group in itertools.groupby(records, key=lambda record: record[0][0]):
+        for record in group:
+            pass
+        yield record
+
+
+def merge_runs(paths):
+    """k-way merge of sorted runs, deduplicated to the newest version of each id"""
+    return newest(heapq.merge(*(read_run(p) for p in paths), key=record_key))
+
+
+def merge_extracts(osm_files, db_file, writers=None, processes=None, validate=False,
+                   batch_size=BATCH_SIZE, run_size=RUN_SIZE):
+    """Load osm_files into db_file, keeping the newest version of every node and way
+
+    :return: {'node': count, 'way': count} of the rows written
+    """
+    if writers is None:
+        writers = [TableWriter()]
+    directory = tempfile.mkdtemp(prefix='merge_extracts-')
+    try:
+        # Extracts with the same file name in different directories get their own runs
+        dirs = [os.path.join(directory, str(i)) for i in range(len(osm_files))]
+        for d in dirs:
+            os.mkdir(d)
+        with ProcessPoolExecutor(processes) as pool:
+            runs = list(pool.map(sort_extract, osm_files, dirs, [validate] * len(osm_files),
+                                 [run_size] * len(osm_files)))
+
+        conn = create_connection(db_file)
+        for writer in writers:
+            writer.create(conn)
+
+        counts = {}
+        for key in ELEMENT_KEYS:
+            counts[key] = 0
+            for _, el in merge_runs([r[key] for r in runs]):
+                counts[key] += 1
+                for writer in writers:
+                    writer.add(el)
+                    if writer.pending >= batch_size:
+                        writer.flush(conn)
+
+        for writer in writers:
+            writer.flush(conn)
+            writer.finish(conn)
+        conn.commit()
+        conn.close()
+        return counts
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) < 3:
+        print("usage: merge_extracts.py OUT.db EXTRACT.osm [EXTRACT.osm ...]")
+        sys.exit(1)
+    print(merge_extracts(sys.argv[2:], sys.argv[1]))
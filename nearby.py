@@ -0,0 +1,224 @@
+"""
+Nearest-POI and reverse-geocode queries on a uniform grid index.
+
+build_poi_grid precomputes a grid cell for every tagged node and every tagged
+way's centroid and stores it in WPM.db:
+
+    poi_grid(cell, element_type, id, lat, lon, amenity, address)
+
+PoiIndex loads that table into NumPy arrays sorted by cell. A query only looks
+at the cells its search box overlaps (one searchsorted per grid row) and filters
+the candidates with a vectorized haversine distance.
+
+Usage:
+    build_poi_grid(conn)                       # once, after the load
+    index = PoiIndex.load(conn)
+    index.within(41.52, -71.07, 500, amenity=True)  # amenities within 500 m
+    index.nearest(41.52, -71.07, k=5)
+    index.reverse_geocode(41.52, -71.07)       # nearest element with an address
+"""
+
+import numpy as np
+
+from database import DB_PATH, create_connection, create_table
+
+# Grid cell edge in degrees (about 550 m north-south)
+CELL_SIZE = 0.005
+
+EARTH_RADIUS = 6371008.8  # meters
+METERS_PER_DEGREE = np.pi * EARTH_RADIUS / 180
+
+# Tags the MassGIS import put on almost every node; they do not make a POI
+IGNORED_KEYS = ('source', 'attribution', 'created_by')
+
+SQL_CREATE_POI_GRID_TABLE = """CREATE TABLE IF NOT EXISTS poi_grid (
+    cell INTEGER NOT NULL,
+    element_type TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    lat FLOAT NOT NULL,
+    lon FLOAT NOT NULL,
+    amenity TEXT,
+    address TEXT,
+    PRIMARY KEY (cell, element_type, id)
+) WITHOUT ROWID;"""
+
+SQL_CREATE_POI_GRID_META_TABLE = """CREATE TABLE IF NOT EXISTS poi_grid_meta (
+    cell_size FLOAT NOT NULL
+);"""
+
+# One row per tagged element: amenity and "housenumber street" when present
+SQL_POI_TAGS = """SELECT id,
+        MAX(CASE WHEN key = 'amenity' AND type = 'regular' THEN value END) AS amenity,
+        MAX(CASE WHEN key = 'street' AND type = 'addr' THEN value END) AS street,
+        MAX(CASE WHEN key = 'housenumber' AND type = 'addr' THEN value END) AS housenumber
+    FROM {table}
+    WHERE key NOT IN ({ignored})
+    GROUP BY id"""
+
+
+def grid_cell(lat, lon, cell_size=CELL_SIZE):
+    """Cell id of each coordinate (works on scalars and arrays)"""
+    row = np.floor((np.asarray(lat) + 90.0) / cell_size).astype(np.int64)
+    col = np.floor((np.asarray(lon) + 180.0) / cell_size).astype(np.int64)
+    return row * grid_columns(cell_size) + col
+
+
+def grid_columns(cell_size=CELL_SIZE):
+    return int(np.ceil(360.0 / cell_size))
+
+
+def haversine(lat, lon, lats, lons):
+    """Distance in meters from (lat, lon) to every point in lats/lons"""
+    lat, lon = np.radians(lat), np.radians(lon)
+    lats, lons = np.radians(lats), np.radians(lons)
+    a = (np.sin((lats - lat) / 2) ** 2 +
+         np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def poi_rows(conn):
+    """Yield (element_type, id, lat, lon, amenity, address) for every tagged element"""
+    ignored = ','.join("'{}'".format(k) for k in IGNORED_KEYS)
+
+    node_sql = """SELECT n.id, n.lat, n.lon, t.amenity, t.street, t.housenumber
+                  FROM ({}) t
+                  JOIN nodes n ON n.id = t.id"""
+    way_sql = """SELECT t.id, AVG(n.lat), AVG(n.lon), t.amenity, t.street, t.housenumber
+                 FROM ({}) t
+                 JOIN ways_nodes wn ON wn.id = t.id
+                 JOIN nodes n ON n.id = wn.node_id
+                 GROUP BY t.id"""
+    for element_type, table, sql in (('node', 'nodes_tags', node_sql), ('way', 'ways_tags', way_sql)):
+        tags_sql = SQL_POI_TAGS.format(table=table, ignored=ignored)
+        for element_id, lat, lon, amenity, street, housenumber in conn.execute(sql.format(tags_sql)):
+            address = ' '.join(p for p in (housenumber, street) if p) or None
+            yield element_type, element_id, lat, lon, amenity, address
+
+
+def build_poi_grid(conn, cell_size=CELL_SIZE):
+    """(Re)build poi_grid for every tagged node and way centroid"""
+    conn.execute("DROP TABLE IF EXISTS poi_grid")
+    conn.execute("DROP TABLE IF EXISTS poi_grid_meta")
+    create_table(conn, SQL_CREATE_POI_GRID_TABLE)
+    create_table(conn, SQL_CREATE_POI_GRID_META_TABLE)
+    conn.execute("INSERT INTO poi_grid_meta VALUES (?)", (cell_size,))
+
+    rows = list(poi_rows(conn))
+    if rows:
+        cells = grid_cell([r[2] for r in rows], [r[3] for r in rows], cell_size)
+        conn.executemany("INSERT INTO poi_grid VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         ((int(cell),) + row for cell, row in zip(cells, rows)))
+    conn.commit()
+    return len(rows)
+
+
+class PoiIndex(object):
+    """In-memory copy of poi_grid, sorted by cell, answering radius and k-nearest queries"""
+
+    def __init__(self, cells, element_types, ids, lats, lons, amenities, addresses,
+                 cell_size=CELL_SIZE):
+        self.cells = cells
+        self.element_types = element_types
+        self.ids = ids
+        self.lats = lats
+        self.lons = lons
+        self.amenities = amenities
+        self.addresses = addresses
+        self.cell_size = cell_size
+        self.columns = grid_columns(cell_size)
+
+    @classmethod
+    def load(cls, conn):
+        cell_size = conn.execute("SELECT cell_size FROM poi_grid_meta").fetchone()[0]
+        rows = conn.execute("""SELECT cell, element_type, id, lat, lon, amenity, address
+                               FROM poi_grid ORDER BY cell""").fetchall()
+        columns = list(zip(*rows)) or [()] * 7
+        return cls(np.array(columns[0], dtype=np.int64),
+                   np.array(columns[1], dtype=object),
+                   np.array(columns[2], dtype=np.int64),
+                   np.array(columns[3], dtype=np.float64),
+                   np.array(columns[4], dtype=np.float64),
+                   np.array(columns[5], dtype=object),
+                   np.array(columns[6], dtype=object),
+                   cell_size)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def candidates(self, lat, lon, radius):
+        """Positions of every point in the cells overlapping the radius' bounding box"""
+        dlat = radius / METERS_PER_DEGREE
+        dlon = radius / (METERS_PER_DEGREE * max(np.cos(np.radians(lat)), 1e-6))
+        row0, col0 = divmod(int(grid_cell(lat - dlat, lon - dlon, self.cell_size)), self.columns)
+        row1, col1 = divmod(int(grid_cell(lat + dlat, lon + dlon, self.cell_size)), self.columns)
+
+        rows = np.arange(row0, row1 + 1, dtype=np.int64) * self.columns
+        starts = np.searchsorted(self.cells, rows + col0, side='left')
+        ends = np.searchsorted(self.cells, rows + col1, side='right')
+        if not len(starts):
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])
+
+    def filter(self, positions, amenity=None, address=False):
+        """Keep positions with an amenity (any if amenity is True) and/or an address"""
+        if amenity is True:
+            positions = positions[self.amenities[positions] != None]  # noqa: E711
+        elif amenity:
+            positions = positions[self.amenities[positions] == amenity]
+        if address:
+            positions = positions[self.addresses[positions] != None]  # noqa: E711
+        return positions
+
+    def results(self, positions, distances):
+        return [{'element_type': self.element_types[p], 'id': int(self.ids[p]),
+                 'lat': float(self.lats[p]), 'lon': float(self.lons[p]),
+                 'amenity': self.amenities[p], 'address': self.addresses[p],
+                 'distance': float(d)}
+                for p, d in zip(positions, distances)]
+
+    def within(self, lat, lon, radius, amenity=None, address=False):
+        """Everything within radius meters of (lat, lon), nearest first"""
+        positions = self.filter(self.candidates(lat, lon, radius), amenity, address)
+        distances = haversine(lat, lon, self.lats[positions], self.lons[positions])
+        keep = distances <= radius
+        positions, distances = positions[keep], distances[keep]
+        order = np.argsort(distances, kind='stable')
+        return self.results(positions[order], distances[order])
+
+    def nearest(self, lat, lon, k=1, amenity=None, address=False, max_radius=50000):
+        """The k nearest elements to (lat, lon), searching up to max_radius meters"""
+        radius = self.cell_size * METERS_PER_DEGREE
+        while True:
+            positions = self.filter(self.candidates(lat, lon, radius), amenity, address)
+            distances = haversine(lat, lon, self.lats[positions], self.lons[positions])
+            # Points outside the radius may be beaten by points in cells not yet searched
+            inside = distances <= radius
+            if inside.sum() >= k or radius >= max_radius:
+                positions, distances = positions[inside], distances[inside]
+                order = np.argsort(distances, kind='stable')[:k]
+                return self.results(positions[order], distances[order])
+            radius *= 2
+
+    def reverse_geocode(self, lat, lon):
+        """Nearest element that has an address, or None"""
+        found = self.nearest(lat, lon, k=1, address=True)
+        return found[0] if found else None
+
+
+if __name__ == '__main__':
+    import pprint
+    import sys
+    import time
+
+    conn = create_connection(DB_PATH)
+    if conn.execute("SELECT name FROM sqlite_master WHERE name='poi_grid'").fetchone() is None:
+        print("Indexed {} elements".format(build_poi_grid(conn)))
+    index = PoiIndex.load(conn)
+
+    lat, lon = (float(a) for a in sys.argv[1:3]) if len(sys.argv) > 2 else (41.5665, -71.0699)
+    start = time.perf_counter()
+    nearby = index.within(lat, lon, 500, amenity=True)
+    elapsed = time.perf_counter() - start
+    pprint.pprint(nearby)
+    print("{} amenities within 500 m in {:.2f} ms".format(len(nearby), elapsed * 1000))
+    pprint.pprint(index.reverse_geocode(lat, lon))
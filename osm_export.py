@@ -0,0 +1,134 @@
+"""
+Stream WPM.db back out as OSM XML.
+
+The street and amenity fixes (audits.update_name / update_amenity) were only
+ever printed; export_osm writes a corrected .osm file from the tables:
+
+    <node ...>  from nodes,  its <tag>s from nodes_tags
+    <way ...>   from ways,   its <nd>s from ways_nodes, its <tag>s from ways_tags
+
+Every table is read through its own cursor ordered by id (and position for
+ways_nodes), and the child cursors are merge-joined against the parent cursor,
+so only the current element is ever in memory whatever the size of the
+database. Tag keys are put back together with data.full_key, undoing the
+type/key split of shape_element.
+
+Usage:
+    export_osm(conn, "WPM_clean.osm")             # with the street/amenity fixes
+    export_osm(conn, "WPM_raw.osm", fix=False)
+"""
+
+import itertools
+from xml.sax.saxutils import quoteattr
+
+from audits import update_amenity, update_name
+from data import full_key
+from database import DB_PATH, create_connection
+
+SQL_NODES = "SELECT id, lat, lon, version, timestamp, changeset, uid, user FROM nodes ORDER BY id"
+SQL_NODES_TAGS = "SELECT id, key, value, type FROM nodes_tags ORDER BY id"
+SQL_WAYS = "SELECT id, version, timestamp, changeset, uid, user FROM ways ORDER BY id"
+SQL_WAYS_NODES = "SELECT id, node_id FROM ways_nodes ORDER BY id, position"
+SQL_WAYS_TAGS = "SELECT id, key, value, type FROM ways_tags ORDER BY id"
+
+# Rows fetched from each cursor at a time
+FETCH_SIZE = 10000
+
+
+def iter_rows(conn, sql):
+    cursor = conn.execute(sql)
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        yield from rows
+
+
+def merge_join(parents, *children):
+    """For id-sorted parent rows, yield (parent, [child rows with that id], ...)
+
+    Every children iterable must be sorted by id (its first column). Children
+    whose id has no parent are skipped.
+    """
+    groups = [itertools.groupby(c, key=lambda row: row[0]) for c in children]
+    current = [next(g, None) for g in groups]
+    for parent in parents:
+        matched = []
+        for i, g in enumerate(groups):
+            while current[i] is not None and current[i][0] < parent[0]:
+                current[i] = next(g, None)
+            if current[i] is not None and current[i][0] == parent[0]:
+                matched.append(list(current[i][1]))
+                current[i] = next(g, None)
+            else:
+                matched.append([])
+        yield (parent,) + tuple(matched)
+
+
+def fixed_value(k, v):
+    """Apply the audit fixes to a tag value"""
+    if k == 'addr:street':
+        return update_name(v)
+    if k == 'amenity':
+        return update_amenity(v)
+    return v
+
+
+def tag_lines(tags, fix):
+    lines = []
+    for _, key, value, tag_type in tags:
+        k = full_key({'key': key, 'type': tag_type})
+        v = fixed_value(k, value) if fix else value
+        lines.append('    <tag k={} v={} />\n'.format(quoteattr(k), quoteattr(v)))
+    return lines
+
+
+def attributes(names, values):
+    return ' '.join('{}={}'.format(name, quoteattr(str(value)))
+                    for name, value in zip(names, values) if value is not None)
+
+
+def node_xml(node, tags, fix):
+    node_id, lat, lon = node[:3]
+    attrs = 'id="{}" lat="{:.7f}" lon="{:.7f}" {}'.format(
+        node_id, float(lat), float(lon),
+        attributes(('version', 'timestamp', 'changeset', 'uid', 'user'), node[3:]))
+    if not tags:
+        return '  <node {} />\n'.format(attrs)
+    return '  <node {}>\n{}  </node>\n'.format(attrs, ''.join(tag_lines(tags, fix)))
+
+
+def way_xml(way, nds, tags, fix):
+    attrs = 'id="{}" {}'.format(
+        way[0], attributes(('version', 'timestamp', 'changeset', 'uid', 'user'), way[1:]))
+    lines = ['    <nd ref="{}" />\n'.format(node_id) for _, node_id in nds]
+    lines.extend(tag_lines(tags, fix))
+    return '  <way {}>\n{}  </way>\n'.format(attrs, ''.join(lines))
+
+
+def export_osm(conn, osm_file, fix=True):
+    """Write every node and way in conn to osm_file; return (nodes, ways) written"""
+    nodes = ways = 0
+    with open(osm_file, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<osm version="0.6" generator="osm_export.py">\n')
+
+        for node, tags in merge_join(iter_rows(conn, SQL_NODES), iter_rows(conn, SQL_NODES_TAGS)):
+            f.write(node_xml(node, tags, fix))
+            nodes += 1
+
+        for way, nds, tags in merge_join(iter_rows(conn, SQL_WAYS), iter_rows(conn, SQL_WAYS_NODES),
+                                         iter_rows(conn, SQL_WAYS_TAGS)):
+            f.write(way_xml(way, nds, tags, fix))
+            ways += 1
+
+        f.write('</osm>\n')
+    return nodes, ways
+
+
+if __name__ == '__main__':
+    import sys
+
+    out = sys.argv[1] if len(sys.argv) > 1 else "WPM_clean.osm"
+    print("{} nodes, {} ways".format(*export_osm(create_connection(DB_PATH), out,
+                                                 fix='--raw' not in sys.argv)))
@@ -0,0 +1,155 @@
+"""
+Pipelined version of data.process_map.
+
+process_map parses, shapes, validates and writes the five csvs one element at a
+time, so parsing and file I/O never overlap. process_map_pipelined splits the
+work into threads joined by bounded queues:
+
+    parser --elements--> shaper --rows--> one writer per csv
+
+Elements and rows move in batches to keep the queue overhead down, and the
+bounded queues give backpressure: a slow disk stalls the shaper, which stalls
+the parser, instead of rows piling up in memory. There is one shaper and every
+csv has a single writer, so the files are byte-for-byte what process_map writes.
+
+If any stage fails the others stop, the files are closed, and the first error
+is raised again in the caller.
+"""
+
+import queue
+import threading
+
+from data import (NODES_PATH, NODE_TAGS_PATH, WAYS_PATH, WAY_NODES_PATH, WAY_TAGS_PATH,
+                  NODE_FIELDS, NODE_TAGS_FIELDS, WAY_FIELDS, WAY_NODES_FIELDS, WAY_TAGS_FIELDS,
+                  OSM_PATH, UnicodeDictWriter, get_element, make_validator, shape_element,
+                  validate_element)
+
+# shape_element key -> (csv path, csv fields)
+OUTPUTS = {
+    'node': (NODES_PATH, NODE_FIELDS),
+    'node_tags': (NODE_TAGS_PATH, NODE_TAGS_FIELDS),
+    'way': (WAYS_PATH, WAY_FIELDS),
+    'way_nodes': (WAY_NODES_PATH, WAY_NODES_FIELDS),
+    'way_tags': (WAY_TAGS_PATH, WAY_TAGS_FIELDS),
+}
+
+BATCH_SIZE = 1000      # elements per parser batch
+QUEUE_SIZE = 16        # batches a queue holds before its producer blocks
+BUFFER_SIZE = 1 << 20  # write buffer per csv
+
+# Sentinel put on a queue after the last batch
+DONE = object()
+
+
+class Pipeline(object):
+    """Shared stop flag, error slot and blocking queue helpers for the stages"""
+
+    def __init__(self):
+        self.stop = threading.Event()
+        self.errors = []
+
+    def put(self, q, item):
+        """Put item on q, giving up if another stage has failed"""
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, q):
+        """Next item from q, or DONE if another stage has failed"""
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return DONE
+
+    def thread(self, target, *args):
+        def run():
+            try:
+                target(*args)
+            except BaseException as e:
+                self.errors.append(e)
+                self.stop.set()
+        return threading.Thread(target=run, name=target.__name__, daemon=True)
+
+
+def parse_stage(pipe, file_in, out, batch_size):
+    batch = []
+    for element in get_element(file_in, tags=('node', 'way')):
+        batch.append(element)
+        if len(batch) >= batch_size:
+            if not pipe.put(out, batch):
+                return
+            batch = []
+    if batch:
+        pipe.put(out, batch)
+    pipe.put(out, DONE)
+
+
+def shape_stage(pipe, validate, inp, outs):
+    validator = make_validator(validate)
+    while True:
+        batch = pipe.get(inp)
+        if batch is DONE:
+            break
+
+        rows = {key: [] for key in outs}
+        for element in batch:
+            el = shape_element(element)
+            if not el:
+                continue
+            if validator is not None:
+                validate_element(el, validator)
+            for key, value in el.items():
+                if isinstance(value, list):
+                    rows[key].extend(value)
+                else:
+                    rows[key].append(value)
+
+        for key, q in outs.items():
+            if rows[key] and not pipe.put(q, rows[key]):
+                return
+
+    for q in outs.values():
+        pipe.put(q, DONE)
+
+
+def write_stage(pipe, path, fields, inp, buffer_size):
+    with open(path, 'w', encoding='utf-8', newline='', buffering=buffer_size) as f:
+        writer = UnicodeDictWriter(f, fields)
+        writer.writeheader()
+        while True:
+            rows = pipe.get(inp)
+            if rows is DONE:
+                break
+            writer.writerows(rows)
+
+
+def process_map_pipelined(file_in, validate, batch_size=BATCH_SIZE, queue_size=QUEUE_SIZE,
+                          buffer_size=BUFFER_SIZE):
+    """Same output as data.process_map, with parsing, shaping and writing in separate threads"""
+    pipe = Pipeline()
+    parsed = queue.Queue(queue_size)
+    outs = {key: queue.Queue(queue_size) for key in OUTPUTS}
+
+    threads = [pipe.thread(parse_stage, pipe, file_in, parsed, batch_size),
+               pipe.thread(shape_stage, pipe, validate, parsed, outs)]
+    for key, (path, fields) in OUTPUTS.items():
+        threads.append(pipe.thread(write_stage, pipe, path, fields, outs[key], buffer_size))
+
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if pipe.errors:
+        raise pipe.errors[0]
+
+
+if __name__ == '__main__':
+    process_map_pipelined(OSM_PATH, validate=True)
+    print("Reshaped and exported.")
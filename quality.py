@@ -0,0 +1,376 @@
+"""
+Semantic data-quality rules evaluated over columnar batches.
+
+my_schema.SCHEMA only checks types, so coordinates outside the extract,
+malformed timestamps, a uid that appears under two user names or a way with
+fewer than two nodes all load without complaint. The rule engine checks such
+things on column batches of shaped rows:
+
+    nodes       id, lat, lon, uid, user, version, changeset, timestamp
+    ways        id, uid, user, version, changeset, timestamp, node_count
+    tags        element_type, id, key, value, type
+
+A rule is a declaration (see default_rules) whose check returns a violation
+mask for a whole batch with NumPy operations:
+
+    range_rule      lo <= column <= hi
+    template_rule   fixed-width format such as a timestamp, checked on a
+                    character matrix, with optional ranges for its digit fields
+    regex_rule      a regular expression; it runs once per distinct value in
+                    the batch and the result is broadcast back, so repeated tag
+                    values cost nothing
+    UidUserRule     the same uid must keep the user name it first arrived with,
+                    across batches and across nodes and ways
+
+QualityWriter runs the rules inside load_map and stores the counts per rule in
+quality_counts and the offending ids in quality_violations; check_file runs
+them without a database.
+
+Usage:
+    load_map("WPM.osm", "WPM.db", writers=[TableWriter(), QualityWriter()])
+    check_file("WPM.osm")        # {'node_lat_outside_bbox': 0, ...}
+"""
+
+import re
+
+import numpy as np
+
+from audits import expected
+from data import OSM_PATH, iter_shaped
+from database import create_table
+
+# min_lat, min_lon, max_lat, max_lon of the Westport extract
+EXTRACT_BBOX = (41.45, -71.21, 41.70, -70.97)
+
+# Elements per batch
+BATCH_SIZE = 10000
+
+# Offending ids kept per rule and batch
+MAX_VIOLATIONS = 1000
+
+SQL_CREATE_QUALITY_COUNTS_TABLE = """CREATE TABLE IF NOT EXISTS quality_counts (
+    rule TEXT PRIMARY KEY NOT NULL,
+    checked INTEGER NOT NULL,
+    violations INTEGER NOT NULL
+);"""
+
+SQL_CREATE_QUALITY_VIOLATIONS_TABLE = """CREATE TABLE IF NOT EXISTS quality_violations (
+    rule TEXT NOT NULL,
+    element_type TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    value TEXT
+);"""
+
+SQL_UPSERT_QUALITY_COUNT = """INSERT INTO quality_counts VALUES (?, ?, ?)
+    ON CONFLICT (rule) DO UPDATE SET
+        checked = checked + excluded.checked,
+        violations = violations + excluded.violations"""
+
+
+# ================================================== #
+#               Batches                              #
+# ================================================== #
+def to_float(values):
+    """float64 array; values that do not parse become NaN"""
+    out = np.full(len(values), np.nan)
+    for i, v in enumerate(values):
+        try:
+            out[i] = float(v)
+        except (TypeError, ValueError):
+            pass
+    return out
+
+
+def to_int(values):
+    """int64 array; values that do not parse become -1"""
+    try:
+        return np.array(values, dtype=np.int64)
+    except (TypeError, ValueError, OverflowError):
+        return np.array([int(v) if str(v).lstrip('-').isdigit() else -1 for v in values],
+                        dtype=np.int64)
+
+
+def columns(elements):
+    """Column batches {'nodes': {...}, 'ways': {...}, 'tags': {...}} of shaped elements"""
+    nodes = [el['node'] for el in elements if 'node' in el]
+    ways = [el for el in elements if 'way' in el]
+    tags = [(t, 'node') for el in elements if 'node' in el for t in el['node_tags']]
+    tags += [(t, 'way') for el in ways for t in el['way_tags']]
+
+    def text(rows, field):
+        return np.array([r[field] for r in rows], dtype=object)
+
+    return {
+        'nodes': {
+            'id': to_int([n['id'] for n in nodes]),
+            'lat': to_float([n['lat'] for n in nodes]),
+            'lon': to_float([n['lon'] for n in nodes]),
+            'uid': to_int([n['uid'] for n in nodes]),
+            'user': text(nodes, 'user'),
+            'version': to_int([n['version'] for n in nodes]),
+            'changeset': to_int([n['changeset'] for n in nodes]),
+            'timestamp': text(nodes, 'timestamp'),
+        },
+        'ways': {
+            'id': to_int([w['way']['id'] for w in ways]),
+            'uid': to_int([w['way']['uid'] for w in ways]),
+            'user': np.array([w['way']['user'] for w in ways], dtype=object),
+            'version': to_int([w['way']['version'] for w in ways]),
+            'changeset': to_int([w['way']['changeset'] for w in ways]),
+            'timestamp': np.array([w['way']['timestamp'] for w in ways], dtype=object),
+            'node_count': np.array([len(w['way_nodes']) for w in ways], dtype=np.int64),
+        },
+        'tags': {
+            'element_type': np.array([e for _, e in tags], dtype=object),
+            'id': to_int([t['id'] for t, _ in tags]),
+            'key': np.array([t['key'] for t, _ in tags], dtype=object),
+            'value': np.array([t['value'] for t, _ in tags], dtype=object),
+            'type': np.array([t['type'] for t, _ in tags], dtype=object),
+        },
+    }
+
+
+# ================================================== #
+#               Rules                                #
+# ================================================== #
+class Rule(object):
+    """A named check on one table; check(batch) returns a violation mask"""
+
+    def __init__(self, name, table, check, column=None, where=None):
+        self.name = name
+        self.table = table
+        self.column = column
+        self.where = where
+        self._check = check
+
+    def check(self, batch):
+        if self.where is None:
+            return self._check(batch)
+        # Only the rows the rule is about are checked
+        mask = self.where(batch)
+        bad = np.zeros(len(mask), dtype=bool)
+        if mask.any():
+            bad[mask] = self._check({column: values[mask] for column, values in batch.items()})
+        return bad
+
+    def applies(self, batch):
+        """Mask of the rows the rule is about (all rows unless where is given)"""
+        n = len(batch['id'])
+        return self.where(batch) if self.where is not None else np.ones(n, dtype=bool)
+
+
+def range_rule(name, table, column, lo=None, hi=None, where=None):
+    """Violation when column is NaN or outside [lo, hi]"""
+    def check(batch):
+        values = batch[column]
+        bad = np.zeros(len(values), dtype=bool)
+        if values.dtype.kind == 'f':
+            bad |= np.isnan(values)
+        if lo is not None:
+            bad |= values < lo
+        if hi is not None:
+            bad |= values > hi
+        return bad
+    return Rule(name, table, check, column, where)
+
+
+def template_rule(name, table, column, template, fields=(), where=None):
+    """Violation unless column matches a fixed-width template
+
+    In the template 'd' is any digit and every other character is literal, so
+    'dddd-dd-ddTdd:dd:ddZ' is an OSM timestamp. The values become one uint8
+    character matrix and each position is compared at once for all rows.
+    fields are (start, stop, lo, hi): the number in characters start:stop must
+    lie in [lo, hi], so a month of 13 is a violation too.
+    """
+    width = len(template)
+
+    def check(batch):
+        values = batch[column]
+        if not len(values):
+            return np.zeros(0, dtype=bool)
+        encoded = np.array([str(v).encode('ascii', 'replace') for v in values],
+                           dtype='S{}'.format(width + 1))
+        chars = encoded.view(np.uint8).reshape(len(values), width + 1)
+        ok = chars[:, width] == 0     # nothing after the template
+        for i, c in enumerate(template):
+            if c == 'd':
+                ok &= (chars[:, i] >= ord('0')) & (chars[:, i] <= ord('9'))
+            else:
+                ok &= chars[:, i] == ord(c)
+        digits = chars.astype(np.int64) - ord('0')
+        for start, stop, lo, hi in fields:
+            number = np.zeros(len(values), dtype=np.int64)
+            for i in range(start, stop):
+                number = number * 10 + digits[:, i]
+            ok &= (number >= lo) & (number <= hi)
+        return ~ok
+    return Rule(name, table, check, column, where)
+
+
+def regex_rule(name, table, column, pattern, match=True, where=None):
+    """Violation when pattern does not match column (or does, with match=False)
+
+    The expression runs once per distinct value in the batch.
+    """
+    regex = re.compile(pattern) if isinstance(pattern, str) else pattern
+
+    def check(batch):
+        values = batch[column]
+        if not len(values):
+            return np.zeros(0, dtype=bool)
+        uniques, inverse = np.unique(values.astype(str), return_inverse=True)
+        found = np.array([regex.search(u) is not None for u in uniques], dtype=bool)
+        return (~found if match else found)[inverse]
+    return Rule(name, table, check, column, where)
+
+
+class UidUserRule(Rule):
+    """Violation when a uid shows up with a different user name than the first time
+
+    Rules given the same users dict share it, so a way whose user differs from
+    the one the uid had on a node is caught as well.
+    """
+
+    def __init__(self, name, table, users=None):
+        super(UidUserRule, self).__init__(name, table, self.check_users, 'user')
+        self.users = {} if users is None else users
+
+    def check_users(self, batch):
+        uid, user = batch['uid'], batch['user']
+        if not len(uid):
+            return np.zeros(0, dtype=bool)
+        pairs, first, inverse = np.unique(np.array([uid.astype(str), user.astype(str)]).T,
+                                          axis=0, return_index=True, return_inverse=True)
+        bad = np.zeros(len(pairs), dtype=bool)
+        # np.unique sorts the pairs; register names in the order they arrived
+        for i in np.argsort(first, kind='stable'):
+            u, name = pairs[i]
+            known = self.users.setdefault(u, name)
+            bad[i] = known != name
+        return bad[inverse.ravel()]
+
+
+def tag_is(key, tag_type='regular'):
+    return lambda batch: (batch['key'] == key) & (batch['type'] == tag_type)
+
+
+STREET_TYPES = r'\b(?:{})$'.format('|'.join(expected))
+
+TIMESTAMP = 'dddd-dd-ddTdd:dd:ddZ'
+
+# (start, stop, lo, hi) of month, day, hour, minute and second in TIMESTAMP
+TIMESTAMP_FIELDS = ((5, 7, 1, 12), (8, 10, 1, 31), (11, 13, 0, 23), (14, 16, 0, 59),
+                    (17, 19, 0, 59))
+
+
+def default_rules(bbox=EXTRACT_BBOX):
+    min_lat, min_lon, max_lat, max_lon = bbox
+    users = {}
+    return [
+        range_rule('node_lat_outside_bbox', 'nodes', 'lat', min_lat, max_lat),
+        range_rule('node_lon_outside_bbox', 'nodes', 'lon', min_lon, max_lon),
+        template_rule('node_bad_timestamp', 'nodes', 'timestamp', TIMESTAMP, TIMESTAMP_FIELDS),
+        template_rule('way_bad_timestamp', 'ways', 'timestamp', TIMESTAMP, TIMESTAMP_FIELDS),
+        range_rule('node_bad_version', 'nodes', 'version', 1),
+        range_rule('way_bad_version', 'ways', 'version', 1),
+        range_rule('way_too_few_nodes', 'ways', 'node_count', 2),
+        UidUserRule('node_uid_user_mismatch', 'nodes', users),
+        UidUserRule('way_uid_user_mismatch', 'ways', users),
+        regex_rule('tag_value_whitespace', 'tags', 'value', r'^\s|\s$|\s\s', match=False),
+        regex_rule('street_unexpected_type', 'tags', 'value', STREET_TYPES,
+                   where=tag_is('street', 'addr')),
+        regex_rule('phone_not_numeric', 'tags', 'value', r'^[\d\s()+.\-;/x]+$',
+                   where=tag_is('phone')),
+    ]
+
+
+# ================================================== #
+#               Engine                               #
+# ================================================== #
+TABLE_TYPES = {'nodes': 'node', 'ways': 'way'}
+
+
+class QualityEngine(object):
+    """Run rules over column batches, keeping counts and sample violations"""
+
+    def __init__(self, rules=None, max_violations=MAX_VIOLATIONS):
+        self.rules = default_rules() if rules is None else rules
+        self.max_violations = max_violations
+        self.counts = {rule.name: [0, 0] for rule in self.rules}   # [checked, violations]
+
+    def evaluate(self, batches):
+        """Check every rule against its table; return (rule, element_type, id, value) violations"""
+        violations = []
+        for rule in self.rules:
+            batch = batches[rule.table]
+            if not len(batch['id']):
+                continue
+            bad = rule.check(batch)
+            count = self.counts[rule.name]
+            count[0] += int(np.count_nonzero(rule.applies(batch)))
+            count[1] += int(np.count_nonzero(bad))
+            idx = np.flatnonzero(bad)[:self.max_violations]
+            if not len(idx):
+                continue
+            if rule.table == 'tags':
+                types = batch['element_type'][idx]
+            else:
+                types = [TABLE_TYPES[rule.table]] * len(idx)
+            values = batch[rule.column][idx] if rule.column else [None] * len(idx)
+            violations.extend((rule.name, t, int(i), None if v is None else str(v))
+                              for t, i, v in zip(types, batch['id'][idx], values))
+        return violations
+
+    def result(self):
+        return {name: violations for name, (_, violations) in self.counts.items()}
+
+
+class QualityWriter(object):
+    """load_map writer that runs the rules on each batch of elements"""
+
+    def __init__(self, rules=None):
+        self.engine = QualityEngine(rules)
+        self.elements = []
+
+    @property
+    def pending(self):
+        return len(self.elements)
+
+    def create(self, conn):
+        create_table(conn, SQL_CREATE_QUALITY_COUNTS_TABLE)
+        create_table(conn, SQL_CREATE_QUALITY_VIOLATIONS_TABLE)
+
+    def add(self, el):
+        self.elements.append(el)
+
+    def flush(self, conn):
+        if not self.elements:
+            return
+        violations = self.engine.evaluate(columns(self.elements))
+        self.elements = []
+        conn.executemany("INSERT INTO quality_violations VALUES (?, ?, ?, ?)", violations)
+
+    def finish(self, conn):
+        conn.executemany(SQL_UPSERT_QUALITY_COUNT,
+                         ((name, checked, bad) for name, (checked, bad) in self.engine.counts.items()))
+
+
+def check_file(osm_file=OSM_PATH, rules=None, batch_size=BATCH_SIZE):
+    """Run the rules over osm_file; return {rule: violation count}"""
+    engine = QualityEngine(rules)
+    batch = []
+    for el in iter_shaped(osm_file):
+        batch.append(el)
+        if len(batch) >= batch_size:
+            engine.evaluate(columns(batch))
+            batch = []
+    if batch:
+        engine.evaluate(columns(batch))
+    return engine.result()
+
+
+if __name__ == '__main__':
+    import pprint
+
+    pprint.pprint(check_file())
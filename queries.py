@@ -0,0 +1,76 @@
+"""
+The report queries from the notebook, keyed by a short name.
+
+Anything that runs or tunes the report (the notebook, indexes.py) should take
+its SQL from here so there is one copy of each query.
+"""
+
+# number of unique users
+UNIQUE_USERS = "SELECT COUNT(DISTINCT uid) as Users FROM nodes;"
+
+# number of nodes
+NODE_COUNT = "SELECT COUNT(id) as Nodes FROM nodes;"
+
+# number of ways
+WAY_COUNT = "SELECT COUNT(id) as Ways FROM ways;"
+
+# top 10 user contributors
+TOP_USERS = """SELECT uid, user, sum(count) as count FROM
+    (SELECT uid, user, count(*) as count FROM nodes GROUP BY uid
+     UNION
+     SELECT uid, user, count(*) as count FROM ways GROUP BY uid)
+    GROUP BY uid
+    ORDER BY count DESC LIMIT 10;"""
+
+# most common node tags
+NODE_TAG_KEYS = """SELECT key, count(*) FROM nodes_tags
+    GROUP BY 1
+    ORDER BY count(*) DESC
+    LIMIT 10;"""
+
+# most common amenities
+AMENITIES = """SELECT value, sum(count) as count FROM
+    (SELECT value, count(*) as count FROM nodes_tags WHERE key = 'amenity'
+     GROUP BY value
+     UNION
+     SELECT value, count(*) as count FROM ways_tags WHERE key = 'amenity'
+     GROUP BY value)
+    GROUP BY value ORDER BY count desc LIMIT 20;"""
+
+# most common religions in the area
+RELIGIONS = """SELECT nodes_tags.value, COUNT(*) as num
+    FROM nodes_tags
+    JOIN (SELECT DISTINCT(id)
+          FROM nodes_tags
+          WHERE value='place_of_worship') i
+    ON nodes_tags.id=i.id
+    WHERE nodes_tags.key='religion'
+    GROUP BY nodes_tags.value
+    ORDER BY num DESC;"""
+
+# total number of cuisine tags (for the "other" slice of the pie chart)
+CUISINE_TOTAL = """SELECT sum(count) FROM
+    (SELECT count(*) as count FROM nodes_tags WHERE key = 'cuisine'
+     UNION
+     SELECT count(*) as count FROM ways_tags WHERE key = 'cuisine');"""
+
+# top 10 cuisines
+CUISINES = """SELECT value, sum(count) as count FROM
+    (SELECT value, count(*) as count FROM nodes_tags WHERE key = 'cuisine'
+     GROUP BY value
+     UNION
+     SELECT value, count(*) as count FROM ways_tags WHERE key = 'cuisine'
+     GROUP BY value)
+    GROUP BY value ORDER BY count desc LIMIT 10;"""
+
+REPORT_QUERIES = {
+    'unique_users': UNIQUE_USERS,
+    'node_count': NODE_COUNT,
+    'way_count': WAY_COUNT,
+    'top_users': TOP_USERS,
+    'node_tag_keys': NODE_TAG_KEYS,
+    'amenities': AMENITIES,
+    'religions': RELIGIONS,
+    'cuisine_total': CUISINE_TOTAL,
+    'cuisines': CUISINES,
+}
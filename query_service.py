@@ -0,0 +1,300 @@
+"""
+Local read-only HTTP/JSON query service over WPM.db.
+
+The notebook runs every report through one global cursor, so only one consumer
+can use the data at a time. QueryService serves the REPORT_QUERIES and a few
+parameterized lookups to any number of concurrent clients:
+
+    GET /reports                          names of the report queries
+    GET /report/<name>                    one report, e.g. /report/top_users
+    GET /bbox?min_lat=&min_lon=&max_lat=&max_lon=[&tag=amenity[&value=cafe]][&limit=]
+                                          nodes inside a box, optionally with a tag
+    GET /tag?tag=cuisine[&value=pizza][&limit=]
+                                          nodes and ways with a tag
+
+Every response is {"columns": [...], "rows": [[...], ...]}.
+
+The database is switched to WAL mode once, so readers never wait on a writer.
+Requests borrow a connection from a ConnectionPool of read-only connections;
+all SQL is fixed text with ? parameters, so each pooled connection compiles a
+statement once and reuses it from sqlite3's statement cache. Results are kept
+in an LRU ResultCache keyed by (query, parameters). Each request reads PRAGMA
+data_version on the connection it borrows; when it changed since that
+connection last looked, something committed to the database (a load_map, a
+build_changesets, ...) and the cache is cleared.
+
+Usage:
+    python query_service.py [port]
+    load_test("http://127.0.0.1:8000", ["/report/top_users", "/report/amenities"])
+"""
+
+import json
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from database import DB_PATH
+from queries import REPORT_QUERIES
+
+HOST = "127.0.0.1"
+PORT = 8000
+POOL_SIZE = 8
+CACHE_SIZE = 1024
+# Compiled statements kept by each pooled connection
+STATEMENT_CACHE = 256
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 10000
+
+SQL_BBOX_NODES = """SELECT id, lat, lon FROM nodes
+    WHERE lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?
+    LIMIT ?"""
+
+SQL_BBOX_TAGGED_NODES = """SELECT DISTINCT n.id, n.lat, n.lon FROM nodes n
+    JOIN nodes_tags t ON t.id = n.id
+    WHERE n.lat BETWEEN ? AND ? AND n.lon BETWEEN ? AND ?
+      AND t.key = ? AND t.type = ? AND (? IS NULL OR t.value = ?)
+    LIMIT ?"""
+
+SQL_TAGGED = """SELECT 'node' AS element_type, id, key, value FROM nodes_tags
+    WHERE key = ? AND type = ? AND (? IS NULL OR value = ?)
+    UNION ALL
+    SELECT 'way', id, key, value FROM ways_tags
+    WHERE key = ? AND type = ? AND (? IS NULL OR value = ?)
+    LIMIT ?"""
+
+
+def split_tag(tag):
+    """Split a full OSM key the way shape_element does: 'addr:street' -> ('street', 'addr')"""
+    if ':' in tag:
+        tag_type, key = tag.split(':', 1)
+        return key, tag_type
+    return tag, 'regular'
+
+
+def enable_wal(db_file):
+    """Switch db_file to WAL journaling (persistent, so this is needed once per database)"""
+    conn = sqlite3.connect(db_file)
+    mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+    conn.close()
+    return mode
+
+
+class ConnectionPool(object):
+    """Fixed set of read-only connections shared by the request threads"""
+
+    def __init__(self, db_file=DB_PATH, size=POOL_SIZE):
+        self.connections = queue.Queue()
+        uri = 'file:{}?mode=ro'.format(db_file)
+        for _ in range(size):
+            self.connections.put(sqlite3.connect(uri, uri=True, check_same_thread=False,
+                                                 cached_statements=STATEMENT_CACHE))
+
+    @contextmanager
+    def connection(self):
+        conn = self.connections.get()
+        try:
+            yield conn
+        finally:
+            self.connections.put(conn)
+
+    def close(self):
+        while not self.connections.empty():
+            self.connections.get().close()
+
+
+class ResultCache(object):
+    """Thread-safe LRU of query results"""
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+        self.generation = 0
+
+    def get(self, key, compute):
+        with self.lock:
+            if key in self.results:
+                self.results.move_to_end(key)
+                self.hits += 1
+                return self.results[key]
+            self.misses += 1
+            generation = self.generation
+        # Computed outside the lock so slow queries do not serialize the others
+        result = compute()
+        with self.lock:
+            # A result computed across a clear() may predate the change
+            if generation == self.generation:
+                self.results[key] = result
+                if len(self.results) > self.size:
+                    self.results.popitem(last=False)
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+            self.generation += 1
+
+
+class QueryService(object):
+    """The queries behind the HTTP endpoints, with pooling and caching"""
+
+    def __init__(self, db_file=DB_PATH, pool_size=POOL_SIZE, cache_size=CACHE_SIZE):
+        enable_wal(db_file)
+        self.pool = ConnectionPool(db_file, pool_size)
+        self.cache = ResultCache(cache_size)
+        self.versions = {}
+        self.versions_lock = threading.Lock()
+
+    def check_version(self, conn):
+        """Clear the cache if the database changed since conn last looked"""
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        with self.versions_lock:
+            last = self.versions.get(id(conn))
+            self.versions[id(conn)] = version
+        if last is not None and last != version:
+            self.cache.clear()
+
+    def execute(self, sql, params=()):
+        """{'columns': [...], 'rows': [...]} of a read query, from the cache when possible"""
+        with self.pool.connection() as conn:
+            self.check_version(conn)
+
+        def compute():
+            with self.pool.connection() as conn:
+                cursor = conn.execute(sql, params)
+                return {'columns': [d[0] for d in cursor.description],
+                        'rows': [list(row) for row in cursor.fetchall()]}
+        return self.cache.get((sql, tuple(params)), compute)
+
+    def report(self, name):
+        if name not in REPORT_QUERIES:
+            raise KeyError(name)
+        return self.execute(REPORT_QUERIES[name])
+
+    def bbox(self, min_lat, min_lon, max_lat, max_lon, tag=None, value=None,
+             limit=DEFAULT_LIMIT):
+        if tag is None:
+            return self.execute(SQL_BBOX_NODES, (min_lat, max_lat, min_lon, max_lon, limit))
+        key, tag_type = split_tag(tag)
+        return self.execute(SQL_BBOX_TAGGED_NODES, (min_lat, max_lat, min_lon, max_lon,
+                                                    key, tag_type, value, value, limit))
+
+    def tagged(self, tag, value=None, limit=DEFAULT_LIMIT):
+        key, tag_type = split_tag(tag)
+        return self.execute(SQL_TAGGED, (key, tag_type, value, value,
+                                         key, tag_type, value, value, limit))
+
+    def handle(self, path, query):
+        """Dispatch one request path and its parsed query string"""
+        def arg(name, convert=str, default=None):
+            if name in query:
+                return convert(query[name][0])
+            if default is None and convert is float:
+                raise ValueError("missing parameter: " + name)
+            return default
+
+        def limit():
+            value = arg('limit', int, DEFAULT_LIMIT)
+            if value < 1:
+                # SQLite reads a negative LIMIT as no limit at all
+                raise ValueError("limit must be positive")
+            return min(value, MAX_LIMIT)
+
+        parts = path.strip('/').split('/')
+        if parts == ['reports']:
+            return {'columns': ['name'], 'rows': [[name] for name in sorted(REPORT_QUERIES)]}
+        if len(parts) == 2 and parts[0] == 'report':
+            return self.report(parts[1])
+        if parts == ['bbox']:
+            return self.bbox(arg('min_lat', float), arg('min_lon', float),
+                             arg('max_lat', float), arg('max_lon', float),
+                             arg('tag'), arg('value'), limit())
+        if parts == ['tag']:
+            tag = arg('tag')
+            if tag is None:
+                raise ValueError("missing parameter: tag")
+            return self.tagged(tag, arg('value'), limit())
+        raise KeyError(path)
+
+    def close(self):
+        self.pool.close()
+
+
+def make_handler(service):
+    """BaseHTTPRequestHandler subclass that answers from service"""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            try:
+                status, body = 200, service.handle(url.path, parse_qs(url.query))
+            except KeyError:
+                status, body = 404, {'error': 'not found: ' + url.path}
+            except ValueError as e:
+                status, body = 400, {'error': str(e)}
+            except sqlite3.Error as e:
+                status, body = 500, {'error': str(e)}
+            payload = json.dumps(body, separators=(',', ':')).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(db_file=DB_PATH, host=HOST, port=PORT, pool_size=POOL_SIZE):
+    """Start the service; return the server (call serve_forever() or run it in a thread)"""
+    service = QueryService(db_file, pool_size)
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+# ================================================== #
+#               Load test client                     #
+# ================================================== #
+def load_test(base_url, paths, clients=8, requests=400):
+    """Fire requests GETs over paths from clients threads; return throughput and latencies"""
+    from concurrent.futures import ThreadPoolExecutor
+    from urllib.request import urlopen
+
+    def fetch(i):
+        start = time.perf_counter()
+        with urlopen(base_url + paths[i % len(paths)]) as response:
+            response.read()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        latencies = sorted(pool.map(fetch, range(requests)))
+    seconds = time.perf_counter() - start
+    return {'requests': requests,
+            'seconds': round(seconds, 3),
+            'per_second': round(requests / seconds, 1),
+            'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2),
+            'p95_ms': round(latencies[int(len(latencies) * 0.95)] * 1000, 2)}
+
+
+if __name__ == '__main__':
+    import sys
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else PORT
+    server = serve(port=port)
+    print("Serving {} on http://{}:{}/".format(DB_PATH, HOST, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.service.close()
@@ -0,0 +1,160 @@
+"""
+Headless version of the notebook's report.
+
+The notebook needs Jupyter (get_ipython, %matplotlib inline) and imports pandas,
+seaborn and matplotlib before anything else runs, then executes the report
+queries one after another on one cursor. render_report instead:
+
+    1. runs the REPORT_QUERIES concurrently, each on its own read-only
+       connection (sqlite3 releases the GIL while a statement runs), so the
+       queries take about as long as the slowest one
+    2. writes report.html with a table per query
+    3. only if a chart is asked for, imports matplotlib (Agg backend, no
+       display needed) and draws the cuisine pie chart to cuisines.png
+
+Nothing heavy is imported at module level, so importing this module, or any of
+the shaping/loading modules, stays fast.
+
+Usage:
+    python report.py [out_dir] [--no-chart]
+    render_report("WPM.db", "report")
+"""
+
+import html
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from database import DB_PATH
+from queries import REPORT_QUERIES
+
+# Title and column headers of each report, as in the notebook's DataFrames
+REPORT_LAYOUT = [
+    ('unique_users', "Number of unique users", ['Users']),
+    ('node_count', "Number of nodes", ['Nodes']),
+    ('way_count', "Number of ways", ['Ways']),
+    ('top_users', "Top 10 user contributors", ['User ID', 'User Name', 'Count']),
+    ('node_tag_keys', "Most common node tags", ['Node Tags', 'Count']),
+    ('amenities', "Most common amenities", ['Amenity', 'Count']),
+    ('religions', "Most common religions in the area", ['Religion', 'Count']),
+    ('cuisines', "Top 10 cuisines", ['Cuisine', 'Count']),
+]
+
+CHART_PATH = "cuisines.png"
+HTML_PATH = "report.html"
+
+
+def run_query(db_file, sql):
+    """(rows, seconds) of one query on a fresh read-only connection"""
+    start = time.perf_counter()
+    conn = sqlite3.connect('file:{}?mode=ro'.format(db_file), uri=True)
+    try:
+        rows = conn.execute(sql).fetchall()
+    finally:
+        conn.close()
+    return rows, time.perf_counter() - start
+
+
+def run_reports(db_file=DB_PATH, queries=REPORT_QUERIES, workers=None):
+    """Run the queries concurrently; return {name: (rows, seconds)}"""
+    with ThreadPoolExecutor(workers or len(queries)) as pool:
+        futures = {name: pool.submit(run_query, db_file, sql) for name, sql in queries.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+
+# ================================================== #
+#               Chart                                #
+# ================================================== #
+# Labels and percentage labels for matplotlib.pie()
+# Authors: Mark Bannister (make_labels), 'unutbu' (make_autopct)
+# Source: http://stackoverflow.com/questions/6170246/how-do-i-use-matplotlib-autopct
+
+
+def make_labels(categories, values):
+    """Make pie chart labels in the format "Category (Value)"."""
+    return ["{c} ({v})".format(c=c, v=v) for c, v in zip(categories, values)]
+
+
+def make_autopct(values):
+    """Make the function to pass to the autopct parameter of pie()."""
+    def my_autopct(pct):
+        return '{p:.1f}%'.format(p=pct)
+    return my_autopct
+
+
+def cuisine_chart(cuisines, total, path=CHART_PATH):
+    """Draw the notebook's cuisine pie chart (top 10 plus 'other') to path"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    values = [count for _, count in cuisines] + [total - sum(count for _, count in cuisines)]
+    categories = [cuisine for cuisine, _ in cuisines] + ['other']
+    colors = plt.get_cmap('Blues')([0.1 + 0.8 * i / len(values) for i in range(len(values))])
+
+    fig = plt.figure(figsize=(5, 5))
+    patches, texts, autotexts = plt.pie(values, labels=make_labels(categories, values),
+                                        colors=colors, autopct=make_autopct(values),
+                                        pctdistance=0.75)
+    for autotext in autotexts:
+        autotext.set_fontsize(10)
+    plt.title("Cuisines in the area...")
+    fig.savefig(path, bbox_inches='tight')
+    plt.close(fig)
+    return path
+
+
+# ================================================== #
+#               HTML                                 #
+# ================================================== #
+def html_table(columns, rows):
+    head = ''.join('<th>{}</th>'.format(html.escape(str(c))) for c in columns)
+    body = ''.join('<tr>{}</tr>'.format(''.join('<td>{}</td>'.format(html.escape(str(v)))
+                                                for v in row))
+                   for row in rows)
+    return '<table><tr>{}</tr>{}</table>'.format(head, body)
+
+
+def render_html(results, chart=None):
+    parts = ['<!DOCTYPE html><html><head><meta charset="utf-8"><title>WPM report</title>'
+             '<style>table{border-collapse:collapse}td,th{border:1px solid #ccc;'
+             'padding:2px 8px}</style></head><body><h1>WPM report</h1>']
+    for name, title, columns in REPORT_LAYOUT:
+        rows, seconds = results[name]
+        parts.append('<h2>{}</h2>'.format(html.escape(title)))
+        parts.append(html_table(columns, rows))
+        parts.append('<p><small>{:.1f} ms</small></p>'.format(seconds * 1000))
+    if chart:
+        parts.append('<h2>Cuisines</h2><img src="{}">'.format(html.escape(chart)))
+    parts.append('</body></html>')
+    return '\n'.join(parts)
+
+
+def render_report(db_file=DB_PATH, out_dir='.', chart=True, workers=None):
+    """Run the report queries concurrently and write report.html (and cuisines.png)
+
+    :return: path of the HTML file
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    results = run_reports(db_file, workers=workers)
+
+    chart_name = None
+    if chart:
+        total = results['cuisine_total'][0][0][0] or 0
+        cuisine_chart(results['cuisines'][0], total, os.path.join(out_dir, CHART_PATH))
+        chart_name = CHART_PATH
+
+    path = os.path.join(out_dir, HTML_PATH)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(render_html(results, chart_name))
+    return path
+
+
+if __name__ == '__main__':
+    import sys
+
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    start = time.perf_counter()
+    path = render_report(out_dir=args[0] if args else '.', chart='--no-chart' not in sys.argv)
+    print("Wrote {} in {:.2f} s".format(path, time.perf_counter() - start))
@@ -0,0 +1,202 @@
+"""
+Routable road graph from the highway=* ways.
+
+RoadGraph.build reads the ordered node lists of every highway way from
+ways_nodes and turns consecutive node pairs into directed edges, in
+compressed-sparse-row form:
+
+    node_ids[i], lats[i], lons[i]    dense node i
+    indptr[i]:indptr[i + 1]          slice of the edges leaving node i
+    targets[e], lengths[e]           edge e's head node and length in meters
+
+oneway=yes/true/1 (and junction=roundabout) keeps only the forward edge,
+oneway=-1 only the reverse one, anything else both. Everything is built with
+NumPy array operations, so the graph is a handful of arrays.
+
+Usage:
+    graph = RoadGraph.build(conn)
+    a, b = graph.nearest_node(41.52, -71.07), graph.nearest_node(41.60, -71.00)
+    meters, path = graph.shortest_path(a, b)   # A*; method='dijkstra' also works
+    labels, sizes = graph.components()
+"""
+
+import heapq
+
+import numpy as np
+
+from database import DB_PATH, create_connection
+from nearby import haversine
+
+FORWARD_ONLY = ('yes', 'true', '1')
+REVERSE_ONLY = ('-1', 'reverse')
+
+SQL_HIGHWAY_WAYS = """SELECT id,
+        MAX(CASE WHEN key = 'oneway' THEN value END) AS oneway,
+        MAX(CASE WHEN key = 'junction' THEN value END) AS junction
+    FROM ways_tags
+    WHERE id IN (SELECT id FROM ways_tags WHERE key = 'highway' AND type = 'regular')
+      AND type = 'regular'
+    GROUP BY id"""
+
+SQL_HIGHWAY_NODES = """SELECT wn.id, wn.node_id FROM ways_nodes wn
+    JOIN (SELECT DISTINCT id FROM ways_tags WHERE key = 'highway' AND type = 'regular') h
+      ON h.id = wn.id
+    ORDER BY wn.id, wn.position"""
+
+SQL_HIGHWAY_NODE_COORDS = """SELECT n.id, n.lat, n.lon FROM nodes n
+    WHERE n.id IN (SELECT wn.node_id FROM ways_nodes wn
+                   JOIN ways_tags t ON t.id = wn.id
+                   WHERE t.key = 'highway' AND t.type = 'regular')
+    ORDER BY n.id"""
+
+
+def oneway_direction(oneway, junction):
+    """1 for forward only, -1 for reverse only, 0 for both directions"""
+    if oneway in FORWARD_ONLY or (oneway is None and junction == 'roundabout'):
+        return 1
+    if oneway in REVERSE_ONLY:
+        return -1
+    return 0
+
+
+class RoadGraph(object):
+    """Directed road graph in CSR arrays"""
+
+    def __init__(self, node_ids, lats, lons, indptr, targets, lengths):
+        self.node_ids = node_ids
+        self.lats = lats
+        self.lons = lons
+        self.indptr = indptr
+        self.targets = targets
+        self.lengths = lengths
+
+    @classmethod
+    def build(cls, conn):
+        directions = {way_id: oneway_direction(oneway, junction)
+                      for way_id, oneway, junction in conn.execute(SQL_HIGHWAY_WAYS)}
+
+        rows = np.array(conn.execute(SQL_HIGHWAY_NODES).fetchall(), dtype=np.int64).reshape(-1, 2)
+        way_ids, refs = rows[:, 0], rows[:, 1]
+
+        coords = conn.execute(SQL_HIGHWAY_NODE_COORDS).fetchall()
+        node_ids = np.array([c[0] for c in coords], dtype=np.int64)
+        lats = np.array([c[1] for c in coords], dtype=np.float64)
+        lons = np.array([c[2] for c in coords], dtype=np.float64)
+
+        # Consecutive nodes of the same way are an edge; refs to nodes missing
+        # from the nodes table (e.g. dropped by sampling) break the way there
+        dense = np.searchsorted(node_ids, refs)
+        dense[dense == len(node_ids)] = 0
+        if len(node_ids):
+            known = node_ids[dense] == refs
+        else:
+            known = np.zeros(len(refs), dtype=bool)
+        pair = (way_ids[:-1] == way_ids[1:]) & known[:-1] & known[1:]
+        src, dst, edge_way = dense[:-1][pair], dense[1:][pair], way_ids[:-1][pair]
+
+        direction = np.array([directions.get(int(w), 0) for w in edge_way], dtype=np.int8)
+        forward = direction >= 0
+        reverse = direction <= 0
+        sources = np.concatenate([src[forward], dst[reverse]])
+        targets = np.concatenate([dst[forward], src[reverse]])
+
+        lengths = haversine(lats[sources], lons[sources], lats[targets], lons[targets])
+
+        order = np.argsort(sources, kind='stable')
+        sources, targets, lengths = sources[order], targets[order], lengths[order]
+        indptr = np.zeros(len(node_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(node_ids)), out=indptr[1:])
+        return cls(node_ids, lats, lons, indptr, targets, lengths)
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    @property
+    def edge_count(self):
+        return len(self.targets)
+
+    def index_of(self, node_id):
+        """Dense index of an OSM node id"""
+        i = int(np.searchsorted(self.node_ids, node_id))
+        if i == len(self.node_ids) or self.node_ids[i] != node_id:
+            raise KeyError(node_id)
+        return i
+
+    def nearest_node(self, lat, lon):
+        """OSM id of the graph node closest to (lat, lon)"""
+        return int(self.node_ids[np.argmin(haversine(lat, lon, self.lats, self.lons))])
+
+    def shortest_path(self, source, target, method='astar'):
+        """(meters, [OSM node ids]) of the shortest path, or (inf, []) if there is none"""
+        s, t = self.index_of(source), self.index_of(target)
+        if method == 'astar':
+            heuristic = haversine(self.lats[t], self.lons[t], self.lats, self.lons)
+        elif method == 'dijkstra':
+            heuristic = np.zeros(len(self.node_ids))
+        else:
+            raise ValueError("method must be 'astar' or 'dijkstra'")
+
+        dist = np.full(len(self.node_ids), np.inf)
+        prev = np.full(len(self.node_ids), -1, dtype=np.int64)
+        done = np.zeros(len(self.node_ids), dtype=bool)
+        dist[s] = 0.0
+        heap = [(heuristic[s], s)]
+        indptr, targets, lengths = self.indptr, self.targets, self.lengths
+
+        while heap:
+            _, u = heapq.heappop(heap)
+            if done[u]:
+                continue
+            if u == t:
+                break
+            done[u] = True
+            start, end = indptr[u], indptr[u + 1]
+            vs = targets[start:end]
+            nd = dist[u] + lengths[start:end]
+            better = nd < dist[vs]
+            for v, d in zip(vs[better], nd[better]):
+                dist[v] = d
+                prev[v] = u
+                heapq.heappush(heap, (d + heuristic[v], v))
+
+        if not np.isfinite(dist[t]):
+            return float('inf'), []
+        path = [t]
+        while path[-1] != s:
+            path.append(prev[path[-1]])
+        return float(dist[t]), [int(self.node_ids[i]) for i in reversed(path)]
+
+    def components(self):
+        """Weakly connected components: (label of each node, size of each label)
+
+        Label propagation over the edge arrays with pointer jumping, so the work
+        is a few passes of vectorized minimums rather than a Python traversal.
+        """
+        sources = np.repeat(np.arange(len(self.node_ids)), np.diff(self.indptr))
+        labels = np.arange(len(self.node_ids))
+        while True:
+            old = labels.copy()
+            low = np.minimum(labels[sources], labels[self.targets])
+            np.minimum.at(labels, sources, low)
+            np.minimum.at(labels, self.targets, low)
+            while True:
+                jumped = labels[labels]
+                if np.array_equal(jumped, labels):
+                    break
+                labels = jumped
+            if np.array_equal(labels, old):
+                break
+        _, labels, sizes = np.unique(labels, return_inverse=True, return_counts=True)
+        return labels, sizes
+
+
+if __name__ == '__main__':
+    import time
+
+    conn = create_connection(DB_PATH)
+    start = time.perf_counter()
+    graph = RoadGraph.build(conn)
+    print("{} nodes, {} edges in {:.2f} s".format(len(graph), graph.edge_count,
+                                                  time.perf_counter() - start))
+    labels, sizes = graph.components()
+    print("{} components, largest has {} nodes".format(len(sizes), sizes.max() if len(sizes) else 0))
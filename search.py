@@ -0,0 +1,148 @@
+"""
+Full-text search over names, addresses and tag values.
+
+values_for_unique_keys in the notebook re-parses the XML for one hardcoded key.
+SearchWriter instead keeps an FTS5 table, search_text, with one row per node or
+way that has a name, addr:*, amenity or cuisine tag:
+
+    search_text(element_type, element_id, name, addr, amenity, cuisine)
+
+search() takes an FTS5 query, so prefix and phrase queries work as usual:
+
+    search(conn, 'harb*')                  # prefix
+    search(conn, '"Main Street"')          # phrase
+    search(conn, 'addr : "Main St*"')      # phrase prefix in one column
+    search(conn, 'cuisine : pizza')
+
+Usage:
+    conn = load_map("WPM.osm", "WPM.db", writers=[TableWriter(), SearchWriter()])
+    # or, for a database that is already loaded
+    build_search_index(conn)
+"""
+
+from data import full_key
+from database import DB_PATH, create_connection, create_table, way_centroids
+
+# Prefix indexes make 2 and 3 character prefix queries index lookups
+SQL_CREATE_SEARCH_TABLE = """CREATE VIRTUAL TABLE IF NOT EXISTS search_text USING fts5(
+    element_type UNINDEXED,
+    element_id UNINDEXED,
+    name,
+    addr,
+    amenity,
+    cuisine,
+    prefix='2 3'
+);"""
+
+SQL_INSERT_SEARCH = "INSERT INTO search_text VALUES (?, ?, ?, ?, ?, ?)"
+
+SEARCH_KEYS = ('name', 'amenity', 'cuisine')
+
+
+def search_row(element_type, element_id, tags):
+    """Build the search_text row for one element, or None if it has nothing searchable"""
+    fields = {'name': [], 'addr': [], 'amenity': [], 'cuisine': []}
+    for tag in tags:
+        if tag['type'] == 'addr':
+            fields['addr'].append(tag['value'])
+        else:
+            k = full_key(tag)
+            if k in SEARCH_KEYS:
+                fields[k].append(tag['value'])
+
+    if not any(fields.values()):
+        return None
+    return (element_type, element_id, ' '.join(fields['name']), ' '.join(fields['addr']),
+            ' '.join(fields['amenity']), ' '.join(fields['cuisine']))
+
+
+class SearchWriter(object):
+    """load_map writer that fills search_text while the file is streamed"""
+
+    def __init__(self):
+        self.rows = []
+
+    @property
+    def pending(self):
+        return len(self.rows)
+
+    def create(self, conn):
+        create_table(conn, SQL_CREATE_SEARCH_TABLE)
+
+    def add(self, el):
+        if 'node' in el:
+            row = search_row('node', el['node']['id'], el['node_tags'])
+        else:
+            row = search_row('way', el['way']['id'], el['way_tags'])
+        if row is not None:
+            self.rows.append(row)
+
+    def flush(self, conn):
+        conn.executemany(SQL_INSERT_SEARCH, self.rows)
+        self.rows = []
+
+    def finish(self, conn):
+        conn.execute("INSERT INTO search_text(search_text) VALUES ('optimize')")
+
+
+def build_search_index(conn):
+    """(Re)build search_text from the nodes_tags and ways_tags tables"""
+    conn.execute("DROP TABLE IF EXISTS search_text")
+    create_table(conn, SQL_CREATE_SEARCH_TABLE)
+
+    for element_type, table in (('node', 'nodes_tags'), ('way', 'ways_tags')):
+        cursor = conn.execute("""SELECT id, key, value, type FROM {}
+                                 WHERE type = 'addr' OR key IN ('name', 'amenity', 'cuisine')
+                                 ORDER BY id""".format(table))
+        rows = []
+        element_id, tags = None, []
+        for tag_id, key, value, tag_type in cursor:
+            if tag_id != element_id and tags:
+                rows.append(search_row(element_type, element_id, tags))
+                tags = []
+            element_id = tag_id
+            tags.append({'key': key, 'value': value, 'type': tag_type})
+        if tags:
+            rows.append(search_row(element_type, element_id, tags))
+        conn.executemany(SQL_INSERT_SEARCH, [row for row in rows if row is not None])
+
+    conn.execute("INSERT INTO search_text(search_text) VALUES ('optimize')")
+    conn.commit()
+
+
+def search(conn, query, limit=20):
+    """Return the best matches for an FTS5 query
+
+    :return: list of dicts with element_type, id, name, addr, lat and lon
+    """
+    matches = [(element_type, int(element_id), name, addr)
+               for element_type, element_id, name, addr in conn.execute(
+                   """SELECT element_type, element_id, name, addr FROM search_text
+                      WHERE search_text MATCH ? ORDER BY rank LIMIT ?""", (query, limit))]
+
+    node_ids = [m[1] for m in matches if m[0] == 'node']
+    coords = {}
+    if node_ids:
+        marks = ','.join('?' * len(node_ids))
+        for node_id, lat, lon in conn.execute(
+                "SELECT id, lat, lon FROM nodes WHERE id IN ({})".format(marks), node_ids):
+            coords[('node', node_id)] = (lat, lon)
+    for way_id, latlon in way_centroids(conn, [m[1] for m in matches if m[0] == 'way']).items():
+        coords[('way', way_id)] = latlon
+
+    results = []
+    for element_type, element_id, name, addr in matches:
+        lat, lon = coords.get((element_type, element_id), (None, None))
+        results.append({'element_type': element_type, 'id': element_id, 'name': name,
+                        'addr': addr, 'lat': lat, 'lon': lon})
+    return results
+
+
+if __name__ == '__main__':
+    import pprint
+    import sys
+
+    conn = create_connection(DB_PATH)
+    if conn.execute("SELECT name FROM sqlite_master WHERE name='search_text'").fetchone() is None:
+        build_search_index(conn)
+    pprint.pprint(search(conn, ' '.join(sys.argv[1:]) or 'harb*'))
@@ -0,0 +1,190 @@
+"""
+Key-ordered output for the csvs and the database.
+
+process_map writes rows in file order. OSM files are mostly sorted already,
+but extracts, merges and edited files are not, and rows that arrive out of
+primary key order scatter inserts across the nodes/ways B-trees and the
+ways_nodes (id, position) lookups. This module emits every table sorted by its
+key:
+
+    nodes, ways             id
+    ways_nodes              (id, position)
+    nodes_tags, ways_tags   id (tags of one element keep their file order)
+
+ExternalSorter keeps at most run_size rows in memory. When the buffer is full
+it is sorted and spilled to a temporary run file, and iterating the sorter
+k-way merges the runs with heapq.merge (stable, so equal keys keep their
+arrival order). Memory is bounded by run_size whatever the size of the input.
+
+Usage:
+    process_map_sorted("WPM.osm")                                    # sorted csvs
+    load_map("WPM.osm", "WPM.db", writers=[SortedTableWriter()])     # key-ordered inserts
+"""
+
+import codecs
+import heapq
+import os
+import pickle
+import shutil
+import tempfile
+
+from data import (NODES_PATH, NODE_TAGS_PATH, WAYS_PATH, WAY_NODES_PATH, WAY_TAGS_PATH,
+                  NODE_FIELDS, NODE_TAGS_FIELDS, WAY_FIELDS, WAY_NODES_FIELDS, WAY_TAGS_FIELDS,
+                  OSM_PATH, UnicodeDictWriter, iter_shaped)
+from database import BATCH_SIZE, TableWriter
+
+# Rows a sorter holds in memory before spilling a run
+RUN_SIZE = 500000
+
+# shape_element key -> (csv path, csv fields, sort key of a row dict)
+OUTPUTS = {
+    'node': (NODES_PATH, NODE_FIELDS, lambda row: int(row['id'])),
+    'node_tags': (NODE_TAGS_PATH, NODE_TAGS_FIELDS, lambda row: int(row['id'])),
+    'way': (WAYS_PATH, WAY_FIELDS, lambda row: int(row['id'])),
+    'way_nodes': (WAY_NODES_PATH, WAY_NODES_FIELDS,
+                  lambda row: (int(row['id']), int(row['position']))),
+    'way_tags': (WAY_TAGS_PATH, WAY_TAGS_FIELDS, lambda row: int(row['id'])),
+}
+
+
+def write_run(path, records):
+    """Write records to path as a stream of separate pickles"""
+    with open(path, 'wb') as f:
+        for record in records:
+            pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+
+
+def read_run(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+class ExternalSorter(object):
+    """Sort any number of items in bounded memory by spilling sorted runs to disk"""
+
+    def __init__(self, key=None, run_size=RUN_SIZE, directory=None):
+        self.key = key
+        self.run_size = run_size
+        self.directory = directory
+        self.buffer = []
+        self.runs = []
+        self.tmp = None
+
+    def __len__(self):
+        return len(self.buffer) + sum(count for _, count in self.runs)
+
+    def add(self, item):
+        self.buffer.append(item)
+        if len(self.buffer) >= self.run_size:
+            self.spill()
+
+    def extend(self, items):
+        for item in items:
+            self.add(item)
+
+    def spill(self):
+        if not self.buffer:
+            return
+        if self.tmp is None:
+            self.tmp = tempfile.mkdtemp(prefix='sorted_output-', dir=self.directory)
+        self.buffer.sort(key=self.key)
+        path = os.path.join(self.tmp, '{}.run'.format(len(self.runs)))
+        write_run(path, self.buffer)
+        self.runs.append((path, len(self.buffer)))
+        self.buffer = []
+
+    def __iter__(self):
+        """Every item added so far, in key order; the sorter is empty afterwards"""
+        self.buffer.sort(key=self.key)
+        streams = [read_run(path) for path, _ in self.runs] + [iter(self.buffer)]
+        try:
+            yield from heapq.merge(*streams, key=self.key)
+        finally:
+            self.close()
+
+    def close(self):
+        self.buffer = []
+        self.runs = []
+        if self.tmp is not None:
+            shutil.rmtree(self.tmp, ignore_errors=True)
+            self.tmp = None
+
+
+def process_map_sorted(file_in=OSM_PATH, validate=False, run_size=RUN_SIZE, directory=None):
+    """process_map, but every csv is written in key order"""
+    sorters = {name: ExternalSorter(key, run_size, directory)
+               for name, (_, _, key) in OUTPUTS.items()}
+    try:
+        for el in iter_shaped(file_in, validate):
+            for name, value in el.items():
+                if isinstance(value, list):
+                    sorters[name].extend(value)
+                else:
+                    sorters[name].add(value)
+
+        for name, (path, fields, _) in OUTPUTS.items():
+            with codecs.open(path, 'w', "utf-8") as f:
+                writer = UnicodeDictWriter(f, fields)
+                writer.writeheader()
+                writer.writerows(sorters[name])
+    finally:
+        for sorter in sorters.values():
+            sorter.close()
+
+
+# Sort key of each table's row tuples (column order of database.SQL_INSERT)
+TABLE_KEYS = {
+    'nodes': lambda row: int(row[0]),
+    'nodes_tags': lambda row: int(row[0]),
+    'ways': lambda row: int(row[0]),
+    'ways_tags': lambda row: int(row[0]),
+    'ways_nodes': lambda row: (int(row[0]), int(row[2])),
+}
+
+
+class SortedTableWriter(TableWriter):
+    """TableWriter that inserts every table in primary key order
+
+    Rows go to one ExternalSorter per table while the file streams; nothing is
+    inserted until finish(), which appends each table in key order in batches.
+    """
+
+    def __init__(self, run_size=RUN_SIZE, batch_size=BATCH_SIZE, directory=None):
+        super(SortedTableWriter, self).__init__()
+        self.sorters = {table: ExternalSorter(key, run_size, directory)
+                        for table, key in TABLE_KEYS.items()}
+        self.batch_size = batch_size
+
+    @property
+    def pending(self):
+        # The sorters bound their own memory; load_map never needs to flush them
+        return 0
+
+    def flush(self, conn):
+        for table, rows in self.rows.items():
+            self.sorters[table].extend(rows)
+        self.rows.clear()
+
+    def add(self, el):
+        super(SortedTableWriter, self).add(el)
+        self.flush(None)
+
+    def finish(self, conn):
+        for table, sorter in self.sorters.items():
+            batch = []
+            for row in sorter:
+                batch.append(row)
+                if len(batch) >= self.batch_size:
+                    conn.executemany(self.insert_sql[table], batch)
+                    batch = []
+            if batch:
+                conn.executemany(self.insert_sql[table], batch)
+
+
+if __name__ == '__main__':
+    process_map_sorted(OSM_PATH)
+    print("Reshaped and exported in key order.")
@@ -0,0 +1,188 @@
+"""
+Point-in-polygon join of nodes to the closed ways around them.
+
+Buildings, parks, landuse areas and the harbor are closed ways: a ways_nodes
+sequence whose last node is its first. Nothing in the tables says which POI
+sits inside which of them. build_node_in_way:
+
+    1. assembles every closed way into one vertex array (CSR offsets per way,
+       like road_graph) and computes the bounding boxes
+    2. buckets the nodes into the nearby.grid_cell grid (sorted by cell, like
+       PoiIndex) and, for each polygon, takes only the nodes of the cells its
+       bbox overlaps, then the ones inside the bbox itself
+    3. runs an even-odd ray-casting test of those nodes against the polygon's
+       edges as NumPy array operations, a block of edges at a time
+
+and stores the result in WPM.db:
+
+    node_in_way(node_id, way_id)
+
+The polygon's own vertices are left out (they are on its boundary, not in it).
+Questions like "amenities inside the harbor area" become plain joins, see
+SQL_AMENITIES_IN_WAY.
+
+Usage:
+    build_node_in_way(conn)                     # every node
+    build_node_in_way(conn, tagged_only=True)   # only nodes with tags
+    conn.execute(SQL_AMENITIES_IN_WAY, (way_id,)).fetchall()
+"""
+
+import numpy as np
+
+from database import DB_PATH, create_connection, create_table
+from nearby import CELL_SIZE, grid_cell, grid_columns
+
+# Edge x point cells evaluated at once by the ray-casting test
+BLOCK_CELLS = 1 << 22
+
+SQL_CREATE_NODE_IN_WAY_TABLE = """CREATE TABLE IF NOT EXISTS node_in_way (
+    node_id INTEGER NOT NULL,
+    way_id INTEGER NOT NULL,
+    PRIMARY KEY (node_id, way_id)
+) WITHOUT ROWID;"""
+
+SQL_CREATE_NODE_IN_WAY_INDEX = "CREATE INDEX IF NOT EXISTS node_in_way_way ON node_in_way (way_id);"
+
+SQL_WAY_VERTICES = """SELECT wn.id, wn.node_id, n.lat, n.lon FROM ways_nodes wn
+    LEFT JOIN nodes n ON n.id = wn.node_id
+    ORDER BY wn.id, wn.position"""
+
+SQL_ALL_NODES = "SELECT id, lat, lon FROM nodes"
+
+SQL_TAGGED_NODES = """SELECT id, lat, lon FROM nodes
+    WHERE id IN (SELECT id FROM nodes_tags)"""
+
+# Amenities (node tags) inside one closed way
+SQL_AMENITIES_IN_WAY = """SELECT t.value, COUNT(*) FROM node_in_way p
+    JOIN nodes_tags t ON t.id = p.node_id
+    WHERE p.way_id = ? AND t.key = 'amenity'
+    GROUP BY t.value
+    ORDER BY COUNT(*) DESC"""
+
+
+class Polygons(object):
+    """Closed ways as CSR vertex arrays: way i's ring is lats/lons[indptr[i]:indptr[i + 1]]"""
+
+    def __init__(self, way_ids, indptr, node_ids, lats, lons):
+        self.way_ids = way_ids
+        self.indptr = indptr
+        self.node_ids = node_ids
+        self.lats = lats
+        self.lons = lons
+        if len(way_ids):
+            self.min_lat = np.minimum.reduceat(lats, indptr[:-1])
+            self.max_lat = np.maximum.reduceat(lats, indptr[:-1])
+            self.min_lon = np.minimum.reduceat(lons, indptr[:-1])
+            self.max_lon = np.maximum.reduceat(lons, indptr[:-1])
+        else:
+            self.min_lat = self.max_lat = self.min_lon = self.max_lon = np.empty(0)
+
+    @classmethod
+    def load(cls, conn):
+        """Every closed way with at least three distinct vertices, all of them in nodes"""
+        rows = conn.execute(SQL_WAY_VERTICES).fetchall()
+        way = np.array([r[0] for r in rows], dtype=np.int64)
+        ref = np.array([r[1] for r in rows], dtype=np.int64)
+        lat = np.array([np.nan if r[2] is None else r[2] for r in rows], dtype=np.float64)
+        lon = np.array([np.nan if r[3] is None else r[3] for r in rows], dtype=np.float64)
+
+        if not len(way):
+            return cls(way, np.zeros(1, dtype=np.int64), ref, lat, lon)
+
+        starts = np.flatnonzero(np.r_[True, way[1:] != way[:-1]])
+        ends = np.r_[starts[1:], len(way)]
+        # Missing nodes (e.g. dropped by sampling) make the ring unusable
+        missing = np.add.reduceat(np.isnan(lat).astype(np.int64), starts)
+        closed = (ends - starts >= 4) & (ref[starts] == ref[ends - 1]) & (missing == 0)
+        starts, ends = starts[closed], ends[closed]
+
+        counts = ends - starts
+        take = np.repeat(starts, counts) + (np.arange(counts.sum()) -
+                                            np.repeat(np.cumsum(counts) - counts, counts))
+        indptr = np.zeros(len(starts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        return cls(way[starts], indptr, ref[take], lat[take], lon[take])
+
+    def __len__(self):
+        return len(self.way_ids)
+
+
+def points_in_ring(lats, lons, ring_lats, ring_lons):
+    """Mask of the points inside the closed ring (even-odd rule)"""
+    inside = np.zeros(len(lats), dtype=bool)
+    y1, y2 = ring_lats[:-1], ring_lats[1:]
+    x1, x2 = ring_lons[:-1], ring_lons[1:]
+    block = max(1, BLOCK_CELLS // max(len(lats), 1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for start in range(0, len(y1), block):
+            ay, by = y1[start:start + block, None], y2[start:start + block, None]
+            ax, bx = x1[start:start + block, None], x2[start:start + block, None]
+            straddles = (ay > lats) != (by > lats)
+            cross_lon = ax + (lats - ay) * (bx - ax) / (by - ay)
+            crossings = np.count_nonzero(straddles & (lons < cross_lon), axis=0)
+            inside ^= (crossings & 1).astype(bool)
+    return inside
+
+
+def node_in_way_pairs(polygons, node_ids, lats, lons, cell_size=CELL_SIZE):
+    """Yield (node_id array, way_id) for every polygon that contains nodes"""
+    cells = grid_cell(lats, lons, cell_size)
+    order = np.argsort(cells, kind='stable')
+    cells, node_ids, lats, lons = cells[order], node_ids[order], lats[order], lons[order]
+    columns = grid_columns(cell_size)
+
+    first = grid_cell(polygons.min_lat, polygons.min_lon, cell_size)
+    last = grid_cell(polygons.max_lat, polygons.max_lon, cell_size)
+    for i in range(len(polygons)):
+        # One cell range per grid row the bbox spans
+        row0, col0 = divmod(int(first[i]), columns)
+        row1, col1 = divmod(int(last[i]), columns)
+        rows = np.arange(row0, row1 + 1, dtype=np.int64) * columns
+        starts = np.searchsorted(cells, rows + col0, 'left')
+        ends = np.searchsorted(cells, rows + col1, 'right')
+        candidates = np.concatenate([np.arange(a, b) for a, b in zip(starts, ends)])
+        if not len(candidates):
+            continue
+        in_box = candidates[(lats[candidates] >= polygons.min_lat[i]) &
+                            (lats[candidates] <= polygons.max_lat[i]) &
+                            (lons[candidates] >= polygons.min_lon[i]) &
+                            (lons[candidates] <= polygons.max_lon[i])]
+        if not len(in_box):
+            continue
+        start, end = polygons.indptr[i], polygons.indptr[i + 1]
+        inside = in_box[points_in_ring(lats[in_box], lons[in_box],
+                                       polygons.lats[start:end], polygons.lons[start:end])]
+        found = node_ids[inside]
+        found = found[~np.isin(found, polygons.node_ids[start:end])]
+        if len(found):
+            yield found, int(polygons.way_ids[i])
+
+
+def build_node_in_way(conn, tagged_only=False):
+    """(Re)build node_in_way; return the number of (node, way) rows"""
+    conn.execute("DROP TABLE IF EXISTS node_in_way")
+    create_table(conn, SQL_CREATE_NODE_IN_WAY_TABLE)
+
+    polygons = Polygons.load(conn)
+    nodes = conn.execute(SQL_TAGGED_NODES if tagged_only else SQL_ALL_NODES).fetchall()
+    node_ids = np.array([n[0] for n in nodes], dtype=np.int64)
+    lats = np.array([n[1] for n in nodes], dtype=np.float64)
+    lons = np.array([n[2] for n in nodes], dtype=np.float64)
+
+    rows = 0
+    for found, way_id in node_in_way_pairs(polygons, node_ids, lats, lons):
+        conn.executemany("INSERT INTO node_in_way VALUES (?, ?)",
+                         ((node_id, way_id) for node_id in found.tolist()))
+        rows += len(found)
+    create_table(conn, SQL_CREATE_NODE_IN_WAY_INDEX)
+    conn.commit()
+    return rows
+
+
+if __name__ == '__main__':
+    import time
+
+    conn = create_connection(DB_PATH)
+    start = time.perf_counter()
+    rows = build_node_in_way(conn)
+    print("{} node_in_way rows in {:.2f} s".format(rows, time.perf_counter() - start))
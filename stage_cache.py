@@ -0,0 +1,197 @@
+"""
+Content-addressed cache for the pipeline stages.
+
+Every notebook run redid the sample, the audits, process_map, the tables and
+the imports even when WPM.osm had not changed ("Do not need to re-create them
+every time"). StageCache keys each stage on
+
+    sha256(stage name + content hash of each input file + the stage's configuration)
+
+where the configuration is whatever changes the stage's output (SCHEMA, the
+field lists, the audit lists, the table SQL, ...). On a hit the stage's output
+files are restored from .stage_cache/<key>/ and its return value is unpickled;
+on a miss the stage runs and its outputs are stored. An output that already
+exists is left alone if it is the cached copy; if it has diverged from it (a
+table added to WPM.db after the stage ran, say) it is kept and a warning is
+issued, unless the cache was made with overwrite=True.
+
+Input hashes are remembered by (path, size, mtime), so a rerun with nothing
+changed does not even re-read the OSM file.
+
+Usage:
+    run_all("WPM.osm")        # sample, audits, csvs and WPM.db, each cached
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import warnings
+
+import audits
+import data
+import database
+from my_schema import SCHEMA
+
+CACHE_DIR = ".stage_cache"
+READ_SIZE = 1 << 20
+
+
+def file_digest(path):
+    """sha256 of a file's contents"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(READ_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def config_digest(config):
+    """Stable hash of a configuration made of dicts, lists, strings, numbers and regexes"""
+    def default(obj):
+        if hasattr(obj, 'pattern'):
+            return obj.pattern
+        return repr(obj)
+    text = json.dumps(config, sort_keys=True, default=default)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class StageCache(object):
+    """Directory of stage artifacts keyed by input content and configuration"""
+
+    def __init__(self, directory=CACHE_DIR, overwrite=False):
+        self.directory = directory
+        self.overwrite = overwrite
+        os.makedirs(directory, exist_ok=True)
+        self.digests_path = os.path.join(directory, 'digests.json')
+        try:
+            with open(self.digests_path) as f:
+                self.digests = json.load(f)
+        except (IOError, ValueError):
+            self.digests = {}
+
+    def input_digest(self, path):
+        """Content hash of path, re-reading the file only if its size or mtime changed"""
+        stat = os.stat(path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        known = self.digests.get(os.path.abspath(path))
+        if known and known[0] == stamp:
+            return known[1]
+        digest = file_digest(path)
+        self.digests[os.path.abspath(path)] = [stamp, digest]
+        with open(self.digests_path, 'w') as f:
+            json.dump(self.digests, f)
+        return digest
+
+    def key(self, stage, inputs, config):
+        h = hashlib.sha256(stage.encode('utf-8'))
+        for path in inputs:
+            h.update(self.input_digest(path).encode('ascii'))
+        h.update(config_digest(config).encode('ascii'))
+        return h.hexdigest()
+
+    def run(self, stage, inputs, config, outputs, fn, *args, **kwargs):
+        """Return fn(*args, **kwargs), or its cached result and output files
+
+        :param inputs: files the stage reads (hashed into the key)
+        :param config: anything else that changes the stage's output
+        :param outputs: files the stage writes (stored and restored)
+        """
+        entry = os.path.join(self.directory, stage + '-' + self.key(stage, inputs, config))
+        result_path = os.path.join(entry, 'result.pickle')
+
+        if os.path.exists(result_path):
+            for path in outputs:
+                if not restore(os.path.join(entry, os.path.basename(path)), path, self.overwrite):
+                    warnings.warn("{} has changed since stage {!r} cached it; "
+                                  "keeping it".format(path, stage))
+            with open(result_path, 'rb') as f:
+                return pickle.load(f)
+
+        result = fn(*args, **kwargs)
+
+        tmp = entry + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for path in outputs:
+            shutil.copy2(path, os.path.join(tmp, os.path.basename(path)))
+        with open(os.path.join(tmp, 'result.pickle'), 'wb') as f:
+            pickle.dump(result, f)
+        # The entry only appears once it is complete
+        shutil.rmtree(entry, ignore_errors=True)
+        os.rename(tmp, entry)
+        return result
+
+
+def restore(cached, path, overwrite=False):
+    """Copy a cached artifact to path unless path already is an identical copy
+
+    A path whose contents differ from the cached copy is only replaced with
+    overwrite=True. Return False if it was left in place for that reason.
+    """
+    if os.path.exists(path):
+        a, b = os.stat(cached), os.stat(path)
+        if a.st_size == b.st_size and a.st_mtime_ns == b.st_mtime_ns:
+            return True
+        if a.st_size == b.st_size and file_digest(cached) == file_digest(path):
+            return True
+        if not overwrite:
+            return False
+    shutil.copy2(cached, path)
+    return True
+
+
+# ================================================== #
+#               Stages                               #
+# ================================================== #
+CSV_PATHS = [data.NODES_PATH, data.NODE_TAGS_PATH, data.WAYS_PATH, data.WAY_NODES_PATH,
+             data.WAY_TAGS_PATH]
+
+SHAPE_CONFIG = {
+    'schema': SCHEMA,
+    'fields': [data.NODE_FIELDS, data.NODE_TAGS_FIELDS, data.WAY_FIELDS, data.WAY_TAGS_FIELDS,
+               data.WAY_NODES_FIELDS],
+    'problemchars': data.PROBLEMCHARS,
+}
+
+AUDIT_CONFIG = {
+    'auditors': [type(a).__name__ for a in audits.AUDITORS],
+    'expected': audits.expected,
+    'expected_amenities': audits.expected_amenities,
+    'patterns': [audits.lower, audits.lower_colon, audits.problemchars, audits.street_type_re,
+                 audits.amenity_re],
+}
+
+DB_CONFIG = dict(SHAPE_CONFIG, tables=database.TableWriter.create_sql)
+
+
+def load_database(osm_file, db_file):
+    """load_map into a fresh db_file"""
+    if os.path.exists(db_file):
+        os.remove(db_file)
+    database.load_map(osm_file, db_file).close()
+
+
+def run_all(osm_file=data.OSM_PATH, sample_file=data.SAMPLE_PATH, db_file=database.DB_PATH,
+            k=data.SAMPLE_K, validate=True, cache=None):
+    """Run sample, audits, csvs and database stages, skipping the ones whose key matches"""
+    cache = cache or StageCache()
+
+    cache.run('sample', [osm_file], {'k': k}, [sample_file],
+              data.make_sample, osm_file, sample_file, k)
+    results = cache.run('audits', [osm_file], AUDIT_CONFIG, [],
+                        audits.audit_file, osm_file)
+    cache.run('csvs', [osm_file], dict(SHAPE_CONFIG, validate=validate), CSV_PATHS,
+              data.process_map, osm_file, validate)
+    cache.run('database', [osm_file], DB_CONFIG, [db_file],
+              load_database, osm_file, db_file)
+    return results
+
+
+if __name__ == '__main__':
+    import time
+
+    start = time.perf_counter()
+    run_all()
+    print("Done in {:.2f} s".format(time.perf_counter() - start))
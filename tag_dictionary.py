@@ -0,0 +1,153 @@
+"""
+Dictionary-encoded storage for nodes_tags and ways_tags.
+
+The tag tables repeat the same key, type and common value strings ('yes',
+'residential', 'restaurant', ...) on every row. In this layout the strings are
+interned once into tag_keys / tag_values and the tag rows only carry integer ids:
+
+    nodes_tags_enc(id, key_id, value_id, type_id)
+    ways_tags_enc(id, key_id, value_id, type_id)
+
+Keys and types share tag_keys. nodes_tags and ways_tags become views that join
+the strings back in, so the report SQL in the notebook keeps working unchanged.
+Queries that want the integer comparisons look the id up once:
+
+    SELECT value_id, COUNT(*) FROM nodes_tags_enc
+    WHERE key_id = (SELECT id FROM tag_keys WHERE key = 'amenity')
+    GROUP BY value_id;
+
+The views cannot replace real nodes_tags / ways_tags tables, so the layout
+goes into its own database (WPM_dict.db by default); create() refuses a
+database that already has the plain tag tables.
+
+Usage:
+    conn = load_map("WPM.osm", DICT_DB_PATH, writers=[DictionaryTableWriter()])
+"""
+
+from database import (SQL_CREATE_NODES_TABLE, SQL_CREATE_WAYS_TABLE,
+                      SQL_CREATE_WAYS_NODES_TABLE, SQL_INSERT, TableWriter, load_map)
+from data import OSM_PATH
+
+DICT_DB_PATH = "WPM_dict.db"
+
+TAG_VIEWS = ('nodes_tags', 'ways_tags')
+
+SQL_CREATE_TAG_KEYS_TABLE = """CREATE TABLE IF NOT EXISTS tag_keys (
+    id INTEGER PRIMARY KEY NOT NULL,
+    key TEXT NOT NULL UNIQUE
+);"""
+
+SQL_CREATE_TAG_VALUES_TABLE = """CREATE TABLE IF NOT EXISTS tag_values (
+    id INTEGER PRIMARY KEY NOT NULL,
+    value TEXT NOT NULL
+);"""
+
+SQL_CREATE_NODES_TAGS_ENC_TABLE = """CREATE TABLE IF NOT EXISTS nodes_tags_enc (
+    id INTEGER NOT NULL,
+    key_id INTEGER NOT NULL,
+    value_id INTEGER NOT NULL,
+    type_id INTEGER NOT NULL,
+    FOREIGN KEY (id) REFERENCES nodes(id),
+    FOREIGN KEY (key_id) REFERENCES tag_keys(id),
+    FOREIGN KEY (value_id) REFERENCES tag_values(id),
+    FOREIGN KEY (type_id) REFERENCES tag_keys(id)
+);"""
+
+SQL_CREATE_WAYS_TAGS_ENC_TABLE = """CREATE TABLE IF NOT EXISTS ways_tags_enc (
+    id INTEGER NOT NULL,
+    key_id INTEGER NOT NULL,
+    value_id INTEGER NOT NULL,
+    type_id INTEGER NOT NULL,
+    FOREIGN KEY (id) REFERENCES ways(id),
+    FOREIGN KEY (key_id) REFERENCES tag_keys(id),
+    FOREIGN KEY (value_id) REFERENCES tag_values(id),
+    FOREIGN KEY (type_id) REFERENCES tag_keys(id)
+);"""
+
+# Compatibility views with the column names and order of the plain tag tables
+SQL_CREATE_TAGS_VIEW = """CREATE VIEW IF NOT EXISTS {table} AS
+    SELECT t.id AS id, k.key AS key, v.value AS value, ty.key AS type
+    FROM {table}_enc t
+    JOIN tag_keys k ON k.id = t.key_id
+    JOIN tag_values v ON v.id = t.value_id
+    JOIN tag_keys ty ON ty.id = t.type_id;"""
+
+
+class Interner(object):
+    """Map strings to dense integer ids, remembering the ones not yet written"""
+
+    def __init__(self):
+        self.ids = {}
+        self.new = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __call__(self, s):
+        i = self.ids.get(s)
+        if i is None:
+            i = self.ids[s] = len(self.ids) + 1
+            self.new.append((i, s))
+        return i
+
+    def load(self, rows):
+        """Seed the dictionary from (id, string) rows already in the database"""
+        for i, s in rows:
+            self.ids[s] = i
+
+    def take_new(self):
+        new, self.new = self.new, []
+        return new
+
+
+class DictionaryTableWriter(TableWriter):
+    """TableWriter that stores tags as integer ids into tag_keys / tag_values
+
+    The dictionaries live in memory for the whole stream; only the strings seen
+    for the first time are inserted at each flush.
+    """
+
+    create_sql = [SQL_CREATE_NODES_TABLE, SQL_CREATE_WAYS_TABLE, SQL_CREATE_WAYS_NODES_TABLE,
+                  SQL_CREATE_TAG_KEYS_TABLE, SQL_CREATE_TAG_VALUES_TABLE,
+                  SQL_CREATE_NODES_TAGS_ENC_TABLE, SQL_CREATE_WAYS_TAGS_ENC_TABLE] + \
+        [SQL_CREATE_TAGS_VIEW.format(table=table) for table in TAG_VIEWS]
+    insert_sql = dict(SQL_INSERT, **{
+        'nodes_tags': "INSERT INTO nodes_tags_enc VALUES (?, ?, ?, ?)",
+        'ways_tags': "INSERT INTO ways_tags_enc VALUES (?, ?, ?, ?)",
+    })
+
+    def __init__(self):
+        super(DictionaryTableWriter, self).__init__()
+        self.keys = Interner()
+        self.values = Interner()
+
+    def create(self, conn):
+        placeholders = ', '.join('?' * len(TAG_VIEWS))
+        clashes = conn.execute("SELECT name FROM sqlite_master WHERE type != 'view' "
+                               "AND name IN ({})".format(placeholders), TAG_VIEWS).fetchall()
+        if clashes:
+            raise ValueError("database already has plain {} tables; load the dictionary "
+                             "layout into a new database".format(
+                                 ', '.join(name for name, in clashes)))
+        super(DictionaryTableWriter, self).create(conn)
+        # Appending to an existing database keeps its ids
+        self.keys.load(conn.execute("SELECT id, key FROM tag_keys"))
+        self.values.load(conn.execute("SELECT id, value FROM tag_values"))
+
+    def add_tags(self, table, tags):
+        keys, values = self.keys, self.values
+        self.rows[table].extend((t['id'], keys(t['key']), values(t['value']), keys(t['type']))
+                                for t in tags)
+
+    def flush(self, conn):
+        # The dictionary rows go first so every id in the tag rows resolves
+        conn.executemany("INSERT INTO tag_keys VALUES (?, ?)", self.keys.take_new())
+        conn.executemany("INSERT INTO tag_values VALUES (?, ?)", self.values.take_new())
+        super(DictionaryTableWriter, self).flush(conn)
+
+
+if __name__ == '__main__':
+    conn = load_map(OSM_PATH, DICT_DB_PATH, writers=[DictionaryTableWriter()])
+    for table in ('tag_keys', 'tag_values', 'nodes_tags_enc', 'ways_tags_enc'):
+        count = conn.execute("SELECT COUNT(*) FROM {}".format(table)).fetchone()[0]
+        print("{}: {}".format(table, count))
@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from database import load_map  # noqa: E402
+
+SAMPLE_OSM = os.path.join(ROOT, 'sample_WPM.osm')
+
+
+@pytest.fixture
+def sample_osm():
+    return SAMPLE_OSM
+
+
+@pytest.fixture
+def sample_db(tmp_path):
+    """Connection to the sample loaded into the plain table layout"""
+    conn = load_map(SAMPLE_OSM, str(tmp_path / 'sample.db'))
+    yield conn
+    conn.close()
@@ -0,0 +1,16 @@
+from audits import audit_file, shard_offsets
+
+
+def test_shards_start_at_elements(sample_osm):
+    offsets = shard_offsets(sample_osm, 7)
+    assert offsets == sorted(offsets)
+    with open(sample_osm, 'rb') as f:
+        data = f.read()
+    for offset in offsets[1:-1]:
+        assert data[offset:offset + 1] == b'<'
+
+
+def test_sharded_equals_serial(sample_osm):
+    serial = audit_file(sample_osm, processes=1, shards=1)
+    assert audit_file(sample_osm, processes=1, shards=7) == serial
+    assert audit_file(sample_osm, processes=2, shards=4) == serial
@@ -0,0 +1,46 @@
+import numpy as np
+
+from geometry import (build_way_geometry, decode_way, encode_ways, load_vertices, simplify,
+                      unzigzag, varint_decode, varint_encode, way_shape, zigzag)
+
+
+def test_zigzag_varint_round_trip():
+    values = np.array([0, 1, -1, 63, -64, 64, 127, 128, 300, -300, 2 ** 40, -2 ** 40,
+                       2 ** 63 - 1, -2 ** 63], dtype=np.int64)
+    assert zigzag([0, -1, 1, -2, 2]).tolist() == [0, 1, 2, 3, 4]
+    data, sizes = varint_encode(zigzag(values))
+    assert len(data) == sizes.sum()
+    assert sizes[:4].tolist() == [1, 1, 1, 1]
+    assert unzigzag(varint_decode(data)).tolist() == values.tolist()
+
+
+def test_encode_ways_round_trip():
+    rng = np.random.default_rng(50)
+    counts = np.array([3, 1, 0, 5, 2])
+    indptr = np.r_[0, np.cumsum(counts)]
+    lats = np.round(rng.uniform(41.4, 41.7, indptr[-1]), 7)
+    lons = np.round(rng.uniform(-71.2, -70.9, indptr[-1]), 7)
+    blobs = encode_ways(indptr, lats, lons)
+    assert len(blobs) == len(counts)
+    for i, blob in enumerate(blobs):
+        way_lats, way_lons = decode_way(blob)
+        assert np.allclose(way_lats, lats[indptr[i]:indptr[i + 1]], rtol=0, atol=1e-9)
+        assert np.allclose(way_lons, lons[indptr[i]:indptr[i + 1]], rtol=0, atol=1e-9)
+
+
+def test_simplify_keeps_ends_and_corners():
+    lats = np.array([41.5, 41.5, 41.5, 41.501, 41.502])
+    lons = np.array([-71.0, -70.999, -70.998, -70.998, -70.998])
+    assert simplify(lats, lons, 1).tolist() == [True, False, True, False, True]
+    assert simplify(lats, lons, 10000).tolist() == [True, False, False, False, True]
+
+
+def test_way_geometry_matches_ways_nodes(sample_db):
+    blobs = build_way_geometry(sample_db, tolerances=(0, 20))
+    way_ids, indptr, lats, lons = load_vertices(sample_db)
+    assert blobs == 2 * len(way_ids)
+    for i, way_id in enumerate(way_ids):
+        way_lats, way_lons = way_shape(sample_db, int(way_id))
+        assert np.allclose(way_lats, lats[indptr[i]:indptr[i + 1]], rtol=0, atol=1e-7)
+        assert np.allclose(way_lons, lons[indptr[i]:indptr[i + 1]], rtol=0, atol=1e-7)
+        assert len(way_shape(sample_db, int(way_id), tolerance=50)[0]) <= len(way_lats)
@@ -0,0 +1,38 @@
+import pytest
+
+from compact import CompactTableWriter
+from database import load_map
+from integrity import IdBitmap, check_database
+from tag_dictionary import DictionaryTableWriter
+
+
+def test_bitmap_duplicates_and_membership():
+    bitmap = IdBitmap()
+    assert bitmap.add([5, 70000, 5]).tolist() == [False, False, True]
+    assert bitmap.add([70000, 6]).tolist() == [True, False]
+    assert bitmap.contains([5, 6, 7, 70000, 1 << 40]).tolist() == [True, True, False, True, False]
+
+
+def test_missing_refs_match_anti_join(sample_db):
+    expected = sample_db.execute("""SELECT COUNT(*) FROM ways_nodes
+        WHERE node_id NOT IN (SELECT id FROM nodes)""").fetchone()[0]
+    assert expected > 0
+    assert check_database(sample_db, batch_size=1000).counts['missing_node_refs'] == expected
+
+
+def test_prune_plain_layout(sample_db):
+    check_database(sample_db, prune=True)
+    counts = check_database(sample_db).counts
+    assert all(count == 0 for count in counts.values())
+
+
+@pytest.mark.parametrize('writer', [DictionaryTableWriter, CompactTableWriter])
+def test_other_layouts_check_but_refuse_prune(tmp_path, sample_osm, sample_db, writer):
+    conn = load_map(sample_osm, str(tmp_path / 'layout.db'), writers=[writer()])
+    expected = check_database(sample_db).counts
+    assert check_database(conn).counts == expected
+    rows = conn.execute("SELECT COUNT(*) FROM ways_nodes").fetchone()[0]
+    with pytest.raises(ValueError):
+        check_database(conn, prune=True)
+    assert conn.execute("SELECT COUNT(*) FROM ways_nodes").fetchone()[0] == rows
+    conn.close()
@@ -0,0 +1,35 @@
+from database import load_map
+from osm_export import export_osm
+
+TABLES = ('nodes', 'ways', 'ways_nodes', 'nodes_tags', 'ways_tags')
+
+
+def rows(conn, table):
+    return sorted(conn.execute("SELECT * FROM {}".format(table)).fetchall())
+
+
+def test_raw_export_round_trips(tmp_path, sample_db):
+    out = str(tmp_path / 'export.osm')
+    nodes, ways = export_osm(sample_db, out, fix=False)
+    assert nodes == sample_db.execute("SELECT COUNT(*) FROM nodes").fetchone()[0]
+    assert ways == sample_db.execute("SELECT COUNT(*) FROM ways").fetchone()[0]
+
+    again = load_map(out, str(tmp_path / 'again.db'))
+    for table in TABLES:
+        assert rows(again, table) == rows(sample_db, table), table
+    again.close()
+
+
+def test_fixed_export_only_changes_tag_values(tmp_path, sample_db):
+    way_id = sample_db.execute("SELECT id FROM ways LIMIT 1").fetchone()[0]
+    sample_db.execute("INSERT INTO ways_tags VALUES (?, 'street', 'Main St', 'addr')", (way_id,))
+    out = str(tmp_path / 'clean.osm')
+    export_osm(sample_db, out)
+
+    again = load_map(out, str(tmp_path / 'clean.db'))
+    for table in ('nodes', 'ways', 'ways_nodes'):
+        assert rows(again, table) == rows(sample_db, table), table
+    assert again.execute("""SELECT value FROM ways_tags
+                            WHERE id = ? AND key = 'street' AND type = 'addr'""",
+                         (way_id,)).fetchall() == [('Main Street',)]
+    again.close()
@@ -0,0 +1,51 @@
+import numpy as np
+
+from quality import TIMESTAMP, TIMESTAMP_FIELDS, check_file, default_rules, template_rule
+
+
+def rules_by_name():
+    return {rule.name: rule for rule in default_rules()}
+
+
+def users_batch(uids, users):
+    return {'id': np.arange(len(uids)), 'uid': np.array(uids, dtype=np.int64),
+            'user': np.array(users, dtype=object)}
+
+
+def test_uid_user_keeps_first_seen_name():
+    rule = rules_by_name()['node_uid_user_mismatch']
+    assert rule.check(users_batch([1, 1, 2], ['zed', 'alice', 'bob'])).tolist() == \
+        [False, True, False]
+    assert rule.check(users_batch([1, 1], ['alice', 'zed'])).tolist() == [True, False]
+
+
+def test_uid_user_shared_between_nodes_and_ways():
+    rules = rules_by_name()
+    rules['node_uid_user_mismatch'].check(users_batch([7], ['ann']))
+    assert rules['way_uid_user_mismatch'].check(users_batch([7, 8], ['bea', 'cy'])).tolist() == \
+        [True, False]
+
+
+def test_timestamp_shape_and_ranges():
+    rule = template_rule('ts', 'nodes', 'timestamp', TIMESTAMP, TIMESTAMP_FIELDS)
+    values = ['2013-03-30T05:36:51Z', '2020-12-31T23:59:59Z', '2020-13-99T99:99:99Z',
+              '2020-00-10T00:00:00Z', '2020-01-10T24:00:00Z', '2020-1-10T00:00:00Z',
+              '2020-01-10T00:00:00Zx', '']
+    batch = {'id': np.arange(len(values)), 'timestamp': np.array(values, dtype=object)}
+    assert rule.check(batch).tolist() == [False, False, True, True, True, True, True, True]
+
+
+def test_where_restricts_regex_rule():
+    rule = rules_by_name()['phone_not_numeric']
+    batch = {'id': np.arange(3),
+             'key': np.array(['phone', 'phone', 'name'], dtype=object),
+             'type': np.array(['regular'] * 3, dtype=object),
+             'value': np.array(['+1 508 555 0100', 'call us', 'call us'], dtype=object)}
+    assert rule.check(batch).tolist() == [False, True, False]
+    assert rule.applies(batch).tolist() == [True, True, False]
+
+
+def test_sample_is_clean_except_street_types(sample_osm):
+    result = check_file(sample_osm, batch_size=1000)
+    assert set(result) == set(rules_by_name())
+    assert {name for name, count in result.items() if count} <= {'street_unexpected_type'}
@@ -0,0 +1,31 @@
+import random
+
+from sorted_output import ExternalSorter, read_run, write_run
+
+
+def test_run_files_round_trip(tmp_path):
+    records = [(i, {'id': str(i)}) for i in range(100)]
+    path = str(tmp_path / 'records.run')
+    write_run(path, records)
+    assert list(read_run(path)) == records
+
+
+def test_external_sort_matches_sorted(tmp_path):
+    rng = random.Random(46)
+    items = [(rng.randrange(1000), n) for n in range(5000)]
+    sorter = ExternalSorter(key=lambda item: item[0], run_size=300, directory=str(tmp_path))
+    sorter.extend(items)
+    assert len(sorter.runs) > 1
+    assert len(sorter) == len(items)
+    # Stable: equal keys keep their arrival order
+    assert list(sorter) == sorted(items, key=lambda item: item[0])
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_close_removes_runs(tmp_path):
+    sorter = ExternalSorter(run_size=10, directory=str(tmp_path))
+    sorter.extend(range(100, 0, -1))
+    assert list(tmp_path.iterdir())
+    sorter.close()
+    assert list(tmp_path.iterdir()) == []
+    assert list(sorter) == []
@@ -0,0 +1,196 @@
+"""
+Map tile bucketing and pre-aggregated tile export.
+
+build_tiles assigns every node (by its coordinate) and every way (by its
+bounding box) to the z/x/y web-mercator tiles it touches over a range of zooms
+and stores the result in WPM.db:
+
+    tile_features(z, x, y, element_type, id)
+    tiles(z, x, y, quadkey, nodes, ways)
+
+A renderer or tile server then reads one tile's rows instead of scanning the
+nodes table for every viewport. The coordinate-to-tile math and the expansion
+of way bounding boxes into tile ranges are NumPy array operations.
+
+export_tiles writes each tile as compact JSON (z/x/y.json) or as a binary blob
+(z/x/y.bin, see pack_tile).
+
+Usage:
+    build_tiles(conn, zooms=range(10, 17))
+    tile_features(conn, 14, 4911, 6094)
+    export_tiles(conn, "tiles", fmt='json')
+"""
+
+import json
+import os
+import struct
+
+import numpy as np
+
+from compact import COORD_SCALE
+from database import DB_PATH, create_connection, create_table
+
+ZOOMS = range(10, 17)
+MAX_LAT = 85.0511287798
+
+SQL_CREATE_TILE_FEATURES_TABLE = """CREATE TABLE IF NOT EXISTS tile_features (
+    z INTEGER NOT NULL,
+    x INTEGER NOT NULL,
+    y INTEGER NOT NULL,
+    element_type TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    PRIMARY KEY (z, x, y, element_type, id)
+) WITHOUT ROWID;"""
+
+SQL_CREATE_TILES_TABLE = """CREATE TABLE IF NOT EXISTS tiles (
+    z INTEGER NOT NULL,
+    x INTEGER NOT NULL,
+    y INTEGER NOT NULL,
+    quadkey TEXT NOT NULL,
+    nodes INTEGER NOT NULL,
+    ways INTEGER NOT NULL,
+    PRIMARY KEY (z, x, y)
+) WITHOUT ROWID;"""
+
+SQL_WAY_BBOXES = """SELECT wn.id, MIN(n.lat), MIN(n.lon), MAX(n.lat), MAX(n.lon)
+    FROM ways_nodes wn
+    JOIN nodes n ON n.id = wn.node_id
+    GROUP BY wn.id"""
+
+# Binary tile: header, then nodes (id, fixed-point lat, lon), then way ids
+TILE_HEADER = struct.Struct('<BIIII')   # z, x, y, node count, way count
+TILE_NODE = np.dtype([('id', '<i8'), ('lat', '<i4'), ('lon', '<i4')])
+
+
+def tile_xy(lat, lon, z):
+    """Web-mercator tile x, y of each coordinate at zoom z (arrays in, arrays out)"""
+    n = 1 << z
+    lat = np.clip(np.asarray(lat, dtype=np.float64), -MAX_LAT, MAX_LAT)
+    lon = np.asarray(lon, dtype=np.float64)
+    x = np.floor((lon + 180.0) / 360.0 * n).astype(np.int64)
+    rad = np.radians(lat)
+    y = np.floor((1.0 - np.log(np.tan(rad) + 1.0 / np.cos(rad)) / np.pi) / 2.0 * n).astype(np.int64)
+    return np.clip(x, 0, n - 1), np.clip(y, 0, n - 1)
+
+
+def quadkey(z, x, y):
+    """Bing-style quadkey string of a tile"""
+    digits = []
+    for i in range(z, 0, -1):
+        mask = 1 << (i - 1)
+        digits.append(str((1 if x & mask else 0) + (2 if y & mask else 0)))
+    return ''.join(digits)
+
+
+def expand_ranges(x0, x1, y0, y1):
+    """For boxes of tiles, return (box index, x, y) of every tile in every box"""
+    widths, heights = x1 - x0 + 1, y1 - y0 + 1
+    counts = widths * heights
+    box = np.repeat(np.arange(len(counts)), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return box, x0[box] + local % widths[box], y0[box] + local // widths[box]
+
+
+def build_tiles(conn, zooms=ZOOMS):
+    """(Re)build tile_features and tiles for every node and way bbox; return the tile count"""
+    conn.execute("DROP TABLE IF EXISTS tile_features")
+    conn.execute("DROP TABLE IF EXISTS tiles")
+    create_table(conn, SQL_CREATE_TILE_FEATURES_TABLE)
+    create_table(conn, SQL_CREATE_TILES_TABLE)
+
+    nodes = np.array(conn.execute("SELECT id, lat, lon FROM nodes").fetchall(),
+                     dtype=np.float64).reshape(-1, 3)
+    node_ids = nodes[:, 0].astype(np.int64)
+    ways = np.array(conn.execute(SQL_WAY_BBOXES).fetchall(), dtype=np.float64).reshape(-1, 5)
+    way_ids = ways[:, 0].astype(np.int64)
+
+    tile_count = 0
+    for z in zooms:
+        nx, ny = tile_xy(nodes[:, 1], nodes[:, 2], z)
+        # min lat is the bottom of the box, which is the larger tile y
+        wx0, wy1 = tile_xy(ways[:, 1], ways[:, 2], z)
+        wx1, wy0 = tile_xy(ways[:, 3], ways[:, 4], z)
+        box, wx, wy = expand_ranges(wx0, wx1, wy0, wy1)
+
+        conn.executemany("INSERT INTO tile_features VALUES (?, ?, ?, 'node', ?)",
+                         zip([z] * len(node_ids), nx.tolist(), ny.tolist(), node_ids.tolist()))
+        conn.executemany("INSERT INTO tile_features VALUES (?, ?, ?, 'way', ?)",
+                         zip([z] * len(box), wx.tolist(), wy.tolist(), way_ids[box].tolist()))
+
+        # Per-tile counts: pack (x, y) into one key and count the unique keys
+        n = 1 << z
+        node_keys, node_counts = np.unique(nx * n + ny, return_counts=True)
+        way_keys, way_counts = np.unique(wx * n + wy, return_counts=True)
+        keys = np.union1d(node_keys, way_keys)
+        counts_n = np.zeros(len(keys), dtype=np.int64)
+        counts_w = np.zeros(len(keys), dtype=np.int64)
+        counts_n[np.searchsorted(keys, node_keys)] = node_counts
+        counts_w[np.searchsorted(keys, way_keys)] = way_counts
+        conn.executemany("INSERT INTO tiles VALUES (?, ?, ?, ?, ?, ?)",
+                         ((z, int(k // n), int(k % n), quadkey(z, int(k // n), int(k % n)),
+                           int(cn), int(cw))
+                          for k, cn, cw in zip(keys, counts_n, counts_w)))
+        tile_count += len(keys)
+
+    conn.commit()
+    return tile_count
+
+
+def tile_features(conn, z, x, y):
+    """{'nodes': [[id, lat, lon], ...], 'ways': [id, ...]} for one tile"""
+    nodes = conn.execute("""SELECT n.id, n.lat, n.lon FROM tile_features t
+                            JOIN nodes n ON n.id = t.id
+                            WHERE t.z = ? AND t.x = ? AND t.y = ? AND t.element_type = 'node'""",
+                         (z, x, y)).fetchall()
+    ways = conn.execute("""SELECT id FROM tile_features
+                           WHERE z = ? AND x = ? AND y = ? AND element_type = 'way'""",
+                        (z, x, y)).fetchall()
+    return {'nodes': [list(row) for row in nodes], 'ways': [row[0] for row in ways]}
+
+
+def pack_tile(z, x, y, features):
+    """Binary tile: TILE_HEADER, node records as TILE_NODE, then int64 way ids"""
+    nodes = np.zeros(len(features['nodes']), dtype=TILE_NODE)
+    if len(nodes):
+        coords = np.array(features['nodes'], dtype=np.float64)
+        nodes['id'] = coords[:, 0].astype(np.int64)
+        nodes['lat'] = np.round(coords[:, 1] * COORD_SCALE).astype(np.int32)
+        nodes['lon'] = np.round(coords[:, 2] * COORD_SCALE).astype(np.int32)
+    ways = np.array(features['ways'], dtype='<i8')
+    return TILE_HEADER.pack(z, x, y, len(nodes), len(ways)) + nodes.tobytes() + ways.tobytes()
+
+
+def unpack_tile(blob):
+    """Inverse of pack_tile: (z, x, y, node records, way ids)"""
+    z, x, y, node_count, way_count = TILE_HEADER.unpack_from(blob)
+    offset = TILE_HEADER.size
+    nodes = np.frombuffer(blob, dtype=TILE_NODE, count=node_count, offset=offset)
+    offset += node_count * TILE_NODE.itemsize
+    ways = np.frombuffer(blob, dtype='<i8', count=way_count, offset=offset)
+    return z, x, y, nodes, ways
+
+
+def export_tiles(conn, directory, fmt='json', zooms=None):
+    """Write every tile (optionally only some zooms) under directory/z/x/y.json or .bin"""
+    if fmt not in ('json', 'bin'):
+        raise ValueError("fmt must be 'json' or 'bin'")
+    written = 0
+    for z, x, y in conn.execute("SELECT z, x, y FROM tiles ORDER BY z, x, y").fetchall():
+        if zooms is not None and z not in zooms:
+            continue
+        features = tile_features(conn, z, x, y)
+        path = os.path.join(directory, str(z), str(x))
+        os.makedirs(path, exist_ok=True)
+        if fmt == 'json':
+            with open(os.path.join(path, '{}.json'.format(y)), 'w') as f:
+                json.dump(features, f, separators=(',', ':'))
+        else:
+            with open(os.path.join(path, '{}.bin'.format(y)), 'wb') as f:
+                f.write(pack_tile(z, x, y, features))
+        written += 1
+    return written
+
+
+if __name__ == '__main__':
+    conn = create_connection(DB_PATH)
+    print("{} tiles".format(build_tiles(conn)))